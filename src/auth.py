@@ -0,0 +1,321 @@
+"""
+Hash and verify user passwords, and remember recently verified credentials so
+that slow password hashes don't have to be computed for every request. Users
+who log in with the login form get a signed session cookie instead.
+"""
+
+import base64
+import binascii
+import collections
+import crypt
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+
+
+# Prefix of password hashes created by hash_password().
+PBKDF2_PREFIX = 'pbkdf2_sha256'
+# Iterations of PBKDF2 for new password hashes.
+PBKDF2_ITERATIONS = 100000
+# Alphabet of the base64 variant used by crypt(3) hashes.
+CRYPT_ALPHABET = ('./0123456789'
+                  'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz')
+# Name of the cookie holding the session of users who used the login form.
+SESSION_COOKIE = 'scriptform_session'
+
+
+def _pbkdf2_sha256(password, salt, iterations):
+    """
+    PBKDF2 with HMAC-SHA256, for Pythons older than 2.7.8 which lack
+    hashlib.pbkdf2_hmac(). Returns a 32 byte key.
+    """
+    mac = hmac.new(password, None, hashlib.sha256)
+
+    def prf(data):
+        """
+        HMAC of `data` keyed with the password.
+        """
+        prf_mac = mac.copy()
+        prf_mac.update(data)
+        return prf_mac.digest()
+
+    block = prf(salt + '\x00\x00\x00\x01')
+    result = int(binascii.hexlify(block), 16)
+    for _ in xrange(iterations - 1):
+        block = prf(block)
+        result ^= int(binascii.hexlify(block), 16)
+    return binascii.unhexlify('{0:064x}'.format(result))
+
+
+def pbkdf2_sha256(password, salt, iterations):
+    """
+    Derive a 32 byte key from `password` with PBKDF2-HMAC-SHA256.
+    """
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return _pbkdf2_sha256(password, salt, iterations)
+
+
+def compare_digest(a, b):
+    """
+    Compare two strings in constant time, so that the time taken doesn't
+    reveal how much of them matched.
+    """
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for char_a, char_b in zip(a, b):
+        result |= ord(char_a) ^ ord(char_b)
+    return result == 0
+
+
+def hash_password(password, iterations=PBKDF2_ITERATIONS, salt=None):
+    """
+    Return a salted PBKDF2 hash of `password` in the form
+    'pbkdf2_sha256$<iterations>$<salt>$<hash>', for use in the `users`
+    section of a form config.
+    """
+    if salt is None:
+        salt = base64.b64encode(os.urandom(12))
+    pw_hash = pbkdf2_sha256(password, salt, iterations)
+    return '{0}${1}${2}${3}'.format(PBKDF2_PREFIX, iterations, salt,
+                                    base64.b64encode(pw_hash))
+
+
+def verify_password(password, pw_hash):
+    """
+    Return whether `password` matches the password hash `pw_hash`, which is
+    either created by hash_password() or an unsalted hex SHA256 hash, as
+    older versions of Scriptform used.
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf8')
+    if isinstance(pw_hash, unicode):
+        pw_hash = pw_hash.encode('utf8')
+    if pw_hash.startswith(PBKDF2_PREFIX + '$'):
+        try:
+            _, iterations, salt, expected = pw_hash.split('$')
+            iterations = int(iterations)
+        except ValueError:
+            return False
+        pw_hash = base64.b64encode(pbkdf2_sha256(password, salt, iterations))
+        return compare_digest(pw_hash, expected)
+    return compare_digest(hashlib.sha256(password).hexdigest(),
+                          pw_hash.lower())
+
+
+def md5_crypt(password, salt, magic='$apr1$'):
+    """
+    Return the MD5-based crypt(3) hash of `password` with `salt`, as used by
+    Apache's htpasswd (`magic` '$apr1$') and glibc ('$1$').
+    """
+    salt = salt[:8]
+    final = hashlib.md5(password + salt + password).digest()
+    ctx = password + magic + salt
+    for i in xrange(len(password), 0, -16):
+        ctx += final[:min(i, 16)]
+    i = len(password)
+    while i:
+        if i & 1:
+            ctx += '\x00'
+        else:
+            ctx += password[0]
+        i >>= 1
+    final = hashlib.md5(ctx).digest()
+    # Deliberately slow things down.
+    for i in xrange(1000):
+        ctx = password if i & 1 else final
+        if i % 3:
+            ctx += salt
+        if i % 7:
+            ctx += password
+        ctx += final if i & 1 else password
+        final = hashlib.md5(ctx).digest()
+
+    final = [ord(char) for char in final]
+    encoded = []
+    for first, second, third, count in ((0, 6, 12, 4), (1, 7, 13, 4),
+                                        (2, 8, 14, 4), (3, 9, 15, 4),
+                                        (4, 10, 5, 4)):
+        value = (final[first] << 16) | (final[second] << 8) | final[third]
+        for _ in xrange(count):
+            encoded.append(CRYPT_ALPHABET[value & 0x3f])
+            value >>= 6
+    value = final[11]
+    for _ in xrange(2):
+        encoded.append(CRYPT_ALPHABET[value & 0x3f])
+        value >>= 6
+    return '{0}{1}${2}'.format(magic, salt, ''.join(encoded))
+
+
+def verify_htpasswd(password, pw_hash):
+    """
+    Return whether `password` matches `pw_hash` from an htpasswd file. The
+    '{SHA}', '$apr1$' (MD5) and crypt(3) formats of Apache's htpasswd are
+    supported, as well as the formats of verify_password(). Bcrypt hashes
+    are only supported if the `bcrypt` module is installed.
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf8')
+    if isinstance(pw_hash, unicode):
+        pw_hash = pw_hash.encode('utf8')
+    if pw_hash.startswith('{SHA}'):
+        sha1 = hashlib.sha1(password).digest()
+        return compare_digest(base64.b64encode(sha1), pw_hash[5:])
+    if pw_hash.startswith('$apr1$'):
+        salt = pw_hash[6:].split('$', 1)[0]
+        return compare_digest(md5_crypt(password, salt), pw_hash)
+    if pw_hash.startswith(('$2a$', '$2b$', '$2y$')):
+        if bcrypt is None:
+            return False
+        return bcrypt.checkpw(password, pw_hash)
+    if pw_hash.startswith(PBKDF2_PREFIX + '$') or len(pw_hash) == 64:
+        return verify_password(password, pw_hash)
+    return compare_digest(crypt.crypt(password, pw_hash) or '', pw_hash)
+
+
+class CredentialCache(object):
+    """
+    Remembers which credentials were recently verified, and for which user,
+    for at most `ttl` seconds. Credentials aren't stored as they are, but as
+    an HMAC with a random key that only lives in memory. At most
+    `max_entries` credentials are remembered.
+
+    Entries belong to a `generation` of the users they were verified against.
+    When a credential is looked up for another generation, the cache is
+    emptied, so that changed passwords or removed users take effect right
+    away.
+    """
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key = os.urandom(32)
+        self.generation = None
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, credentials, generation):
+        """
+        Return the user whose `credentials` were verified against
+        `generation` of the users, or None if they weren't or it's been too
+        long.
+        """
+        digest = self._digest(credentials)
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+                return None
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            username, expires = entry
+            if expires < time.time():
+                del self.entries[digest]
+                return None
+            return username
+
+    def add(self, credentials, generation, username):
+        """
+        Remember that `credentials` were verified as `username` against
+        `generation` of the users.
+        """
+        digest = self._digest(credentials)
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            self.entries.pop(digest, None)
+            self.entries[digest] = (username, time.time() + self.ttl)
+            while len(self.entries) > self.max_entries:
+                # Entries are in order of expiry, so drop the oldest.
+                self.entries.popitem(last=False)
+
+    def _digest(self, credentials):
+        """
+        Return the key under which `credentials` are stored.
+        """
+        return hmac.new(self.key, credentials, hashlib.sha256).digest()
+
+
+class SessionSigner(object):
+    """
+    Creates and verifies the session tokens of users who logged in, which
+    are valid for `ttl` seconds. A token holds the username and the time it
+    expires, signed with an HMAC under a random key that only lives in
+    memory. Verifying it only takes computing that HMAC, instead of a slow
+    password hash. Restarting Scriptform ends all sessions.
+
+    The HMAC also covers a stamp of the user's password, such as its hash,
+    so that changing a user's password or removing the user ends their
+    sessions.
+
+    If `secure` is True, browsers only send the session cookie over HTTPS.
+    """
+    def __init__(self, ttl=3600, secure=False):
+        self.ttl = ttl
+        self.secure = secure
+        self.key = os.urandom(32)
+
+    def sign(self, username, stamp):
+        """
+        Return a session token for `username`, whose password has the
+        `stamp`.
+        """
+        if isinstance(username, unicode):
+            username = username.encode('utf8')
+        expires = str(int(time.time() + self.ttl))
+        user_b64 = base64.urlsafe_b64encode(username)
+        mac = self._mac(user_b64, expires, stamp)
+        return '{0}.{1}.{2}'.format(user_b64, expires, mac)
+
+    def verify(self, token, get_stamp):
+        """
+        Return the username of the session `token`, or None if it's invalid
+        or has expired. `get_stamp` is called with the username and returns
+        the stamp of their password, or None if there's no such user.
+        """
+        try:
+            user_b64, expires, mac = token.split('.')
+            username = base64.urlsafe_b64decode(user_b64).decode('utf8')
+            if int(expires) < time.time():
+                return None
+        except (ValueError, TypeError):
+            return None
+        stamp = get_stamp(username)
+        if stamp is None or \
+           not compare_digest(self._mac(user_b64, expires, stamp), mac):
+            return None
+        return username
+
+    def cookie(self, token, secure=False):
+        """
+        Return the value of a Set-Cookie header that stores `token` in the
+        browser for as long as it's valid. An empty `token` removes it. The
+        cookie is marked `Secure` if `secure` is True (e.g. because it's set
+        over HTTPS), or if the signer was created with `secure`.
+        """
+        max_age = self.ttl if token else 0
+        cookie = '{0}={1}; Max-Age={2}; HttpOnly; SameSite=Lax'.format(
+            SESSION_COOKIE, token, max_age)
+        if secure or self.secure:
+            cookie += '; Secure'
+        return cookie
+
+    def _mac(self, user_b64, expires, stamp):
+        """
+        Return the signature of a token as a hex string.
+        """
+        if isinstance(stamp, unicode):
+            stamp = stamp.encode('utf8')
+        msg = '{0}.{1}.{2}'.format(user_b64, expires, stamp)
+        return hmac.new(self.key, msg, hashlib.sha256).hexdigest()
@@ -0,0 +1,225 @@
+"""
+Sources of the users that may log in to Scriptform. By default, users are
+defined in the `users` section of the form config. An `auth` section selects
+another backend instead, such as an htpasswd file or an LDAP directory.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from auth import CredentialCache, verify_htpasswd, verify_password
+from formconfig import FormConfigError
+from ldapclient import LDAPConnectionPool, LDAPError, escape_dn_value
+
+
+class AuthBackend(object):
+    """
+    Base class of authentication backends, which check the passwords of
+    users. Usernames are unicode strings, passwords are byte strings.
+    """
+    def generation(self):
+        """
+        Return a value that changes whenever users or their passwords might
+        have changed, so that credentials verified for an older generation
+        can be forgotten.
+        """
+        return 0
+
+    def authenticate(self, username, password):
+        """
+        Return whether `password` is the password of the user `username`.
+        """
+        raise NotImplementedError()
+
+    def session_stamp(self, username):
+        """
+        Return a string that changes when the password of `username`
+        changes, which session tokens are signed with. Returns None if
+        there's no such user.
+        """
+        raise NotImplementedError()
+
+
+class UsersBackend(AuthBackend):
+    """
+    Users from the `users` section of the form config, which maps usernames
+    to password hashes.
+    """
+    def __init__(self, users):
+        self.users = users
+
+    def authenticate(self, username, password):
+        pw_hash = self.users.get(username)
+        return pw_hash is not None and verify_password(password, pw_hash)
+
+    def session_stamp(self, username):
+        return self.users.get(username)
+
+
+class HtpasswdBackend(AuthBackend):
+    """
+    Users from the Apache htpasswd file at `path`. The file is indexed in
+    memory and read again when it changes, which is checked at most once
+    every `check_interval` seconds.
+    """
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.users = {}
+        self.file_stat = None
+        self.checked = 0
+        self.gen = 0
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('AUTH')
+        if not os.path.isfile(path):
+            raise ValueError("No such file: {0}".format(path))
+        self.check()
+
+    def generation(self):
+        self.check()
+        return self.gen
+
+    def authenticate(self, username, password):
+        self.check()
+        pw_hash = self.users.get(username)
+        return pw_hash is not None and verify_htpasswd(password, pw_hash)
+
+    def session_stamp(self, username):
+        self.check()
+        return self.users.get(username)
+
+    def check(self):
+        """
+        Read the file again if it has changed since it was last read.
+        """
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        with self.lock:
+            if now - self.checked < self.check_interval:
+                return
+            self.checked = now
+            try:
+                fstat = os.stat(self.path)
+                file_stat = (fstat.st_mtime, fstat.st_size, fstat.st_ino)
+            except OSError as err:
+                if self.file_stat is not None:
+                    self.log.error("Can't read {0}: {1}".format(self.path,
+                                                                err))
+                # Nobody can log in without the file.
+                file_stat = None
+            if file_stat == self.file_stat:
+                return
+            users = {}
+            if file_stat is not None:
+                users = self.load()
+            self.users = users
+            self.file_stat = file_stat
+            self.gen += 1
+
+    def load(self):
+        """
+        Read the file and return a dict that maps usernames to password
+        hashes.
+        """
+        users = {}
+        with open(self.path, 'r') as fileobj:
+            for line in fileobj:
+                line = line.strip()
+                if not line or line.startswith('#') or ':' not in line:
+                    continue
+                username, pw_hash = line.split(':', 1)
+                users[username.decode('utf8', 'replace')] = pw_hash
+        return users
+
+
+class LDAPBackend(AuthBackend):
+    """
+    Users of the LDAP directory at `url`, whose passwords are checked by
+    binding as the user. `user_dn` is the distinguished name of users, in
+    which '{username}' is replaced by the username, e.g.
+    'uid={username},ou=people,dc=example,dc=com'.
+
+    At most `pool_size` connections to the server are kept open. Correct
+    passwords are remembered for `cache_ttl` seconds and wrong ones for
+    `negative_cache_ttl` seconds, so that the directory isn't asked again for
+    every request.
+    """
+    def __init__(self, url, user_dn, pool_size=4, timeout=5.0, cache_ttl=60,
+                 negative_cache_ttl=10):
+        if '{username}' not in user_dn:
+            raise ValueError("user_dn must contain '{username}'")
+        if isinstance(user_dn, str):
+            user_dn = user_dn.decode('utf8')
+        self.user_dn = user_dn
+        self.pool = LDAPConnectionPool(url, pool_size, timeout)
+        self.cache = None
+        if cache_ttl:
+            self.cache = CredentialCache(cache_ttl)
+        self.negative_cache = None
+        if negative_cache_ttl:
+            self.negative_cache = CredentialCache(negative_cache_ttl)
+        self.log = logging.getLogger('AUTH')
+
+    def authenticate(self, username, password):
+        # An LDAP bind without a password always succeeds.
+        if not username or not password:
+            return False
+        username_utf8 = username.encode('utf8')
+        credentials = '{0}:{1}{2}'.format(len(username_utf8), username_utf8,
+                                          password)
+        if self.cache is not None and \
+           self.cache.get(credentials, 0) is not None:
+            return True
+        if self.negative_cache is not None and \
+           self.negative_cache.get(credentials, 0) is not None:
+            return False
+
+        try:
+            valid = self.pool.bind(self.get_dn(username), password)
+        except LDAPError as err:
+            self.log.error("Can't authenticate {0!r}: {1}".format(username,
+                                                                  err))
+            return False
+
+        cache = self.cache if valid else self.negative_cache
+        if cache is not None:
+            cache.add(credentials, 0, username)
+        return valid
+
+    def session_stamp(self, username):
+        # There's no way to tell whether the password changed without
+        # asking for it, so sessions last until they expire.
+        return self.get_dn(username)
+
+    def get_dn(self, username):
+        """
+        Return the distinguished name of the user `username`.
+        """
+        dn = self.user_dn.format(username=escape_dn_value(username))
+        return dn.encode('utf8')
+
+
+# Backends that can be selected with the `type` of the `auth` section.
+BACKENDS = {
+    'htpasswd': HtpasswdBackend,
+    'ldap': LDAPBackend,
+}
+
+
+def get_auth_backend(auth_config):
+    """
+    Create the backend described by the `auth` section of a form config:
+    its `type` and the backend's options.
+    """
+    options = dict((str(key), value) for key, value in auth_config.items())
+    backend_type = options.pop('type', None)
+    if backend_type not in BACKENDS:
+        raise FormConfigError("Unknown auth type: {0}".format(backend_type))
+    try:
+        return BACKENDS[backend_type](**options)
+    except (TypeError, ValueError) as err:
+        raise FormConfigError("Invalid {0} auth config: {1}".format(
+            backend_type, err))
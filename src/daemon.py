@@ -9,6 +9,9 @@ import signal
 import time
 import errno
 import atexit
+import threading
+
+from logqueue import QueueFileHandler
 
 
 class DaemonError(Exception):
@@ -21,9 +24,13 @@ class DaemonError(Exception):
 class Daemon(object):  # pragma: no cover
     """
     Daemonize the current process (detach it from the console).
+
+    If `log_queue_size` is given, log records are written to the log file by
+    a background thread, with at most that many records waiting to be
+    written. Otherwise they're written by the thread that logs them.
     """
     def __init__(self, pid_file, log_file=None, log_level=logging.INFO,
-                 foreground=False):
+                 foreground=False, log_queue_size=None):
         if pid_file is None:
             self.pid_file = '{0}.pid'.format(os.path.basename(sys.argv[0]))
         else:
@@ -35,10 +42,16 @@ class Daemon(object):  # pragma: no cover
         self.foreground = foreground
 
         log_fmt = '%(asctime)s:%(name)s:%(levelname)s:%(message)s'
-        logging.basicConfig(level=log_level,
-                            format=log_fmt,
-                            filename=self.log_file,
-                            filemode='a')
+        if log_queue_size:
+            handler = QueueFileHandler(self.log_file, log_queue_size)
+            handler.setFormatter(logging.Formatter(log_fmt))
+            logging.getLogger().addHandler(handler)
+            logging.getLogger().setLevel(log_level)
+        else:
+            logging.basicConfig(level=log_level,
+                                format=log_fmt,
+                                filename=self.log_file,
+                                filemode='a')
         self.log = logging.getLogger('DAEMON')
         self.shutdown_callback = None
 
@@ -169,3 +182,103 @@ class Daemon(object):  # pragma: no cover
         if os.path.exists(self.pid_file):
             os.unlink(self.pid_file)
         self.shutdown_callback()
+
+
+class Supervisor(object):
+    """
+    Run a function in a number of forked worker processes and restart any
+    worker that exits, until stop() is called. Anything set up before calling
+    run(), such as a listening socket, is shared by all the workers.
+    """
+    def __init__(self, worker_count, worker_cb):
+        self.worker_count = worker_count
+        self.worker_cb = worker_cb
+        self.children = {}
+        self.running = False
+        self.log = logging.getLogger('SUPERVISOR')
+
+    def run(self):
+        """
+        Start the workers and supervise them. Blocks until stop() has been
+        called and all workers have exited.
+        """
+        self.running = True
+        while True:
+            while self.running and len(self.children) < self.worker_count:
+                self._spawn()
+            if not self.children:
+                break
+
+            try:
+                pid, status = os.wait()
+            except OSError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            except KeyboardInterrupt:
+                self.stop()
+                continue
+
+            started = self.children.pop(pid, None)
+            if started is not None and self.running:
+                self.log.error("Worker {0} exited with status {1}. "
+                               "Restarting".format(pid, status))
+                if time.time() - started < 1:
+                    # Don't fork like crazy if workers die right away.
+                    time.sleep(1)
+
+    def stop(self):
+        """
+        Stop all the workers. They're sent a SIGTERM and won't be restarted.
+        """
+        self.running = False
+        self.signal_workers(signal.SIGTERM)
+
+    def signal_workers(self, sig):
+        """
+        Send the signal `sig` to all the workers.
+        """
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def _spawn(self):
+        """
+        Fork a new worker process which runs the worker callback and exits.
+        """
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            exitcode = 0
+            try:
+                self._watch_parent()
+                self.worker_cb()
+            except Exception as err:
+                self.log.exception(err)
+                exitcode = 1
+            finally:
+                # Don't run the parent's atexit handlers, etc.
+                os._exit(exitcode)
+        self.log.info("Started worker {0}".format(pid))
+        self.children[pid] = time.time()
+
+    def _watch_parent(self):  # pragma: no cover
+        """
+        Start a thread in the worker process that sends the worker a SIGTERM
+        if the supervisor goes away without stopping it first (for instance
+        if it was killed), so that workers aren't left running on their own.
+        """
+        parent_pid = os.getppid()
+
+        def watch():
+            """
+            Wait until the parent process is gone.
+            """
+            while os.getppid() == parent_pid:
+                time.sleep(1)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        watcher = threading.Thread(target=watch)
+        watcher.daemon = True
+        watcher.start()
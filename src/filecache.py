@@ -0,0 +1,178 @@
+"""
+Keep small static files in memory, so that frequently requested files don't
+have to be read from disk for every request.
+"""
+
+import collections
+import os
+import stat
+import threading
+import time
+
+from webserver import COMPRESSIBLE_TYPES, compress, file_etag, guess_type
+
+
+class CachedFile(object):
+    """
+    The contents of the file at `path` and everything needed to serve it. If
+    it's worth compressing, `gzip_data` holds a gzip compressed version.
+    `sidecar` is the size and mtime of the file's '.gz' version when it was
+    read, or None if there was none.
+    """
+    def __init__(self, path, data, mtime, gzip_data=None):
+        self.path = path
+        self.data = data
+        self.size = len(data)
+        self.mtime = mtime
+        self.content_type = guess_type(path)
+        self.etag = file_etag(self.size, mtime)
+        self.gzip_data = gzip_data
+        self.gzip_etag = self.etag[:-1] + '-gz"'
+        self.sidecar = None
+        self.checked = time.time()
+
+    def memory_size(self):
+        """
+        Return the number of bytes of file data held in memory.
+        """
+        return self.size + len(self.gzip_data or '')
+
+
+class FileCache(object):
+    """
+    Least recently used cache of files of at most `max_file_size` bytes,
+    holding at most `max_size` bytes of data in total. Whether a cached file
+    has changed on disk is checked at most once every `check_interval`
+    seconds.
+
+    If `compress` is True, textual files of at least `compress_min_size`
+    bytes are also kept gzip compressed. If there's a 'foo.css.gz' file next
+    to 'foo.css' that's at least as new, its contents are used instead of
+    compressing the file ourselves. A cached file is also read again when
+    its '.gz' file changes, appears or disappears.
+    """
+    def __init__(self, max_size=8 * 1024 * 1024, max_file_size=256 * 1024,
+                 check_interval=1.0, compress=True, compress_min_size=1024):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.files = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Return the CachedFile for the file at `path`, reading it if it's not
+        cached yet or has changed. Returns None if the file doesn't exist,
+        isn't a regular file or is too large to cache.
+        """
+        now = time.time()
+        with self.lock:
+            cached = self.files.pop(path, None)
+            if cached is not None:
+                # Move it to the most recently used end.
+                self.files[path] = cached
+                if now - cached.checked < self.check_interval:
+                    return cached
+
+        try:
+            fstat = os.stat(path)
+        except OSError:
+            fstat = None
+        if fstat is None or not stat.S_ISREG(fstat.st_mode) or \
+           fstat.st_size > self.max_file_size:
+            self._remove(path)
+            return None
+        if cached is not None and cached.size == fstat.st_size and \
+           cached.mtime == fstat.st_mtime and \
+           (not self.compress or cached.sidecar == self._sidecar_stat(path)):
+            cached.checked = now
+            return cached
+
+        try:
+            cached = self._load(path)
+        except (IOError, OSError):
+            self._remove(path)
+            return None
+        if cached.size > self.max_file_size:
+            # It grew since we checked.
+            self._remove(path)
+            return None
+        self._add(cached)
+        return cached
+
+    def _load(self, path):
+        """
+        Read the file at `path` and, if it's worth it, its gzipped version.
+        """
+        with open(path, 'rb') as fileobj:
+            mtime = os.fstat(fileobj.fileno()).st_mtime
+            data = fileobj.read()
+        cached = CachedFile(path, data, mtime)
+        if not self.compress:
+            return cached
+        # Stat it before reading it, so that a sidecar that changes while
+        # it's read is read again next time.
+        cached.sidecar = self._sidecar_stat(path)
+        if len(data) >= self.compress_min_size and \
+           cached.content_type.startswith(COMPRESSIBLE_TYPES):
+            gzip_data = self._load_sidecar(path, mtime)
+            if gzip_data is None:
+                gzip_data = ''.join(compress([data], 'gzip', 9))
+            elif cached.sidecar is not None:
+                # A new sidecar for the same file gets a new ETag.
+                cached.gzip_etag = '{0}-{1}-gz"'.format(
+                    cached.etag[:-1], file_etag(*cached.sidecar)[1:-1])
+            if len(gzip_data) < len(data):
+                cached.gzip_data = gzip_data
+        return cached
+
+    def _sidecar_stat(self, path):
+        """
+        Return the size and mtime of the '.gz' version of the file at `path`,
+        or None if there's no such file.
+        """
+        try:
+            fstat = os.stat(path + '.gz')
+        except OSError:
+            return None
+        return (fstat.st_size, fstat.st_mtime)
+
+    def _load_sidecar(self, path, mtime):
+        """
+        Return the contents of the precompressed '.gz' version of the file at
+        `path`, or None if there's no such file or it's older than the file.
+        """
+        try:
+            with open(path + '.gz', 'rb') as fileobj:
+                if os.fstat(fileobj.fileno()).st_mtime < mtime:
+                    return None
+                return fileobj.read()
+        except (IOError, OSError):
+            return None
+
+    def _add(self, cached):
+        """
+        Add `cached` to the cache and evict the least recently used files
+        until everything fits.
+        """
+        with self.lock:
+            old = self.files.pop(cached.path, None)
+            if old is not None:
+                self.size -= old.memory_size()
+            self.files[cached.path] = cached
+            self.size += cached.memory_size()
+            while self.size > self.max_size and self.files:
+                _, evicted = self.files.popitem(last=False)
+                self.size -= evicted.memory_size()
+
+    def _remove(self, path):
+        """
+        Remove the file at `path` from the cache, if it's in there.
+        """
+        with self.lock:
+            cached = self.files.pop(path, None)
+            if cached is not None:
+                self.size -= cached.memory_size()
@@ -23,14 +23,25 @@ class FormConfig(object):
     form configuration being served by this instance of ScriptForm.
     """
     def __init__(self, title, forms, users=None, static_dir=None,
-                 custom_css=None):
+                 custom_css=None, metrics_users=None, generation=0,
+                 fingerprint=None, auth_backend=None):
         self.title = title
         self.users = {}
         if users is not None:
             self.users = users
+        # authbackends.AuthBackend which users must log in with, or None if
+        # no login is required.
+        self.auth_backend = auth_backend
         self.forms = forms
         self.static_dir = static_dir
         self.custom_css = custom_css
+        self.metrics_users = metrics_users
+        # Changes whenever the configuration it was read from changes, so
+        # things derived from it can be cached per generation.
+        self.generation = generation
+        # Hash of the configuration's contents. Unlike the generation, it's
+        # the same in every process and after a restart.
+        self.fingerprint = fingerprint
         self.log = logging.getLogger('FORMCONFIG')
 
         # Validate scripts
@@ -0,0 +1,545 @@
+"""
+Streaming parser for submitted form data. Uploaded files are written straight
+to temporary files while the request body comes in. Other form fields are kept
+in memory, unless they're too large for that.
+"""
+
+import cgi
+import os
+import re
+import tempfile
+import threading
+import urllib
+
+import metrics
+
+
+MAX_PART_HEADER_SIZE = 16 * 1024
+
+UPLOAD_BYTES = metrics.Counter(
+    'scriptform_upload_bytes_total',
+    "Bytes of uploaded files received.")
+
+
+class FormDataError(Exception):
+    """
+    Raised if the form data can't be parsed or is too large. `status_code` is
+    the HTTP status code that best describes the problem.
+    """
+    def __init__(self, msg, status_code=400):
+        self.msg = msg
+        self.status_code = status_code
+        Exception.__init__(self, msg, status_code)
+
+
+class UploadedFile(object):
+    """
+    A file uploaded through a file field. `path` is the temporary file the
+    upload was written to, `filename` is the name of the file on the client.
+    """
+    def __init__(self, path, filename):
+        self.path = path
+        self.filename = filename
+        self.size = 0
+
+
+class SpilledField(object):
+    """
+    The value of a normal form field that was too large to keep in memory.
+    It's in the temporary file `path`, which is `size` bytes.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def read(self):
+        """
+        Return the value.
+        """
+        with open(self.path, 'rb') as fileobj:
+            return fileobj.read()
+
+
+class FieldValue(object):
+    """
+    Collects the value of the normal form field `name` of the FormData
+    `form_data`. Up to `max_memory` bytes are kept in memory. If the value is
+    larger, it's spilled to a temporary file, if `max_size` allows it. Values
+    over `max_size` bytes (or over `max_memory` if `max_size` is None) raise
+    a FormDataError.
+    """
+    def __init__(self, form_data, name, max_memory, max_size=None):
+        self.form_data = form_data
+        self.name = name
+        self.max_memory = max_memory
+        self.max_size = max_memory if max_size is None else max_size
+        self.size = 0
+        self.buf = []
+        self.path = None
+        self.tmp_file = None
+
+    def write(self, data):
+        """
+        Add `data` to the value.
+        """
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise FormDataError("Field '{0}' is too large".format(self.name),
+                                413)
+        if self.tmp_file is None and self.size > self.max_memory:
+            fdescriptor, self.path = tempfile.mkstemp(
+                prefix="scriptform_field_")
+            self.form_data.tmp_files.append(self.path)
+            self.tmp_file = os.fdopen(fdescriptor, 'wb')
+            self.tmp_file.write(''.join(self.buf))
+            self.buf = []
+        if self.tmp_file is not None:
+            self.tmp_file.write(data)
+        else:
+            self.buf.append(data)
+
+    def close(self):
+        """
+        Close the temporary file, if any.
+        """
+        if self.tmp_file is not None:
+            self.tmp_file.close()
+            self.tmp_file = None
+
+    def value(self):
+        """
+        Return the value as a string, or as a SpilledField if it was spilled
+        to disk.
+        """
+        self.close()
+        if self.path is not None:
+            return SpilledField(self.path, self.size)
+        return ''.join(self.buf)
+
+
+class FormData(object):
+    """
+    The parsed values of a submitted form. `fields` maps the names of normal
+    form fields to their values, which are strings or, if they were too large
+    to keep in memory, SpilledField instances. `files` maps the names of file
+    fields to UploadedFile instances. Only the first value of each field is
+    kept.
+    """
+    def __init__(self):
+        self.fields = {}
+        self.files = {}
+        self.tmp_files = []
+        # The UploadBudget the request's body is counted against, and the
+        # number of bytes reserved in it.
+        self.budget = None
+        self.reserved = 0
+
+    def getfirst(self, name, default=None):
+        """
+        Return the value of the normal form field `name`, or `default` if
+        there is no such field.
+        """
+        value = self.fields.get(name, default)
+        if isinstance(value, SpilledField):
+            return value.read()
+        return value
+
+    def field_values(self):
+        """
+        Return a dict that maps the names of all normal form fields to their
+        values as strings. Values that were spilled to disk are read back.
+        """
+        return dict((name, self.getfirst(name)) for name in self.fields)
+
+    def detach_uploads(self):
+        """
+        Return a new FormData that takes over the temporary files of all
+        uploads and the upload budget reserved for them, so that cleanup()
+        and release() leave them alone. It's then up to the caller to
+        cleanup() and release() the returned FormData.
+        """
+        uploads = FormData()
+        uploads.files = self.files
+        uploads.tmp_files, self.tmp_files = self.tmp_files, []
+        uploads.budget, uploads.reserved = self.budget, self.reserved
+        self.budget = None
+        self.reserved = 0
+        return uploads
+
+    def release(self):
+        """
+        Release the upload budget reserved for the request's body, if any.
+        """
+        if self.budget is not None:
+            self.budget.release(self.reserved)
+            self.budget = None
+            self.reserved = 0
+
+    def cleanup(self):
+        """
+        Remove the temporary files of all uploads.
+        """
+        for tmp_fname in self.tmp_files:
+            if os.path.exists(tmp_fname):
+                os.unlink(tmp_fname)
+        self.tmp_files = []
+
+
+class UploadBudget(object):
+    """
+    Limits the total size of request bodies that are being received, or whose
+    uploads are kept on disk, at the same time. A request's Content-Length is
+    reserved before its body is read and released once it has been handled,
+    or, if a background job takes over its uploads, once the job has run.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        Reserve `size` bytes. Returns False if that would exceed the budget.
+        """
+        with self.lock:
+            if self.in_flight + size > self.max_bytes:
+                return False
+            self.in_flight += size
+            return True
+
+    def release(self, size):
+        """
+        Release `size` previously reserved bytes.
+        """
+        with self.lock:
+            self.in_flight -= size
+
+
+class MultipartParser(object):
+    """
+    Parser for 'multipart/form-data' request bodies. At most `length` bytes
+    are read from `rfile`, in chunks of `chunk_size` bytes. Data is held in
+    memory until a chunk is complete and is then written to the upload's temp
+    file. Normal fields are kept in memory up to `max_field_size` bytes and
+    are spilled to a temp file up to `max_spill_size` bytes (see
+    FieldValue). After each normal field, `field_cb` is called with the form
+    data parsed so far.
+    """
+    def __init__(self, rfile, length, boundary, max_field_size,
+                 chunk_size, field_cb=None, max_spill_size=None):
+        self.rfile = rfile
+        self.remaining = length
+        self.boundary = '--' + boundary
+        self.max_field_size = max_field_size
+        self.max_spill_size = max_spill_size
+        self.chunk_size = chunk_size
+        self.field_cb = field_cb
+        self.buf = ''
+
+    def parse(self, form_data):
+        """
+        Parse the request body into the FormData instance `form_data`.
+        """
+        # Skip anything before the first boundary.
+        self._read_until(self.boundary, None)
+
+        while True:
+            # A boundary is either followed by '--' for the last boundary, or
+            # by the headers of the next part.
+            while len(self.buf) < 2:
+                self._read()
+            if self.buf.startswith('--'):
+                break
+
+            while True:
+                end = self.buf.find('\r\n\r\n')
+                if end != -1:
+                    break
+                if len(self.buf) > MAX_PART_HEADER_SIZE:
+                    raise FormDataError("Multipart headers too large")
+                self._read()
+            part_headers = self._parse_part_headers(self.buf[:end])
+            self.buf = self.buf[end + 4:]
+
+            disposition, params = cgi.parse_header(
+                part_headers.get('content-disposition', ''))
+            if disposition != 'form-data' or 'name' not in params:
+                raise FormDataError("Invalid multipart Content-Disposition")
+
+            if 'filename' in params:
+                self._parse_file(form_data, params['name'],
+                                 params['filename'])
+            else:
+                self._parse_field(form_data, params['name'])
+
+        # Skip anything after the last boundary.
+        while self.remaining > 0:
+            self._read()
+            self.buf = ''
+
+    def _parse_field(self, form_data, name):
+        """
+        Read the value of a normal field.
+        """
+        value = FieldValue(form_data, name, self.max_field_size,
+                           self.max_spill_size)
+        try:
+            self._read_until('\r\n' + self.boundary, value.write)
+        finally:
+            value.close()
+        form_data.fields.setdefault(name, value.value())
+        if self.field_cb is not None:
+            self.field_cb(form_data)
+
+    def _parse_file(self, form_data, name, filename):
+        """
+        Stream an uploaded file to a temporary file. File fields for which no
+        file was selected are skipped.
+        """
+        if filename == '' or name in form_data.files:
+            self._read_until('\r\n' + self.boundary, None)
+            return
+
+        fdescriptor, tmp_fname = tempfile.mkstemp(prefix="scriptform_")
+        form_data.tmp_files.append(tmp_fname)
+        # Scripts may run as a different user, which must be able to read it.
+        os.fchmod(fdescriptor, 0644)
+        upload = UploadedFile(tmp_fname, filename)
+        tmp_file = os.fdopen(fdescriptor, 'wb')
+
+        def write(data):
+            """
+            Write the uploaded data to the temp file.
+            """
+            upload.size += len(data)
+            UPLOAD_BYTES.inc(amount=len(data))
+            tmp_file.write(data)
+
+        try:
+            self._read_until('\r\n' + self.boundary, write)
+        finally:
+            tmp_file.close()
+        form_data.files[name] = upload
+
+    def _parse_part_headers(self, header_block):
+        """
+        Parse the headers of a part into a dict with lowercase header names.
+        """
+        part_headers = {}
+        for line in header_block.split('\r\n'):
+            if ':' in line:
+                header_k, header_v = line.split(':', 1)
+                part_headers[header_k.strip().lower()] = header_v.strip()
+        return part_headers
+
+    def _read_until(self, delimiter, write_cb):
+        """
+        Consume the body up to and including `delimiter`. Everything in
+        front of the delimiter is passed to `write_cb` (if it's not None) as
+        soon as it's clear it's not part of the delimiter.
+        """
+        keep = len(delimiter) - 1
+        while True:
+            end = self.buf.find(delimiter)
+            if end != -1:
+                if write_cb is not None and end > 0:
+                    write_cb(self.buf[:end])
+                self.buf = self.buf[end + len(delimiter):]
+                return
+            if len(self.buf) > keep:
+                if write_cb is not None:
+                    write_cb(self.buf[:-keep])
+                self.buf = self.buf[-keep:]
+            self._read()
+
+    def _read(self):
+        """
+        Read the next chunk of the body into the buffer.
+        """
+        if self.remaining <= 0:
+            raise FormDataError("Unexpected end of multipart data")
+        chunk = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not chunk:
+            raise FormDataError("Unexpected end of request body")
+        self.remaining -= len(chunk)
+        self.buf += chunk
+
+
+class URLEncodedParser(object):
+    """
+    Parser for 'application/x-www-form-urlencoded' request bodies, which
+    reads `length` bytes from `rfile` in chunks of `chunk_size` bytes. Values
+    are collected by FieldValue, so large ones are spilled to disk like
+    those of MultipartParser. After each field, `field_cb` is called with the
+    form data parsed so far.
+    """
+    # Separators of names and values, and of fields.
+    NAME_END = re.compile('[=&;]')
+    VALUE_END = re.compile('[&;]')
+
+    def __init__(self, rfile, length, max_field_size, chunk_size,
+                 field_cb=None, max_spill_size=None):
+        self.rfile = rfile
+        self.remaining = length
+        self.max_field_size = max_field_size
+        self.max_spill_size = max_spill_size
+        self.chunk_size = chunk_size
+        self.field_cb = field_cb
+        # The (encoded) name of the field being read, its FieldValue once
+        # its '=' has been seen, and the end of the value that can't be
+        # decoded until more data comes in.
+        self.name = ''
+        self.value = None
+        self.undecoded = ''
+
+    def parse(self, form_data):
+        """
+        Parse the request body into the FormData instance `form_data`.
+        """
+        try:
+            while self.remaining > 0:
+                chunk = self.rfile.read(min(self.chunk_size, self.remaining))
+                if not chunk:
+                    raise FormDataError("Unexpected end of request body")
+                self.remaining -= len(chunk)
+                self._feed(form_data, chunk)
+            self._end_field(form_data)
+        finally:
+            if self.value is not None:
+                self.value.close()
+
+    def _feed(self, form_data, data):
+        """
+        Parse the next piece of the body.
+        """
+        while data:
+            if self.value is None:
+                match = self.NAME_END.search(data)
+                if match is None:
+                    self.name += data
+                    if len(self.name) > MAX_PART_HEADER_SIZE:
+                        raise FormDataError("Field name too large")
+                    return
+                self.name += data[:match.start()]
+                data = data[match.end():]
+                if match.group() == '=':
+                    self.value = FieldValue(
+                        form_data, urllib.unquote_plus(self.name),
+                        self.max_field_size, self.max_spill_size)
+                else:
+                    self._end_field(form_data)
+            else:
+                match = self.VALUE_END.search(data)
+                if match is None:
+                    self.value.write(self._decode(data))
+                    return
+                self.value.write(self._decode(data[:match.start()]))
+                data = data[match.end():]
+                self._end_field(form_data)
+
+    def _decode(self, data, final=False):
+        """
+        Decode the next piece of a value. An escape ('%xx') that's cut off at
+        the end is kept until the rest of it comes in.
+        """
+        data = self.undecoded + data
+        end = len(data)
+        if not final:
+            escape = data.rfind('%', max(0, end - 2))
+            if escape != -1:
+                end = escape
+        self.undecoded = data[end:]
+        return urllib.unquote_plus(data[:end])
+
+    def _end_field(self, form_data):
+        """
+        Add the field that was just read, if any, to `form_data`.
+        """
+        if self.value is None and not self.name:
+            return
+        name = urllib.unquote_plus(self.name)
+        value = ''
+        if self.value is not None:
+            self.value.write(self._decode('', True))
+            value = self.value.value()
+        form_data.fields.setdefault(name, value)
+        self.name = ''
+        self.value = None
+        self.undecoded = ''
+        if self.field_cb is not None:
+            self.field_cb(form_data)
+
+
+def get_content_length(headers):
+    """
+    Return the length of the request body from the request's `headers`.
+    Raises FormDataError if it's missing or invalid.
+    """
+    length = headers.get('content-length', None)
+    if length is None:
+        raise FormDataError("Content-Length required", 411)
+    try:
+        length = int(length)
+    except ValueError:
+        raise FormDataError("Invalid Content-Length")
+    if length < 0:
+        raise FormDataError("Invalid Content-Length")
+    return length
+
+
+def parse(rfile, headers, max_field_size=1024 * 1024, chunk_size=64 * 1024,
+          max_size_cb=None, max_spill_size=None):
+    """
+    Parse the form data in the request body, which can be read from `rfile`.
+    `headers` are the request's headers. Returns a FormData instance. Raises
+    FormDataError if the data is invalid or too large.
+
+    Normal fields are kept in memory up to `max_field_size` bytes. Larger
+    fields are spilled to temp files up to `max_spill_size` bytes, and are
+    rejected beyond that. If `max_spill_size` is None, fields are never
+    spilled and are rejected beyond `max_field_size`. Uploaded files are
+    written to disk in chunks of `chunk_size` bytes. The body is read in
+    chunks of that size too.
+
+    `max_size_cb` is called with the FormData before the body is read and
+    again after each normal field has been parsed. It returns the maximum
+    size of the body, or None for no limit, so the limit can depend on the
+    values of fields. Bodies over the limit are rejected as soon as it's
+    known, without reading the rest of the body.
+    """
+    length = get_content_length(headers)
+    form_data = FormData()
+
+    def check_size(form_data):
+        """
+        Raise a FormDataError if the body is larger than allowed for the form
+        data parsed so far.
+        """
+        if max_size_cb is not None:
+            max_size = max_size_cb(form_data)
+            if max_size is not None and length > max_size:
+                raise FormDataError("Request body too large", 413)
+
+    check_size(form_data)
+    content_type, params = cgi.parse_header(
+        headers.get('content-type', 'application/x-www-form-urlencoded'))
+
+    if content_type == 'multipart/form-data':
+        boundary = params.get('boundary', '')
+        if not cgi.valid_boundary(boundary):
+            raise FormDataError("Invalid multipart boundary")
+        parser = MultipartParser(rfile, length, boundary, max_field_size,
+                                 chunk_size, check_size, max_spill_size)
+    elif content_type == 'application/x-www-form-urlencoded':
+        parser = URLEncodedParser(rfile, length, max_field_size, chunk_size,
+                                  check_size, max_spill_size)
+    else:
+        raise FormDataError("Unsupported form data", 415)
+
+    try:
+        parser.parse(form_data)
+    except Exception:
+        form_data.cleanup()
+        raise
+
+    return form_data
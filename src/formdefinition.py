@@ -19,7 +19,8 @@ class FormDefinition(object):
     """
     def __init__(self, name, title, description, fields, script,
                  output='escaped', hidden=False, submit_title="Submit",
-                 allowed_users=None, run_as=None):
+                 allowed_users=None, run_as=None, max_upload_size=None,
+                 stream=False, run_async=False):
         self.name = name
         self.title = title
         self.description = description
@@ -30,13 +31,27 @@ class FormDefinition(object):
         self.submit_title = submit_title
         self.allowed_users = allowed_users
         self.run_as = run_as
+        self.max_upload_size = max_upload_size
+        # Whether 'escaped' and 'html' output is sent while the script runs.
+        self.stream = stream
+        # Whether the script runs as a background job (the `async` option).
+        self.run_async = run_async
 
         self.validate_field_defs(self.fields)
 
+        # Look up field definitions and their validation methods once, rather
+        # than for every field of every submitted form.
+        self.field_defs = {}
+        self.field_validators = {}
+        for field in self.fields:
+            self.field_defs[field['name']] = field
+            self.field_validators[field['name']] = \
+                self.validators[field['type']]
+
     def validate_field_defs(self, fields):
         """
-        Make sure all required properties are present when loading a field
-        definition.
+        Make sure all required properties are present and the field type is
+        known when loading a field definition.
         """
         required = ['name', 'title', 'type']
         for field in fields:
@@ -44,15 +59,18 @@ class FormDefinition(object):
                 if not prop_name in field:
                     raise KeyError("Missing required property '{0}' for field "
                                    "'{1}'".format(prop_name, str(field)))
+            if field['type'] not in self.validators:
+                raise ValueError("Unknown type '{0}' for field "
+                                 "'{1}'".format(field['type'], field['name']))
 
     def get_field_def(self, field_name):
         """
         Return the field definition for `field_name`.
         """
-        for field in self.fields:
-            if field['name'] == field_name:
-                return field
-        raise KeyError("Unknown field: {0}".format(field_name))
+        try:
+            return self.field_defs[field_name]
+        except KeyError:
+            raise KeyError("Unknown field: {0}".format(field_name))
 
     def validate(self, form_values):
         """
@@ -92,15 +110,12 @@ class FormDefinition(object):
 
     def _field_validate(self, field_name, form_values):
         """
-        Validate a field in this form. This does a dynamic call to a method on
-        this class in the form 'validate_<field_type>'.
+        Validate a field in this form. This calls the method for the field's
+        type in the form 'validate_<field_type>'.
         """
-        # Find field definition by iterating through all the fields.
         field_def = self.get_field_def(field_name)
-
-        field_type = field_def['type']
-        validate_cb = getattr(self, 'validate_{0}'.format(field_type), None)
-        return validate_cb(field_def, form_values)
+        validate_cb = self.field_validators[field_name]
+        return validate_cb(self, field_def, form_values)
 
     def validate_string(self, field_def, form_values):
         """
@@ -270,3 +285,17 @@ class FormDefinition(object):
             raise ValidationError(msg)
 
         return value
+
+    # Map each field type to the method that validates it.
+    validators = {
+        'string': validate_string,
+        'integer': validate_integer,
+        'float': validate_float,
+        'date': validate_date,
+        'radio': validate_radio,
+        'select': validate_select,
+        'checkbox': validate_checkbox,
+        'text': validate_text,
+        'password': validate_password,
+        'file': validate_file,
+    }
@@ -97,9 +97,7 @@ class FormRender(object):
         Render a generic field to HTML.
         """
         params = self.cast_params(kwargs)
-        method_name = 'r_field_{0}'.format(field_type)
-        method = getattr(self, method_name, None)
-        field = method(**params)
+        field = self.field_renderers[field_type](self, **params)
 
         if 'required' in kwargs and kwargs['required'] is True:
             return HTML_REQUIRED.format(field)
@@ -211,6 +209,20 @@ class FormRender(object):
         return tpl.format(name=name, select_elems=''.join(select_elems),
                           classes=classes, style=style)
 
+    # Map each field type to the method that renders it.
+    field_renderers = {
+        "string": r_field_string,
+        "integer": r_field_integer,
+        "float": r_field_float,
+        "date": r_field_date,
+        "file": r_field_file,
+        "password": r_field_password,
+        "text": r_field_text,
+        "radio": r_field_radio,
+        "checkbox": r_field_checkbox,
+        "select": r_field_select,
+    }
+
     def r_form_line(self, field_type, title, h_input, classes, errors):
         """
         Render a line (label + input) to HTML.
@@ -0,0 +1,321 @@
+"""
+Run scripts in the background for forms with the `async` option, so that
+submitting such a form returns right away instead of keeping the connection
+and a server thread busy until the script exits.
+
+Jobs and their output are kept on disk, so that every forked worker process
+can show them, until they expire.
+"""
+
+import binascii
+import errno
+import json
+import logging
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+import time
+
+import metrics
+import runscript
+
+
+log = logging.getLogger('JOBS')
+
+JOBS_QUEUED = metrics.Gauge(
+    'scriptform_jobs_queued',
+    "Jobs waiting for a free job thread.")
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when a job is submitted while the job queue is full.
+    """
+    pass
+
+
+def process_alive(pid):
+    """
+    Return whether the process `pid` is still running.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class JobStore(object):
+    """
+    Jobs in `directory` (default: a new temporary directory, which is
+    removed by remove_all()). Each job is a directory named after its ID,
+    with a `job.json` holding its state and, once it's done, the `stdout` and
+    `stderr` of its script. Finished jobs are removed `ttl` seconds after
+    they finished.
+
+    A job's state is 'queued', 'running' or 'done'. A job that was queued or
+    running in a process that has since stopped is 'lost'.
+    """
+    def __init__(self, directory=None, ttl=24 * 3600):
+        self.temporary = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='scriptform_jobs_')
+        elif not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self.directory = directory
+        self.ttl = ttl
+        self.expired = 0
+
+    def create(self, form_def, username):
+        """
+        Create a queued job for the form `form_def`, submitted by `username`,
+        and return it.
+        """
+        self.expire()
+        job = {
+            'id': binascii.hexlify(os.urandom(16)),
+            'form_name': form_def.name,
+            'title': form_def.title,
+            'output': form_def.output,
+            'username': username,
+            'pid': os.getpid(),
+            'state': 'queued',
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'exitcode': None,
+        }
+        os.mkdir(self.path(job['id']), 0o700)
+        self.update(job)
+        return job
+
+    def get(self, job_id):
+        """
+        Return the job with `job_id`, or None if there's no such job. Jobs
+        that have expired are removed first, so that they're removed even if
+        no new jobs are submitted.
+        """
+        self.expire()
+        return self._load(job_id)
+
+    def _load(self, job_id):
+        """
+        Read the job with `job_id`, or return None if there's no such job.
+        """
+        if not self._is_id(job_id):
+            return None
+        try:
+            with open(self.path(job_id, 'job.json'), 'r') as fileobj:
+                job = json.load(fileobj)
+        except (IOError, ValueError):
+            return None
+        if job['state'] in ('queued', 'running') and \
+           not process_alive(job['pid']):
+            job['state'] = 'lost'
+        return job
+
+    def update(self, job):
+        """
+        Save the changed `job`. It's replaced at once, so that other
+        processes never see a half written job.
+        """
+        path = self.path(job['id'], 'job.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fileobj:
+            json.dump(job, fileobj)
+        os.rename(tmp_path, path)
+
+    def path(self, job_id, fname=None):
+        """
+        Return the path of the directory of the job `job_id`, or of the file
+        `fname` in it.
+        """
+        if fname is None:
+            return os.path.join(self.directory, job_id)
+        return os.path.join(self.directory, job_id, fname)
+
+    def expire(self):
+        """
+        Remove jobs that finished more than `ttl` seconds ago. This is done
+        at most once a minute.
+        """
+        now = time.time()
+        if now - self.expired < 60:
+            return
+        self.expired = now
+        for job_id in os.listdir(self.directory):
+            if not self._is_id(job_id):
+                continue
+            job = self._load(job_id)
+            if job is not None and job['state'] in ('queued', 'running'):
+                continue
+            try:
+                mtime = os.stat(self.path(job_id)).st_mtime
+                if job is not None:
+                    mtime = os.stat(self.path(job_id, 'job.json')).st_mtime
+            except OSError:
+                continue
+            if mtime + self.ttl < now:
+                shutil.rmtree(self.path(job_id), True)
+
+    def remove_all(self):
+        """
+        Remove the store's directory and all jobs in it, if it's a temporary
+        directory. Jobs that are still queued or running are left alone,
+        along with the directory.
+        """
+        if not self.temporary or not os.path.isdir(self.directory):
+            return
+        for job_id in os.listdir(self.directory):
+            job = self._load(job_id)
+            if job is not None and job['state'] in ('queued', 'running'):
+                continue
+            shutil.rmtree(self.path(job_id), True)
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+    def _is_id(self, job_id):
+        """
+        Return whether `job_id` looks like the ID of a job, so that it can
+        safely be used as a file name.
+        """
+        return len(job_id) == 32 and \
+            all(char in '0123456789abcdef' for char in job_id)
+
+
+class JobRunner(object):
+    """
+    Runs the scripts of jobs in the JobStore `store` with `threads` threads.
+    At most `queue_size` jobs wait for a free thread. Up to `capture_size`
+    bytes of a script's output are kept in memory before it's spooled to the
+    job's directory.
+
+    The threads are started when the first job is submitted, so that every
+    forked worker process starts its own.
+    """
+    def __init__(self, store, threads=2, queue_size=100,
+                 capture_size=1024 * 1024):
+        self.store = store
+        self.num_threads = threads
+        self.capture_size = capture_size
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def submit(self, form_def, form_values, username, uploads):
+        """
+        Queue a job that runs the script of `form_def` with the validated
+        `form_values` on behalf of `username`, and return it. The job takes
+        over the FormData `uploads`, whose temporary files are removed and
+        whose upload budget is released once the script has run. Raises
+        JobQueueFull (after doing so right away) if there's no room for
+        another job.
+        """
+        self.start()
+        job = self.store.create(form_def, username)
+        JOBS_QUEUED.inc()
+        try:
+            self.queue.put_nowait((job, form_def, form_values, uploads))
+        except Queue.Full:
+            JOBS_QUEUED.dec()
+            shutil.rmtree(self.store.path(job['id']), True)
+            uploads.cleanup()
+            uploads.release()
+            raise JobQueueFull()
+        return job
+
+    def start(self):
+        """
+        Start the threads, unless they're already running in this process.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.threads = []
+            for _ in xrange(self.num_threads):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Stop the threads. Jobs that are still queued are dropped and marked
+        as lost. Waits up to `timeout` seconds for running jobs to finish,
+        and returns whether they all did.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return True
+            self.pid = None
+            threads = self.threads
+            self.threads = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is None:
+                continue
+            JOBS_QUEUED.dec()
+            job, _, _, uploads = item
+            uploads.cleanup()
+            uploads.release()
+            job['state'] = 'lost'
+            self.store.update(job)
+        for _ in threads:
+            self.queue.put(None)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for thread in threads:
+            if timeout is None:
+                thread.join()
+            else:
+                thread.join(max(0, deadline - time.time()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def _work(self):
+        """
+        Main function of the job threads.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            JOBS_QUEUED.dec()
+            self.run_job(*item)
+
+    def run_job(self, job, form_def, form_values, uploads):
+        """
+        Run the script of `job` and save its output and exit code.
+        """
+        job['state'] = 'running'
+        job['started'] = time.time()
+        self.store.update(job)
+        job_dir = self.store.path(job['id'])
+        try:
+            result = runscript.run_script(form_def, form_values,
+                                          capture_size=self.capture_size,
+                                          spool_dir=job_dir)
+            for name in ('stdout', 'stderr'):
+                runscript.save_output(result[name],
+                                      self.store.path(job['id'], name))
+            job['exitcode'] = result['exitcode']
+        except Exception as err:
+            log.exception(err)
+            with open(self.store.path(job['id'], 'stderr'), 'wb') as fileobj:
+                fileobj.write('Internal error: {0}. Please see the log '
+                              'file.'.format(err))
+            job['exitcode'] = -1
+        finally:
+            uploads.cleanup()
+            uploads.release()
+            job['state'] = 'done'
+            job['finished'] = time.time()
+            self.store.update(job)
@@ -0,0 +1,295 @@
+"""
+A minimal LDAP client that can do nothing but check a user's password by
+binding as that user. Connections are kept open in a bounded pool, so that
+checking a password doesn't require a new connection every time.
+
+Only the few parts of BER (the encoding used by LDAP) that simple binds need
+are implemented.
+"""
+
+import Queue
+import socket
+import ssl
+import urlparse
+
+
+# BER tags.
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_ENUMERATED = 0x0a
+TAG_SEQUENCE = 0x30
+TAG_BIND_REQUEST = 0x60
+TAG_BIND_RESPONSE = 0x61
+TAG_UNBIND_REQUEST = 0x42
+TAG_AUTH_SIMPLE = 0x80
+
+# LDAP result codes.
+RESULT_SUCCESS = 0
+RESULT_INVALID_CREDENTIALS = 49
+
+
+class LDAPError(Exception):
+    """
+    Raised when the LDAP server can't be reached or doesn't answer as
+    expected.
+    """
+    pass
+
+
+class ConnectionClosed(LDAPError):
+    """
+    Raised when the LDAP server closed the connection.
+    """
+    pass
+
+
+def ber_length(length):
+    """
+    Return the BER encoding of the length of a value.
+    """
+    if length < 0x80:
+        return chr(length)
+    encoded = ''
+    while length:
+        encoded = chr(length & 0xff) + encoded
+        length >>= 8
+    return chr(0x80 | len(encoded)) + encoded
+
+
+def ber_encode(tag, value):
+    """
+    Return the BER encoding of the string `value` with `tag`.
+    """
+    return chr(tag) + ber_length(len(value)) + value
+
+
+def ber_encode_int(value, tag=TAG_INTEGER):
+    """
+    Return the BER encoding of the non-negative integer `value`.
+    """
+    encoded = chr(value & 0xff)
+    value >>= 8
+    while value:
+        encoded = chr(value & 0xff) + encoded
+        value >>= 8
+    if ord(encoded[0]) & 0x80:
+        # Keep it from being read as a negative number.
+        encoded = '\x00' + encoded
+    return ber_encode(tag, encoded)
+
+
+def ber_decode_int(value):
+    """
+    Return the integer encoded in the string `value`.
+    """
+    result = 0
+    for char in value:
+        result = (result << 8) | ord(char)
+    if value and ord(value[0]) & 0x80:
+        result -= 1 << (8 * len(value))
+    return result
+
+
+def ber_decode(data):
+    """
+    Return the values encoded one after the other in `data`, which is the
+    contents of a sequence, as a list of (tag, value) tuples.
+    """
+    values = []
+    pos = 0
+    while pos < len(data):
+        if pos + 2 > len(data):
+            raise LDAPError("Truncated BER value")
+        tag = ord(data[pos])
+        length = ord(data[pos + 1])
+        pos += 2
+        if length & 0x80:
+            num_octets = length & 0x7f
+            length = ber_decode_int('\x00' + data[pos:pos + num_octets])
+            pos += num_octets
+        if pos + length > len(data):
+            raise LDAPError("Truncated BER value")
+        values.append((tag, data[pos:pos + length]))
+        pos += length
+    return values
+
+
+def ber_read(fileobj, max_length=1024 * 1024):
+    """
+    Read a single BER encoded value from `fileobj` and return it as a (tag,
+    value) tuple.
+    """
+    header = fileobj.read(2)
+    if len(header) < 2:
+        raise ConnectionClosed("Connection closed by server")
+    tag = ord(header[0])
+    length = ord(header[1])
+    if length & 0x80:
+        num_octets = length & 0x7f
+        length_octets = fileobj.read(num_octets)
+        if len(length_octets) < num_octets:
+            raise ConnectionClosed("Connection closed by server")
+        length = ber_decode_int('\x00' + length_octets)
+    if length > max_length:
+        raise LDAPError("Response too large")
+    value = fileobj.read(length)
+    if len(value) < length:
+        raise ConnectionClosed("Connection closed by server")
+    return tag, value
+
+
+def escape_dn_value(value):
+    """
+    Escape the characters in `value` that have a special meaning in a
+    distinguished name (RFC 4514), so a username can be put into one.
+    """
+    escaped = []
+    for i, char in enumerate(value):
+        if char in ',+"\\<>;=' or \
+           (char == '#' and i == 0) or \
+           (char == ' ' and (i == 0 or i == len(value) - 1)):
+            escaped.append('\\' + char)
+        elif char == '\x00':
+            escaped.append('\\00')
+        else:
+            escaped.append(char)
+    return type(value)().join(escaped)
+
+
+class LDAPConnection(object):
+    """
+    A connection to the LDAP server at `host` and `port`, over SSL if
+    `use_ssl` is True. Network operations time out after `timeout` seconds.
+    """
+    def __init__(self, host, port, use_ssl=False, timeout=5.0):
+        sock = socket.create_connection((host, port), timeout)
+        if use_ssl:
+            if hasattr(ssl, 'create_default_context'):
+                context = ssl.create_default_context()
+                sock = context.wrap_socket(sock, server_hostname=host)
+            else:
+                sock = ssl.wrap_socket(sock)
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.message_id = 0
+
+    def bind(self, dn, password):
+        """
+        Bind as `dn` with `password`. Returns True if the password is
+        correct and False if it isn't. Other results raise an LDAPError.
+        """
+        self.message_id += 1
+        bind_request = ber_encode(
+            TAG_BIND_REQUEST,
+            ber_encode_int(3) +
+            ber_encode(TAG_OCTET_STRING, dn) +
+            ber_encode(TAG_AUTH_SIMPLE, password))
+        self.sock.sendall(ber_encode(
+            TAG_SEQUENCE, ber_encode_int(self.message_id) + bind_request))
+
+        tag, message = ber_read(self.rfile)
+        if tag != TAG_SEQUENCE:
+            raise LDAPError("Invalid response")
+        values = ber_decode(message)
+        if len(values) < 2 or values[0][0] != TAG_INTEGER or \
+           ber_decode_int(values[0][1]) != self.message_id or \
+           values[1][0] != TAG_BIND_RESPONSE:
+            raise LDAPError("Unexpected response")
+        result = ber_decode(values[1][1])
+        if not result or result[0][0] != TAG_ENUMERATED:
+            raise LDAPError("Invalid bind response")
+        result_code = ber_decode_int(result[0][1])
+        if result_code == RESULT_SUCCESS:
+            return True
+        if result_code == RESULT_INVALID_CREDENTIALS:
+            return False
+        message = ''
+        if len(result) > 2:
+            message = result[2][1]
+        raise LDAPError("Bind failed with result {0}: {1}".format(
+            result_code, message))
+
+    def close(self):
+        """
+        Unbind and close the connection.
+        """
+        try:
+            self.message_id += 1
+            self.sock.sendall(ber_encode(
+                TAG_SEQUENCE,
+                ber_encode_int(self.message_id) +
+                ber_encode(TAG_UNBIND_REQUEST, '')))
+        except socket.error:
+            pass
+        self.rfile.close()
+        self.sock.close()
+
+
+class LDAPConnectionPool(object):
+    """
+    Keeps at most `size` connections to the LDAP server at `url` (e.g.
+    'ldap://ldap.example.com' or 'ldaps://ldap.example.com:636') open. When
+    all of them are in use, callers wait up to `timeout` seconds for one to
+    become available. Connections are only opened when they're needed.
+    """
+    def __init__(self, url, size=4, timeout=5.0):
+        url_comp = urlparse.urlsplit(url)
+        if url_comp.scheme not in ('ldap', 'ldaps') or not url_comp.hostname:
+            raise ValueError("Invalid LDAP URL: {0}".format(url))
+        self.use_ssl = url_comp.scheme == 'ldaps'
+        self.host = url_comp.hostname
+        self.port = url_comp.port or (636 if self.use_ssl else 389)
+        self.timeout = timeout
+        # The most recently used connections are taken first, since they're
+        # least likely to have been closed by the server. None stands for a
+        # connection that hasn't been opened yet.
+        self.connections = Queue.LifoQueue()
+        for _ in xrange(size):
+            self.connections.put(None)
+
+    def bind(self, dn, password):
+        """
+        Bind as `dn` with `password` on one of the pooled connections, and
+        return whether the password is correct. If a pooled connection turns
+        out to have been closed, it's retried once on a new connection.
+        """
+        try:
+            conn = self.connections.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise LDAPError("No LDAP connection available")
+        try:
+            if conn is not None:
+                try:
+                    return conn.bind(dn, password)
+                except (socket.error, ConnectionClosed):
+                    # The server may have closed the idle connection.
+                    conn.close()
+                    conn = None
+            conn = LDAPConnection(self.host, self.port, self.use_ssl,
+                                  self.timeout)
+            return conn.bind(dn, password)
+        except (socket.error, LDAPError) as err:
+            # Don't reuse a connection in an unknown state.
+            if conn is not None:
+                conn.close()
+                conn = None
+            if isinstance(err, LDAPError):
+                raise
+            raise LDAPError(str(err))
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        conns = []
+        while True:
+            try:
+                conns.append(self.connections.get_nowait())
+            except Queue.Empty:
+                break
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+            self.connections.put(None)
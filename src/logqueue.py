@@ -0,0 +1,123 @@
+"""
+Logging handler which writes log records to a file from a background thread,
+so that logging threads never wait for disk I/O.
+"""
+
+import logging
+import os
+import Queue
+import threading
+
+
+class QueueFileHandler(logging.Handler):
+    """
+    Logging handler that appends records to `filename` from a separate writer
+    thread. Logging threads only format the record and put it on a queue of at
+    most `queue_size` records. If the queue is full, the record is dropped and
+    counted in `dropped`. The writer collects up to `batch_size` queued records
+    and appends them to the file with a single write.
+
+    The writer thread is started on first use in each process, so the handler
+    keeps working in forked processes. Starting it and counting dropped
+    records is guarded by the handler's lock, since records may be emitted
+    from several threads at once.
+    """
+    def __init__(self, filename, queue_size=10000, batch_size=100):
+        logging.Handler.__init__(self)
+        self.filename = filename
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.reported = 0
+        self.queue = None
+        self.writer = None
+        self.writer_pid = None
+        self.fdescriptor = os.open(filename,
+                                   os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                   0644)
+
+    def emit(self, record):
+        """
+        Queue the formatted record for the writer thread.
+        """
+        if self.writer_pid != os.getpid():
+            with self.lock:
+                if self.writer_pid != os.getpid():
+                    self._start_writer()
+        try:
+            msg = self.format(record)
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf8')
+            self.queue.put_nowait(msg)
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """
+        Write the records that are still queued and close the file.
+        """
+        if self.writer_pid == os.getpid():
+            self.queue.put(None)
+            self.writer.join(5)
+            self.writer_pid = None
+        if self.fdescriptor is not None:
+            os.close(self.fdescriptor)
+            self.fdescriptor = None
+        logging.Handler.close(self)
+
+    def _start_writer(self):
+        """
+        Start the writer thread for this process. Records queued before a fork
+        are written by the parent, so the child starts with an empty queue.
+        """
+        self.queue = Queue.Queue(self.queue_size)
+        self.writer = threading.Thread(target=self._write_loop,
+                                       args=(self.queue, ))
+        self.writer.daemon = True
+        self.writer.start()
+        self.writer_pid = os.getpid()
+
+    def _write_loop(self, queue):
+        """
+        Main loop of the writer thread. Waits for records and writes all of
+        those that are queued at that point at once, until it encounters the
+        None sentinel.
+        """
+        while True:
+            lines = [queue.get()]
+            try:
+                while len(lines) < self.batch_size:
+                    lines.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            stop = None in lines
+            lines = [line for line in lines if line is not None]
+            dropped = self.dropped
+            if dropped != self.reported:
+                record = logging.LogRecord(
+                    'LOGQUEUE', logging.WARNING, __file__, 0,
+                    "Log queue full. Dropped {0} log records".format(
+                        dropped - self.reported),
+                    None, None)
+                lines.append(self.format(record))
+                self.reported = dropped
+            if lines:
+                self._write('\n'.join(lines) + '\n')
+            if stop:
+                break
+
+    def _write(self, data):
+        """
+        Write `data` to the file, retrying partial writes.
+        """
+        try:
+            while data:
+                written = os.write(self.fdescriptor, data)
+                data = data[written:]
+        except OSError:
+            # There's nobody to report this to but the log itself.
+            pass
@@ -0,0 +1,194 @@
+"""
+Collect metrics about the running server and expose them in the Prometheus
+text format.
+"""
+
+import threading
+
+
+# Default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+def format_value(value):
+    """
+    Format a sample value or bucket bound.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names, values):
+    """
+    Format label names and their values as '{name="value",...}'.
+    """
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = unicode(value).encode('utf8')
+        value = value.replace('\\', '\\\\').replace('\n', '\\n')
+        value = value.replace('"', '\\"')
+        pairs.append('{0}="{1}"'.format(name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Registry(object):
+    """
+    A collection of metrics that can be exposed together.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """
+        Add `metric` to the registry.
+        """
+        self.metrics.append(metric)
+
+    def expose(self):
+        """
+        Return all metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+# The registry that metrics are added to unless told otherwise.
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """
+    Base class for metrics. A metric holds a value for each combination of
+    values of its `labels`. Label values are passed as a tuple in the same
+    order as `labels`.
+    """
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def expose(self):
+        """
+        Return the lines describing this metric in the Prometheus text
+        format.
+        """
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help_text),
+            '# TYPE {0} {1}'.format(self.name, self.kind),
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        if not values and not self.labels:
+            values = [((), 0)]
+        for label_values, value in values:
+            lines.append('{0}{1} {2}'.format(
+                self.name,
+                format_labels(self.labels, label_values),
+                format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, such as the number of handled requests.
+    """
+    kind = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        """
+        Increase the counter by `amount`.
+        """
+        with self.lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, such as the number of running scripts.
+    """
+    kind = 'gauge'
+
+    def inc(self, label_values=(), amount=1):
+        """
+        Increase the gauge by `amount`.
+        """
+        with self.lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+    def dec(self, label_values=(), amount=1):
+        """
+        Decrease the gauge by `amount`.
+        """
+        self.inc(label_values, -amount)
+
+
+class Histogram(Metric):
+    """
+    Counts observed values, such as durations, in cumulative buckets with the
+    upper bounds `buckets`, and keeps track of their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        Metric.__init__(self, name, help_text, labels, registry)
+        self.buckets = tuple(buckets) + (float('inf'), )
+
+    def observe(self, value, label_values=()):
+        """
+        Record the observed `value`.
+        """
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = sample = self.values[label_values]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            sample[1] += value
+            sample[2] += 1
+
+    def expose(self):
+        """
+        Return the lines describing this histogram in the Prometheus text
+        format.
+        """
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help_text),
+            '# TYPE {0} {1}'.format(self.name, self.kind),
+        ]
+        with self.lock:
+            values = sorted((label_values, (list(counts), total, count))
+                            for label_values, (counts, total, count)
+                            in self.values.items())
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name,
+                    format_labels(self.labels + ('le', ),
+                                  label_values + (format_value(bound), )),
+                    cumulative))
+            labels = format_labels(self.labels, label_values)
+            lines.append('{0}_sum{1} {2}'.format(self.name, labels,
+                                                 format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, labels, count))
+        return lines
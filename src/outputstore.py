@@ -0,0 +1,110 @@
+"""
+Keep script output that was too large to show on the result page, so that
+the user can download it in its entirety.
+"""
+
+import binascii
+import hashlib
+import hmac
+import os
+import shutil
+import tempfile
+import time
+
+from auth import compare_digest
+
+
+class OutputStore(object):
+    """
+    Files with script output in `directory` (default: a new temporary
+    directory), which users can download for `ttl` seconds after their
+    script finished.
+
+    A file is identified by a random token and an HMAC of that token and the
+    user that ran the script, so that only they can download it. Apart from
+    the files themselves, the store has no state. Forked worker processes
+    that share the directory and `key` can all serve every file.
+    """
+    def __init__(self, directory=None, ttl=3600, key=None):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='scriptform_outputs_')
+        self.directory = directory
+        self.ttl = ttl
+        if key is None:
+            key = os.urandom(32)
+        self.key = key
+        self.expired = 0
+
+    def add(self, path, username):
+        """
+        Move the file at `path` into the store and return the ID with which
+        `username` can get it. It must be on the same file system as the
+        store's directory.
+        """
+        self.expire()
+        token = binascii.hexlify(os.urandom(16))
+        dest_path = os.path.join(self.directory, token)
+        os.rename(path, dest_path)
+        # Expiry counts from now.
+        os.utime(dest_path, None)
+        return '{0}-{1}'.format(token, self._mac(token, username))
+
+    def get(self, output_id, username):
+        """
+        Return the path of the file with `output_id` if `username` may
+        download it, or None if they may not or it's expired.
+        """
+        token, _, mac = output_id.partition('-')
+        if not self._is_token(token) or \
+           not compare_digest(self._mac(token, username), mac):
+            return None
+        path = os.path.join(self.directory, token)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if mtime + self.ttl < time.time():
+            return None
+        return path
+
+    def expire(self):
+        """
+        Remove files that have expired. This is done at most once a minute.
+        """
+        now = time.time()
+        if now - self.expired < 60:
+            return
+        self.expired = now
+        for fname in os.listdir(self.directory):
+            # Leave spool files of scripts that are still running alone.
+            if not self._is_token(fname):
+                continue
+            path = os.path.join(self.directory, fname)
+            try:
+                if os.stat(path).st_mtime + self.ttl < now:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def remove_all(self):
+        """
+        Remove the store's directory and all files in it.
+        """
+        shutil.rmtree(self.directory, True)
+
+    def _is_token(self, token):
+        """
+        Return whether `token` looks like a token created by add(), so that
+        it can safely be used as a file name.
+        """
+        return len(token) == 32 and \
+            all(char in '0123456789abcdef' for char in token)
+
+    def _mac(self, token, username):
+        """
+        Return the HMAC of `token` and `username` as a hex string.
+        """
+        if isinstance(username, unicode):
+            username = username.encode('utf8')
+        msg = '{0}:{1}'.format(token, username or '')
+        return hmac.new(self.key, msg, hashlib.sha256).hexdigest()[:32]
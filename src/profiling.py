@@ -0,0 +1,154 @@
+"""
+Profile request handling in a running server, per route and form. Results are
+written as pstats files or as collapsed stacks, which can be turned into flame
+graphs.
+"""
+
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sys
+import thread
+import threading
+import time
+
+
+class Profiler(object):
+    """
+    Profiles the handling of requests while it's enabled. Requests are grouped
+    by a key, such as their route. Results are written to `output_dir` when
+    the profiler is stopped.
+
+    In 'sample' mode, the stacks of threads handling a request are sampled
+    every `interval` seconds. This has little overhead and results in
+    '.collapsed' files with one stack per line, followed by the number of
+    times it was seen. In 'cprofile' mode, every function call is measured
+    with cProfile, which results in '.pstats' files.
+    """
+    def __init__(self, output_dir, mode='sample', interval=0.005):
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError("Unknown profile mode: {0}".format(mode))
+        self.output_dir = output_dir
+        self.mode = mode
+        self.interval = interval
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.stacks = {}
+        self.active = {}
+        self.log = logging.getLogger('PROFILER')
+
+    def start(self):
+        """
+        Start profiling requests.
+        """
+        if self.enabled:
+            return
+        self.log.info("Profiling requests ({0})".format(self.mode))
+        self.enabled = True
+        if self.mode == 'sample':
+            sampler = threading.Thread(target=self._sample_loop)
+            sampler.daemon = True
+            sampler.start()
+
+    def stop(self):
+        """
+        Stop profiling and write the results collected so far.
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.dump()
+
+    def toggle(self):
+        """
+        Start profiling if it's stopped, and vice versa.
+        """
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    @contextlib.contextmanager
+    def profile(self, key):
+        """
+        Profile the code in the with block as part of the results for `key`.
+        """
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                with self.lock:
+                    if key in self.stats:
+                        self.stats[key].add(profile)
+                    else:
+                        self.stats[key] = pstats.Stats(profile)
+        else:
+            ident = thread.get_ident()
+            self.active[ident] = key
+            try:
+                yield
+            finally:
+                self.active.pop(ident, None)
+
+    def dump(self):
+        """
+        Write the results for each key to a file in the output dir, and
+        start collecting new results. Returns the paths of the written files.
+        """
+        with self.lock:
+            stats, self.stats = self.stats, {}
+            stacks, self.stacks = self.stacks, {}
+
+        paths = []
+        for key, key_stats in stats.items():
+            path = self._path(key, 'pstats')
+            key_stats.dump_stats(path)
+            paths.append(path)
+        for key, counts in stacks.items():
+            path = self._path(key, 'collapsed')
+            with open(path, 'w') as collapsed:
+                for stack, count in sorted(counts.items()):
+                    collapsed.write('{0} {1}\n'.format(stack, count))
+            paths.append(path)
+        for path in paths:
+            self.log.info("Wrote profile {0}".format(path))
+        return paths
+
+    def _path(self, key, extension):
+        """
+        Return the path of the results file for `key`. Results of different
+        processes are written to different files.
+        """
+        key = re.sub(r'[^A-Za-z0-9_.-]+', '_', key).strip('_') or 'index'
+        fname = 'scriptform.{0}.{1}.{2}'.format(os.getpid(), key, extension)
+        return os.path.join(self.output_dir, fname)
+
+    def _sample_loop(self):
+        """
+        Main loop of the sampler thread. Records the stack of every thread
+        that's handling a request, until the profiler is stopped.
+        """
+        while self.enabled:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident, key in self.active.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{0}:{1}'.format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack = ';'.join(reversed(stack))
+                with self.lock:
+                    counts = self.stacks.setdefault(key, {})
+                    counts[stack] = counts.get(stack, 0) + 1
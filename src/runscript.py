@@ -4,14 +4,164 @@ their output.
 """
 
 import logging
+import errno
+import sys
 import os
 import pwd
 import grp
+import select
 import subprocess
+import tempfile
+import time
+
+import metrics
+from watchdog import WATCHDOG
 
 
 log = logging.getLogger('RUNSCRIPT')
 
+# Form values are passed to scripts in their environment. Linux refuses to
+# start a program with an environment variable ("NAME=value") larger than
+# 128 KiB, so values may be at most this large, leaving room for the name.
+MAX_VALUE_SIZE = 127 * 1024
+
+SCRIPT_DURATION = metrics.Histogram(
+    'scriptform_script_duration_seconds',
+    "Time taken by scripts to run, by form.",
+    ('form', ),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0,
+             900.0, 3600.0))
+SCRIPT_EXITS = metrics.Counter(
+    'scriptform_script_exits_total',
+    "Scripts that finished, by form and exit code.",
+    ('form', 'exitcode'))
+SCRIPTS_RUNNING = metrics.Gauge(
+    'scriptform_scripts_running',
+    "Scripts (child processes) currently running.")
+
+
+class CapturedOutput(object):
+    """
+    Output of a script, kept in memory up to `max_memory` bytes. If there's
+    more, all of it is spooled to a temporary file in `spool_dir` (default:
+    the system's temporary dir) instead, so that scripts with huge output
+    don't use up the server's memory. `max_memory` None means no limit.
+    """
+    def __init__(self, max_memory=None, spool_dir=None):
+        self.max_memory = max_memory
+        self.spool_dir = spool_dir
+        self.size = 0
+        self.buf = []
+        self.path = None
+        self.fileobj = None
+
+    def write(self, data):
+        """
+        Add `data` to the output.
+        """
+        self.size += len(data)
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+            return
+        self.buf.append(data)
+        if self.max_memory is not None and self.size > self.max_memory:
+            fdescriptor, self.path = tempfile.mkstemp(
+                prefix='scriptform_output_', dir=self.spool_dir)
+            self.fileobj = os.fdopen(fdescriptor, 'w+b')
+            self.fileobj.write(''.join(self.buf))
+            self.buf = []
+
+    def spooled(self):
+        """
+        Return whether the output was spooled to a file.
+        """
+        return self.path is not None
+
+    def getvalue(self):
+        """
+        Return the complete output. Only use this if it wasn't spooled.
+        """
+        if self.fileobj is not None:
+            self.fileobj.seek(0)
+            return self.fileobj.read()
+        return ''.join(self.buf)
+
+    def head(self, size):
+        """
+        Return the first `size` bytes of the output.
+        """
+        if self.fileobj is None:
+            return self.getvalue()[:size]
+        self.fileobj.seek(0)
+        return self.fileobj.read(size)
+
+    def tail(self, size):
+        """
+        Return the last `size` bytes of the output.
+        """
+        if self.fileobj is None:
+            return self.getvalue()[-size:]
+        self.fileobj.seek(max(0, self.size - size))
+        return self.fileobj.read(size)
+
+    def close(self):
+        """
+        Close the spool file, if any. The file itself is kept.
+        """
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+    def detach(self):
+        """
+        Close the spool file and return its path. It's then up to the caller
+        to remove it; cleanup() leaves it alone.
+        """
+        self.close()
+        path, self.path = self.path, None
+        return path
+
+    def cleanup(self):
+        """
+        Close and remove the spool file, if any.
+        """
+        self.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.path = None
+
+
+def load_output(path, max_memory=None):
+    """
+    Return a CapturedOutput for the output saved in the file at `path`. It's
+    read into memory if it's at most `max_memory` bytes. Otherwise it's read
+    from the file as needed. close() it when done, but don't cleanup() it,
+    which would remove the file.
+    """
+    captured = CapturedOutput(max_memory)
+    fileobj = open(path, 'rb')
+    captured.size = os.fstat(fileobj.fileno()).st_size
+    if max_memory is not None and captured.size > max_memory:
+        captured.path = path
+        captured.fileobj = fileobj
+    else:
+        captured.buf = [fileobj.read()]
+        fileobj.close()
+    return captured
+
+
+def save_output(captured, path):
+    """
+    Save the CapturedOutput `captured` to the file at `path`, which must be
+    on the same file system as its spool file, if any. This cleans it up.
+    """
+    if captured.spooled():
+        os.rename(captured.detach(), path)
+    else:
+        with open(path, 'wb') as fileobj:
+            fileobj.write(captured.getvalue())
+        captured.cleanup()
+
 
 def run_as(uid, gid, groups):
     """Closure that changes the current running user and groups. Called before
@@ -24,7 +174,8 @@ def run_as(uid, gid, groups):
     return set_acc
 
 
-def run_script(form_def, form_values, stdout=None, stderr=None):
+def run_script(form_def, form_values, stdout=None, stderr=None, timer=None,
+               on_stdout=None, capture_size=None, spool_dir=None):
     """
     Perform a callback for the form `form_def`. This calls a script.
     `form_values` is a dictionary of validated values as returned by
@@ -32,6 +183,18 @@ def run_script(form_def, form_values, stdout=None, stderr=None):
     and `stderr` have to be open filehandles where the output of the
     callback should be written. The output of the script is hooked up to
     the output, depending on the output type.
+
+    For other output types, if `on_stdout` is given, it's called with each
+    piece of the script's stdout as soon as the script writes it, instead of
+    returning all of it once the script exits.
+
+    If `capture_size` is given, the result's 'stdout' and 'stderr' are
+    CapturedOutput instances, which spool output beyond `capture_size`
+    bytes to a file in `spool_dir`. The caller must clean them up.
+    Otherwise they're strings.
+
+    If a timing.Timer is given as `timer`, starting the script and running
+    it are recorded as the 'spawn' and 'script' phases.
     """
     # Validate params
     if form_def.output == 'raw' and (stdout is None or stderr is None):
@@ -69,6 +232,27 @@ def run_script(form_def, form_values, stdout=None, stderr=None):
             log.critical("Not running as root, so we can't run the "
                          "script as user '{0}'".format(form_def.run_as))
 
+    start = time.time()
+    SCRIPTS_RUNNING.inc()
+    try:
+        result = _run(form_def, env, run_as_fn, stdout, stderr, timer,
+                      on_stdout, capture_size, spool_dir)
+    finally:
+        SCRIPTS_RUNNING.dec()
+    if form_def.output == 'raw':
+        exitcode = result
+    else:
+        exitcode = result['exitcode']
+    SCRIPT_DURATION.observe(time.time() - start, (form_def.name, ))
+    SCRIPT_EXITS.inc((form_def.name, str(exitcode)))
+    return result
+
+
+def _run(form_def, env, run_as_fn, stdout, stderr, timer, on_stdout,
+         capture_size, spool_dir):
+    """
+    Start the script and wait for it to finish. See run_script().
+    """
     # If the form output type is 'raw', we directly stream the output to
     # the browser. Otherwise we store it for later displaying.
     if form_def.output == 'raw':
@@ -80,7 +264,12 @@ def run_script(form_def, form_values, stdout=None, stderr=None):
                                     env=env,
                                     close_fds=True,
                                     preexec_fn=run_as_fn)
+            WATCHDOG.set_child_pid(proc.pid)
+            if timer is not None:
+                timer.lap('spawn')
             stdout, stderr = proc.communicate(input)
+            if timer is not None:
+                timer.lap('script')
             log.info("Exit code: {0}".format(proc.returncode))
             return proc.returncode
         except OSError as err:
@@ -97,7 +286,30 @@ def run_script(form_def, form_values, stdout=None, stderr=None):
                                     env=env,
                                     close_fds=True,
                                     preexec_fn=run_as_fn)
-            stdout, stderr = proc.communicate()
+            WATCHDOG.set_child_pid(proc.pid)
+            if timer is not None:
+                timer.lap('spawn')
+            if on_stdout is None and capture_size is None:
+                stdout, stderr = proc.communicate()
+            else:
+                proc.stdin.close()
+                stdout = CapturedOutput(capture_size, spool_dir)
+                stderr = CapturedOutput(capture_size, spool_dir)
+                try:
+                    _read_output(proc, on_stdout or stdout.write,
+                                 stderr.write)
+                except Exception:
+                    stdout.cleanup()
+                    stderr.cleanup()
+                    raise
+                finally:
+                    # Don't leave a zombie behind, even if reading failed.
+                    proc.wait()
+                if capture_size is None:
+                    stdout = stdout.getvalue()
+                    stderr = stderr.getvalue()
+            if timer is not None:
+                timer.lap('script')
             log.info("Exit code: {0}".format(proc.returncode))
             return {
                 'stdout': stdout,
@@ -106,9 +318,60 @@ def run_script(form_def, form_values, stdout=None, stderr=None):
             }
         except OSError as err:
             log.exception(err)
+            stdout = ''
+            stderr = 'Internal error: {0}. Please see the log ' \
+                     'file.'.format(str(err))
+            if capture_size is not None:
+                stdout = CapturedOutput()
+                captured_stderr = CapturedOutput()
+                captured_stderr.write(stderr)
+                stderr = captured_stderr
             return {
-                'stdout': '',
-                'stderr': 'Internal error: {0}. Please see the log '
-                          'file.'.format(str(err)),
+                'stdout': stdout,
+                'stderr': stderr,
                 'exitcode': -1
             }
+
+
+def _read_output(proc, on_stdout, on_stderr, chunk_size=64 * 1024):
+    """
+    Read the output of `proc` until it closes its stdout and stderr. Pieces
+    of output are passed to `on_stdout` and `on_stderr` as they come in.
+
+    If `on_stdout` raises an exception, the rest of stdout is read and
+    discarded, so that the script doesn't block on a full pipe, and the
+    exception is raised once the script has closed its output. The pipes
+    are closed in any case.
+    """
+    stdout_fd = proc.stdout.fileno()
+    stderr_fd = proc.stderr.fileno()
+    poller = select.poll()
+    poller.register(stdout_fd, select.POLLIN)
+    poller.register(stderr_fd, select.POLLIN)
+    open_fds = set((stdout_fd, stderr_fd))
+    error = None
+    try:
+        while open_fds:
+            try:
+                events = poller.poll()
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fdescriptor, _ in events:
+                data = os.read(fdescriptor, chunk_size)
+                if not data:
+                    poller.unregister(fdescriptor)
+                    open_fds.discard(fdescriptor)
+                elif fdescriptor == stderr_fd:
+                    on_stderr(data)
+                elif error is None:
+                    try:
+                        on_stdout(data)
+                    except Exception:
+                        error = sys.exc_info()
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+    if error is not None:
+        raise error[0], error[1], error[2]
@@ -43,12 +43,26 @@ import logging
 import thread
 import hashlib
 import socket
+import signal
+import tempfile
+import itertools
 
-from daemon import Daemon
+from daemon import Daemon, Supervisor
 from formdefinition import FormDefinition
 from formconfig import FormConfig
-from webserver import ThreadedHTTPServer
+from webserver import ThreadedHTTPServer, ThreadPoolHTTPServer, \
+    EventHTTPServer
 from webapp import ScriptFormWebApp
+from formdata import UploadBudget
+from filecache import FileCache
+from auth import CredentialCache, SessionSigner, hash_password
+from authbackends import UsersBackend, get_auth_backend
+from outputstore import OutputStore
+from jobs import JobRunner, JobStore
+from profiling import Profiler
+import runscript
+import timing
+from watchdog import WATCHDOG
 
 
 class ScriptFormError(Exception):
@@ -58,6 +72,10 @@ class ScriptFormError(Exception):
     pass
 
 
+# Generations of form configurations. Unique across ScriptForm instances.
+GENERATIONS = itertools.count(1)
+
+
 class ScriptForm(object):
     """
     'Main' class that orchestrates parsing the Form configurations and running
@@ -68,9 +86,18 @@ class ScriptForm(object):
         self.cache = cache
         self.log = logging.getLogger('SCRIPTFORM')
         self.form_config_singleton = None
+        self.config_source = None
+        self.config_generation = None
+        self.config_fingerprint = None
+        self.auth_config = None
+        self.auth_backend = None
         self.websrv = None
         self.running = False
         self.httpd = None
+        self.supervisor = None
+        self.profiler = None
+        self.profile = False
+        self.slow_request = None
 
         # Init form config so it can raise errors about problems.
         self.get_form_config()
@@ -84,19 +111,32 @@ class ScriptForm(object):
         if self.cache and self.form_config_singleton is not None:
             return self.form_config_singleton
 
-        config = json.load(file(self.config_file, 'r'))
+        config_source = file(self.config_file, 'r').read()
+        config = json.loads(config_source)
 
         static_dir = None
         custom_css = None
         users = None
+        auth_backend = None
+        metrics_users = None
         forms = []
 
         if 'static_dir' in config:
             static_dir = config['static_dir']
         if 'custom_css' in config:
             custom_css = file(config['custom_css'], 'r').read()
+            config_source += custom_css
         if 'users' in config:
             users = config['users']
+            if users:
+                auth_backend = UsersBackend(users)
+        if 'auth' in config:
+            if users is not None:
+                raise ScriptFormError("Form config can't have both 'users' "
+                                      "and 'auth'")
+            auth_backend = self.get_auth_backend(config['auth'])
+        if 'metrics_users' in config:
+            metrics_users = config['metrics_users']
         for form in config['forms']:
             form_name = form['name']
             if not form['script'].startswith('/'):
@@ -116,34 +156,301 @@ class ScriptForm(object):
                                hidden=form.get('hidden', False),
                                submit_title=form.get('submit_title', 'Submit'),
                                allowed_users=form.get('allowed_users', None),
-                               run_as=form.get('run_as', None))
+                               run_as=form.get('run_as', None),
+                               max_upload_size=form.get('max_upload_size',
+                                                        None),
+                               stream=form.get('stream', False),
+                               run_async=form.get('async', False))
             )
 
+        # Only start a new generation if the configuration actually changed,
+        # so that reloading it doesn't invalidate everything cached for it.
+        if config_source != self.config_source:
+            self.config_source = config_source
+            self.config_generation = next(GENERATIONS)
+            self.config_fingerprint = hashlib.sha256(
+                config_source).hexdigest()
+
         form_config = FormConfig(
             config['title'],
             forms,
             users,
             static_dir,
-            custom_css
+            custom_css,
+            metrics_users,
+            self.config_generation,
+            self.config_fingerprint,
+            auth_backend
         )
         self.form_config_singleton = form_config
         return form_config
 
-    def run(self, listen_addr='0.0.0.0', listen_port=80):
+    def get_auth_backend(self, auth_config):
+        """
+        Return the authentication backend for the `auth` section
+        `auth_config` of the form config. Backends keep state, such as
+        connections and cached results, so the same backend is returned for
+        as long as its configuration doesn't change.
+        """
+        if self.auth_backend is None or auth_config != self.auth_config:
+            self.auth_backend = get_auth_backend(auth_config)
+            self.auth_config = auth_config
+        return self.auth_backend
+
+    def run(self, listen_addr='0.0.0.0', listen_port=80, threads=None,
+            queue_size=50, keepalive=None, engine='threads', workers=None,
+            max_field_size=64 * 1024, max_spill_size=runscript.MAX_VALUE_SIZE,
+            upload_chunk_size=64 * 1024,
+            upload_budget=None, compress_min_size=1024, metrics=False,
+            server_timing=False, trace_file=None, profile=False,
+            profile_dir=None, profile_mode='sample', slow_request=None,
+            static_cache_size=8 * 1024 * 1024, auth_cache_ttl=300,
+            session_ttl=None, secure_cookies=False, capture_size=1024 * 1024,
+            preview_size=64 * 1024, job_threads=2, job_queue_size=100,
+            job_dir=None, job_ttl=24 * 3600):
         """
         Start the webserver on address `listen_addr` and port `listen_port`.
         This call is blocking until the user hits Ctrl-c, the shutdown() method
         is called or something like SystemExit is raised in a handler.
+
+        If `threads` is given, requests are handled by a pool of that many
+        worker threads, with at most `queue_size` connections waiting for a
+        free worker. Otherwise a new thread is started for every request.
+
+        If `keepalive` is given, HTTP/1.1 persistent connections are enabled.
+        Connections that stay idle for more than `keepalive` seconds are
+        closed.
+
+        `engine` determines how connections are handled. With 'threads', each
+        connection is handled by its own thread (or a worker from the pool)
+        for as long as it's open. With 'events', connections that are
+        waiting for a request are kept in a single poll loop and are only
+        handed to one of the `threads` (default 10) workers when a request
+        comes in. Connections that stay idle, or stall halfway through a
+        request, for `keepalive` seconds (default 15) are closed.
+
+        If `workers` is given, the listening socket is shared by that many
+        forked worker processes, which are restarted if they exit.
+
+        Submitted form fields are kept in memory up to `max_field_size`
+        bytes. Larger fields are spilled to a temp file while the request is
+        received, up to `max_spill_size` bytes. If that's None, they're
+        rejected instead. Since field values are passed to scripts in their
+        environment, both are capped at runscript.MAX_VALUE_SIZE, and larger
+        fields are always rejected. Uploaded files are written straight to disk
+        in chunks of `upload_chunk_size` bytes. If `upload_budget` is given,
+        form submissions whose bodies are being received or whose uploads are
+        still on disk may add up to at most that many bytes.
+
+        Pages of at least `compress_min_size` bytes are compressed with gzip
+        or deflate if the browser supports it. If it's None, responses are
+        never compressed.
+
+        If `metrics` is True, metrics about requests and scripts are served
+        at /metrics.
+
+        If `server_timing` is True, responses include a Server-Timing header
+        which reports how long each phase of the request took. If
+        `trace_file` is given, the phases of every request are appended to it
+        as JSON lines.
+
+        If `profile` is True, the handling of requests is profiled from the
+        start. Otherwise profiling can be started and stopped with
+        toggle_profiling(). `profile_mode` is 'sample' to periodically
+        sample the stacks of requests, or 'cprofile' to measure every
+        function call. The results are written per route and form to
+        `profile_dir` (default: the system's temporary dir) when profiling
+        stops.
+
+        If `slow_request` is given, requests that take longer than that many
+        seconds are logged along with their stack and the PID of their
+        script, if any.
+
+        Small static files are kept in memory, up to `static_cache_size`
+        bytes in total. If it's 0, static files are always read from disk.
+
+        Credentials of users who logged in successfully are remembered for
+        `auth_cache_ttl` seconds, so their password hash doesn't have to be
+        verified for every request. If it's 0, it's verified every time.
+
+        If `session_ttl` is given, browsers are asked to log in with a login
+        form instead of HTTP basic authentication. Users that log in stay
+        logged in for `session_ttl` seconds with a signed session cookie.
+        If `secure_cookies` is True, the cookie is always marked `Secure`, so
+        that browsers only send it over HTTPS. Otherwise it's only marked so
+        when a proxy says the login form was used over HTTPS.
+
+        Up to `capture_size` bytes of a script's output are kept in memory.
+        Larger output is spooled to disk, and only its first and last
+        `preview_size` bytes are shown. The user can download all of it for
+        an hour after the script finished. `capture_size` can't be None,
+        since the output always has to be captured.
+
+        The scripts of forms with the `async` option are run as background
+        jobs by `job_threads` threads (per worker), with at most
+        `job_queue_size` jobs waiting to run. Jobs and their output are kept
+        in `job_dir` (default: a temporary dir that's removed on shutdown)
+        for `job_ttl` seconds after they finish.
         """
+        if not capture_size:
+            raise ScriptFormError("capture_size must be a positive number "
+                                  "of bytes")
         ScriptFormWebApp.scriptform = self
-        self.httpd = ThreadedHTTPServer((listen_addr, listen_port),
-                                        ScriptFormWebApp)
-        self.httpd.daemon_threads = True
+        ScriptFormWebApp.get_routes()
+        ScriptFormWebApp.max_field_size = min(max_field_size,
+                                              runscript.MAX_VALUE_SIZE)
+        if max_spill_size is not None:
+            max_spill_size = min(max_spill_size, runscript.MAX_VALUE_SIZE)
+        ScriptFormWebApp.max_spill_size = max_spill_size
+        ScriptFormWebApp.upload_chunk_size = upload_chunk_size
+        if upload_budget:
+            ScriptFormWebApp.upload_budget = UploadBudget(upload_budget)
+        else:
+            ScriptFormWebApp.upload_budget = None
+        ScriptFormWebApp.compress_min_size = compress_min_size
+        if static_cache_size:
+            ScriptFormWebApp.static_cache = FileCache(
+                static_cache_size,
+                compress=compress_min_size is not None,
+                compress_min_size=compress_min_size or 0)
+        else:
+            ScriptFormWebApp.static_cache = None
+        if auth_cache_ttl:
+            ScriptFormWebApp.credential_cache = CredentialCache(auth_cache_ttl)
+        else:
+            ScriptFormWebApp.credential_cache = None
+        if session_ttl:
+            ScriptFormWebApp.sessions = SessionSigner(session_ttl,
+                                                      secure_cookies)
+        else:
+            ScriptFormWebApp.sessions = None
+        ScriptFormWebApp.capture_size = capture_size
+        ScriptFormWebApp.preview_size = preview_size
+        # Created before forking, so that all workers share it.
+        self.output_store = OutputStore()
+        ScriptFormWebApp.output_store = self.output_store
+        self.jobs = JobRunner(JobStore(job_dir, job_ttl), job_threads,
+                              job_queue_size, capture_size)
+        ScriptFormWebApp.jobs = self.jobs
+        ScriptFormWebApp.metrics_enabled = metrics
+        ScriptFormWebApp.server_timing = server_timing
+        if trace_file is not None:
+            timing.enable_trace(trace_file)
+            ScriptFormWebApp.trace = True
+        if profile_dir is None:
+            profile_dir = tempfile.gettempdir()
+        self.profiler = Profiler(profile_dir, profile_mode)
+        self.profile = profile
+        ScriptFormWebApp.profiler = self.profiler
+        self.slow_request = slow_request
+        if keepalive:
+            ScriptFormWebApp.protocol_version = 'HTTP/1.1'
+            ScriptFormWebApp.timeout = keepalive
+        else:
+            ScriptFormWebApp.protocol_version = 'HTTP/1.0'
+            ScriptFormWebApp.timeout = None
+        if engine == 'events':
+            if not threads:
+                threads = 10
+            self.httpd = EventHTTPServer((listen_addr, listen_port),
+                                         ScriptFormWebApp,
+                                         threads=threads,
+                                         queue_size=queue_size,
+                                         idle_timeout=keepalive or 15)
+            self.log.info("Using event engine with {0} worker threads, "
+                          "queue size {1}".format(threads, queue_size))
+        elif engine != 'threads':
+            raise ScriptFormError("Unknown engine: {0}".format(engine))
+        elif threads:
+            self.httpd = ThreadPoolHTTPServer((listen_addr, listen_port),
+                                              ScriptFormWebApp,
+                                              threads=threads,
+                                              queue_size=queue_size)
+            self.log.info("Using {0} worker threads, queue size {1}".format(
+                threads, queue_size))
+        else:
+            self.httpd = ThreadedHTTPServer((listen_addr, listen_port),
+                                            ScriptFormWebApp)
+            self.httpd.daemon_threads = True
         self.log.info("Listening on {0}:{1}".format(listen_addr, listen_port))
         self.running = True
-        self.httpd.serve_forever()
+        if workers:
+            # Workers that lose the race for a new connection shouldn't block
+            # in accept().
+            self.httpd.socket.setblocking(0)
+            self.supervisor = Supervisor(workers, self._run_worker)
+            self.supervisor.run()
+        else:
+            self._start_monitors()
+            self.httpd.serve_forever()
+            self._stop_monitors()
+        self.httpd.server_close()
+        self.output_store.remove_all()
+        if not self.jobs.stop(timeout=10):
+            self.log.warning("Background jobs are still running in "
+                             "{0}".format(self.jobs.store.directory))
+        self.jobs.store.remove_all()
         self.running = False
 
+    def _run_worker(self):
+        """
+        Main function of a forked worker process. Serves requests until the
+        process receives a SIGTERM.
+        """
+        def sig_term(sig, frame):
+            """
+            Stop serving requests. This must be done from a separate thread,
+            since the server is running in this one.
+            """
+            thread.start_new_thread(self.httpd.shutdown, ())
+
+        # The supervisor takes care of Ctrl-c and stopping the workers.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, sig_term)
+        # This process is a worker, not the supervisor.
+        self.supervisor = None
+        self._start_monitors()
+        self.httpd.serve_forever()
+        self._stop_monitors()
+        self.httpd.server_close()
+
+    def _start_monitors(self):
+        """
+        Start the profiler and watchdog, if enabled, in the process that
+        serves requests. Their threads don't survive a fork, so in pre-fork
+        mode they're started in each worker.
+        """
+        if self.profile:
+            self.profiler.start()
+        if self.slow_request:
+            WATCHDOG.start(self.slow_request)
+
+    def _stop_monitors(self):
+        """
+        Stop the profiler, which writes its results, and the watchdog.
+        """
+        self.profiler.stop()
+        WATCHDOG.stop()
+
+    def toggle_profiling(self):
+        """
+        Start profiling requests, or stop profiling and write the results. In
+        pre-fork mode, the workers are sent a SIGUSR2 to do so themselves.
+        """
+        if self.supervisor is not None:
+            self.supervisor.signal_workers(signal.SIGUSR2)
+        elif self.profiler is not None:
+            self.profiler.toggle()
+
+    def dump_stacks(self):
+        """
+        Log the stack of every thread, and the request it's handling. In
+        pre-fork mode, the workers are sent a SIGUSR1 to do so themselves.
+        """
+        WATCHDOG.dump_stacks()
+        if self.supervisor is not None:
+            self.supervisor.signal_workers(signal.SIGUSR1)
+
     def shutdown(self):
         """
         Shutdown the server. This interupts the run() method and must thus be
@@ -156,6 +463,10 @@ class ScriptForm(object):
             Callback for when the server is shutdown.
             """
             scriptform_instance.log.info(self.websrv)
+            if scriptform_instance.supervisor is not None:
+                # Pre-fork mode. The workers run the actual server.
+                scriptform_instance.supervisor.stop()
+                return
             # Undocumented feature to shutdow the server.
             scriptform_instance.httpd.socket.close()
             scriptform_instance.httpd.shutdown()
@@ -188,10 +499,132 @@ def main():  # pragma: no cover
     parser.add_option("-r", "--reload", dest="reload", action="store_true",
                       default=False,
                       help="Reload form config on every request (DEV)")
+    parser.add_option("-t", "--threads", dest="threads", action="store",
+                      type="int", default=None,
+                      help="Handle requests with a fixed number of worker "
+                           "threads (default: one thread per request)")
+    parser.add_option("--queue-size", dest="queue_size", action="store",
+                      type="int", default=50,
+                      help="Max connections waiting for a worker thread "
+                           "before new ones are rejected (default=50)")
+    parser.add_option("-k", "--keep-alive", dest="keepalive",
+                      action="store", type="int", default=None,
+                      help="Enable HTTP/1.1 keep-alive. Idle connections are "
+                           "closed after this many seconds")
+    parser.add_option("-e", "--engine", dest="engine", action="store",
+                      type="choice", choices=["threads", "events"],
+                      default="threads",
+                      help="How to handle connections: 'threads' or "
+                           "'events' (default=threads)")
+    parser.add_option("-w", "--workers", dest="workers", action="store",
+                      type="int", default=None,
+                      help="Number of worker processes to serve requests "
+                           "with (default: a single process)")
+    parser.add_option("--max-field-size", dest="max_field_size",
+                      action="store", type="int", default=64 * 1024,
+                      help="Keep submitted form fields (not counting file "
+                           "uploads) in memory up to this many bytes "
+                           "(default=65536)")
+    parser.add_option("--max-spill-size", dest="max_spill_size",
+                      action="store", type="int",
+                      default=runscript.MAX_VALUE_SIZE,
+                      help="Spill larger form fields to disk up to this many "
+                           "bytes, at most {0}. 0 rejects them instead "
+                           "(default={0})".format(runscript.MAX_VALUE_SIZE))
+    parser.add_option("--upload-chunk-size", dest="upload_chunk_size",
+                      action="store", type="int", default=64 * 1024,
+                      help="Uploads are buffered in memory up to this many "
+                           "bytes before being written to disk "
+                           "(default=65536)")
+    parser.add_option("--upload-budget", dest="upload_budget",
+                      action="store", type="int", default=None,
+                      help="Max total bytes of form submissions being "
+                           "handled at the same time (default: no limit)")
+    parser.add_option("--compress-min-size", dest="compress_min_size",
+                      action="store", type="int", default=1024,
+                      help="Compress pages of at least this many bytes if "
+                           "the browser supports it (default=1024)")
+    parser.add_option("--no-compress", dest="compress", action="store_false",
+                      default=True, help="Never compress pages")
+    parser.add_option("--static-cache-size", dest="static_cache_size",
+                      action="store", type="int", default=8 * 1024 * 1024,
+                      help="Keep up to this many bytes of small static files "
+                           "in memory. 0 disables caching (default=8388608)")
+    parser.add_option("--auth-cache-ttl", dest="auth_cache_ttl",
+                      action="store", type="int", default=300,
+                      help="Remember verified credentials for this many "
+                           "seconds. 0 disables this (default=300)")
+    parser.add_option("--session-ttl", dest="session_ttl", action="store",
+                      type="int", default=None,
+                      help="Let browsers log in with a login form and keep "
+                           "them logged in for this many seconds (default: "
+                           "use HTTP basic authentication)")
+    parser.add_option("--secure-cookies", dest="secure_cookies",
+                      action="store_true", default=False,
+                      help="Only let browsers send the session cookie over "
+                           "HTTPS")
+    parser.add_option("--capture-size", dest="capture_size", action="store",
+                      type="int", default=1024 * 1024,
+                      help="Keep up to this many bytes of a script's output "
+                           "in memory and spool the rest to disk "
+                           "(default=1048576)")
+    parser.add_option("--preview-size", dest="preview_size", action="store",
+                      type="int", default=64 * 1024,
+                      help="Show this many bytes of the start and end of "
+                           "output that was spooled to disk (default=65536)")
+    parser.add_option("--job-threads", dest="job_threads", action="store",
+                      type="int", default=2,
+                      help="Run this many background jobs at the same time "
+                           "(default=2)")
+    parser.add_option("--job-queue-size", dest="job_queue_size",
+                      action="store", type="int", default=100,
+                      help="Let at most this many background jobs wait to "
+                           "run (default=100)")
+    parser.add_option("--job-dir", dest="job_dir", action="store",
+                      default=None,
+                      help="Keep background jobs and their output in this "
+                           "dir (default: a temporary dir)")
+    parser.add_option("--job-ttl", dest="job_ttl", action="store",
+                      type="int", default=24 * 3600,
+                      help="Keep finished background jobs for this many "
+                           "seconds (default=86400)")
+    parser.add_option("--metrics", dest="metrics", action="store_true",
+                      default=False,
+                      help="Serve metrics in the Prometheus format at "
+                           "/metrics")
+    parser.add_option("--server-timing", dest="server_timing",
+                      action="store_true", default=False,
+                      help="Report how long each phase of a request took in "
+                           "a Server-Timing header")
+    parser.add_option("--trace-file", dest="trace_file", action="store",
+                      default=None,
+                      help="Append the timing of each request to this file")
+    parser.add_option("--profile", dest="profile", action="store_true",
+                      default=False,
+                      help="Profile requests from the start. Send a SIGUSR2 "
+                           "to start or stop profiling at runtime")
+    parser.add_option("--profile-dir", dest="profile_dir", action="store",
+                      default=None,
+                      help="Write profiles to this dir (default: temp dir)")
+    parser.add_option("--profile-mode", dest="profile_mode", action="store",
+                      type="choice", choices=["sample", "cprofile"],
+                      default="sample",
+                      help="How to profile: 'sample' or 'cprofile' "
+                           "(default=sample)")
+    parser.add_option("--slow-request", dest="slow_request", action="store",
+                      type="float", default=None,
+                      help="Log requests that take longer than this many "
+                           "seconds, with their stack. Send a SIGUSR1 to "
+                           "log the stacks of all threads")
     parser.add_option("--pid-file", dest="pid_file", action="store",
                       default=None, help="Pid file")
     parser.add_option("--log-file", dest="log_file", action="store",
                       default=None, help="Log file")
+    parser.add_option("--log-queue-size", dest="log_queue_size",
+                      action="store", type="int", default=None,
+                      help="Write the log from a background thread, with at "
+                           "most this many records waiting to be written "
+                           "(default: write synchronously)")
     parser.add_option("--start", dest="action_start", action="store_true",
                       default=None, help="Start daemon")
     parser.add_option("--stop", dest="action_stop", action="store_true",
@@ -206,7 +639,7 @@ def main():  # pragma: no cover
         if not plain_pw == getpass.getpass('Repeat password: '):
             sys.stderr.write("Passwords do not match.\n")
             sys.exit(1)
-        sys.stdout.write(hashlib.sha256(plain_pw).hexdigest() + '\n')
+        sys.stdout.write(hash_password(plain_pw) + '\n')
         sys.exit(0)
     else:
         if not options.action_stop and len(args) < 1:
@@ -223,15 +656,58 @@ def main():  # pragma: no cover
             args[0] = os.path.basename(args[0])
 
         daemon = Daemon(options.pid_file, options.log_file,
-                        foreground=options.foreground)
+                        foreground=options.foreground,
+                        log_queue_size=options.log_queue_size)
         log = logging.getLogger('MAIN')
         try:
             if options.action_start:
                 cache = not options.reload
+                compress_min_size = None
+                if options.compress:
+                    compress_min_size = options.compress_min_size
                 scriptform_instance = ScriptForm(args[0], cache=cache)
                 daemon.register_shutdown_callback(scriptform_instance.shutdown)
                 daemon.start()
-                scriptform_instance.run(listen_port=options.port)
+                signal.signal(signal.SIGUSR2,
+                              lambda sig, frame:
+                              scriptform_instance.toggle_profiling())
+                signal.signal(signal.SIGUSR1,
+                              lambda sig, frame:
+                              scriptform_instance.dump_stacks())
+                scriptform_instance.run(listen_port=options.port,
+                                        threads=options.threads,
+                                        queue_size=options.queue_size,
+                                        keepalive=options.keepalive,
+                                        engine=options.engine,
+                                        workers=options.workers,
+                                        max_field_size=options.max_field_size,
+                                        max_spill_size=(
+                                            options.max_spill_size or None),
+                                        upload_chunk_size=(
+                                            options.upload_chunk_size),
+                                        upload_budget=options.upload_budget,
+                                        compress_min_size=compress_min_size,
+                                        metrics=options.metrics,
+                                        server_timing=options.server_timing,
+                                        trace_file=options.trace_file,
+                                        profile=options.profile,
+                                        profile_dir=options.profile_dir,
+                                        profile_mode=options.profile_mode,
+                                        slow_request=options.slow_request,
+                                        static_cache_size=(
+                                            options.static_cache_size),
+                                        auth_cache_ttl=(
+                                            options.auth_cache_ttl),
+                                        session_ttl=options.session_ttl,
+                                        secure_cookies=(
+                                            options.secure_cookies),
+                                        capture_size=options.capture_size,
+                                        preview_size=options.preview_size,
+                                        job_threads=options.job_threads,
+                                        job_queue_size=(
+                                            options.job_queue_size),
+                                        job_dir=options.job_dir,
+                                        job_ttl=options.job_ttl)
             elif options.action_stop:
                 daemon.stop()
                 sys.exit(0)
@@ -0,0 +1,76 @@
+"""
+Measure how long the phases of a request take, for reporting them in a
+Server-Timing header and writing them to a trace file.
+"""
+
+import json
+import logging
+import os
+import time
+
+from logqueue import QueueFileHandler
+
+
+# Trace records are logged here, one JSON object per line. See enable_trace().
+TRACE_LOG = logging.getLogger('TRACE')
+
+
+def enable_trace(trace_file):
+    """
+    Write trace records to `trace_file`. The file is written by a background
+    thread, so requests don't wait for it.
+    """
+    handler = QueueFileHandler(trace_file)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    TRACE_LOG.addHandler(handler)
+    TRACE_LOG.setLevel(logging.INFO)
+    TRACE_LOG.propagate = False
+
+
+class Timer(object):
+    """
+    Measures the phases of a request. The timer starts when it's created.
+    Each call to lap() ends a phase, which started where the previous phase
+    ended.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.last = self.start
+        self.phases = []
+
+    def lap(self, name):
+        """
+        End the current phase and record it as `name`.
+        """
+        now = time.time()
+        self.phases.append((name, self.last, now - self.last))
+        self.last = now
+
+    def server_timing(self):
+        """
+        Return the phases so far, and the total time, as the value of a
+        Server-Timing header. Durations are in milliseconds.
+        """
+        timings = ['{0};dur={1:.3f}'.format(name, duration * 1000)
+                   for name, _, duration in self.phases]
+        timings.append('total;dur={0:.3f}'.format(
+            (time.time() - self.start) * 1000))
+        return ', '.join(timings)
+
+    def trace(self, **attrs):
+        """
+        Return JSON lines describing the request as a whole, with `attrs`,
+        followed by a span for each phase. All lines share a random trace ID.
+        """
+        trace_id = os.urandom(8).encode('hex')
+        request = dict(attrs, trace=trace_id, span='request',
+                       start=self.start, duration=time.time() - self.start)
+        lines = [json.dumps(request, sort_keys=True)]
+        for name, start, duration in self.phases:
+            lines.append(json.dumps({
+                'trace': trace_id,
+                'span': name,
+                'start': start,
+                'duration': duration,
+            }, sort_keys=True))
+        return '\n'.join(lines)
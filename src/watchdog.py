@@ -0,0 +1,164 @@
+"""
+Keep track of the requests that are being handled, so that requests which
+take too long can be reported along with what they're doing.
+"""
+
+import contextlib
+import logging
+import os
+import sys
+import thread
+import threading
+import time
+import traceback
+
+
+class InFlightRequest(object):
+    """
+    A request that's being handled by the thread `ident`.
+    """
+    def __init__(self, ident, method, path, client):
+        self.ident = ident
+        self.method = method
+        self.path = path
+        self.client = client
+        self.start = time.time()
+        self.child_pid = None
+        self.reported = False
+
+    def describe(self):
+        """
+        Return a one-line description of the request.
+        """
+        desc = "{0} {1} from {2}, running for {3:.1f}s".format(
+            self.method, self.path, self.client, time.time() - self.start)
+        if self.child_pid is not None:
+            desc += ", script PID {0}".format(self.child_pid)
+        return desc
+
+
+class Watchdog(object):
+    """
+    Registry of the requests that are being handled, one per thread. A
+    background thread started with start() logs every request that takes
+    longer than a threshold, with the stack of the thread handling it.
+    """
+    def __init__(self):
+        self.requests = {}
+        self.threshold = None
+        self.checker = None
+        self.stopped = None
+        self.log = logging.getLogger('WATCHDOG')
+
+    @contextlib.contextmanager
+    def track(self, method, path, client):
+        """
+        Register the request being handled by the current thread for the
+        duration of the with block. Requests that were reported as slow are
+        logged once more when they're done.
+        """
+        ident = thread.get_ident()
+        request = InFlightRequest(ident, method, path, client)
+        self.requests[ident] = request
+        try:
+            yield request
+        finally:
+            self.requests.pop(ident, None)
+            if request.reported:
+                self.log.warning("Slow request finished: {0}".format(
+                    request.describe()))
+
+    def set_child_pid(self, pid):
+        """
+        Record that the request handled by the current thread started the
+        child process `pid`.
+        """
+        request = self.requests.get(thread.get_ident())
+        if request is not None:
+            request.child_pid = pid
+
+    def start(self, threshold, interval=None):
+        """
+        Start a thread which logs requests that have been running for more
+        than `threshold` seconds. It checks every `interval` seconds, by
+        default half the threshold up to a second.
+        """
+        if interval is None:
+            interval = min(threshold / 2.0, 1.0)
+        self.threshold = threshold
+        if self.checker is not None and self.checker.is_alive():
+            return
+        # Every checker thread gets its own event, so that one that's being
+        # stopped can't be kept going by a start() that follows.
+        self.stopped = threading.Event()
+        self.checker = threading.Thread(target=self._check_loop,
+                                        args=(interval, self.stopped))
+        self.checker.daemon = True
+        self.checker.start()
+
+    def stop(self):
+        """
+        Stop checking for slow requests, and wait for the checker thread to
+        finish, so that a start() that follows doesn't run a second one.
+        """
+        checker, self.checker = self.checker, None
+        if checker is None:
+            return
+        self.stopped.set()
+        if checker is not threading.current_thread():
+            checker.join()
+
+    def check(self):
+        """
+        Log the requests that have been running for longer than the threshold
+        and haven't been reported yet, with their current stack. Returns the
+        reported requests.
+        """
+        now = time.time()
+        slow = [request for request in self.requests.values()
+                if not request.reported and
+                now - request.start > self.threshold]
+        if not slow:
+            return []
+        frames = sys._current_frames()
+        for request in slow:
+            request.reported = True
+            stack = ''
+            frame = frames.get(request.ident)
+            if frame is not None:
+                stack = ''.join(traceback.format_stack(frame))
+            self.log.warning("Slow request: {0}\n{1}".format(
+                request.describe(), stack))
+        return slow
+
+    def dump_stacks(self):
+        """
+        Log the current stack of every thread in this process, along with the
+        request it's handling, if any.
+        """
+        names = dict((thr.ident, thr.name) for thr in threading.enumerate())
+        frames = sys._current_frames()
+        lines = ["Stacks of {0} threads in process {1}".format(
+            len(frames), os.getpid())]
+        for ident, frame in sorted(frames.items()):
+            lines.append("Thread {0} ({1})".format(
+                names.get(ident, 'unknown'), ident))
+            request = self.requests.get(ident)
+            if request is not None:
+                lines.append("Handling {0}".format(request.describe()))
+            lines.append(''.join(traceback.format_stack(frame)))
+        self.log.warning('\n'.join(lines))
+
+    def _check_loop(self, interval, stopped):
+        """
+        Main loop of the checker thread, until the `stopped` event is set.
+        """
+        while not stopped.wait(interval):
+            try:
+                self.check()
+            except Exception as err:
+                self.log.exception(err)
+
+
+# The watchdog that requests are registered with.
+WATCHDOG = Watchdog()
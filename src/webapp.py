@@ -4,83 +4,91 @@ handling them.
 """
 
 import cgi
+import codecs
 import logging
-import tempfile
 import os
 import base64
+import binascii
 import hashlib
+import json
+import time
+import urllib
+import urlparse
 
+from auth import SESSION_COOKIE
 from formrender import FormRender
-from webserver import HTTPError, RequestHandler
+from jobs import JobQueueFull
+from webserver import HTTPError, RequestHandler, http_methods, \
+    negotiate_encoding
 import runscript
-
+import metrics
+
+
+HTML_CSS = u'''/* Default classes */
+.btn { color: #FFFFFF; font-weight: bold; font-size: 0.9em;
+       background-color: #1D98E4; padding: 9px; border-radius: 4px;
+       border-width: 0px; text-decoration: none; }
+.btn-act { background-color: #1D98E4; }
+.btn-lnk { background-color: #D0D0D0; }
+.error { color: #FF0000; }
+
+/* Main element markup */
+*,body { font-family: sans-serif; }
+h1 { color: #555555; text-align: center; margin: 32px auto 32px auto; }
+pre { font-family: monospace; }
+
+/* List of available forms */
+div.list { width: 50%; margin: 40px auto 0px auto; }
+div.list li { font-size: 0.90em; list-style: none;
+             margin-bottom: 65px; }
+div.list h2 { background-color: #E0E5E5;
+             border-radius: 3px; font-weight: bold;
+             padding: 10px; font-size: 1.2em; }
+div.list p.form-description { margin-left: 25px; }
+div.list a.form-link { margin-left: 25px; }
+
+/* Form display */
+div.form { width: 50%; margin: 40px auto 0px auto; }
+div.form h2 { font-weight: bold; background-color: #E0E5E5; padding: 25px;
+             border-radius: 10px; }
+div.form p.form-description { font-size: 0.90em;
+                             margin: 40px 25px 65px 25px; }
+div.form li { font-size: 0.90em; list-style: none; }
+div.form li.hidden { display: none; }
+div.form p.form-field-title { margin-bottom: 0px; }
+div.form p.form-field-input { margin-top: 0px; }
+div.form li.checkbox p.form-field-input { float: left;
+                                          margin-right: 8px; }
+div.form li.required abbr { color: #FF0000; }
+select,
+textarea,
+input[type=text],
+input[type=number],
+input[type=date],
+input[type=password] { color: #606060; padding: 9px; border-radius: 4px;
+                       border: 1px solid #D0D0D0;
+                       background-color: #F9F9F9; }
+textarea { font-family: monospace; }
+
+/* Result display */
+div.result { width: 50%; margin: 40px auto 0px auto; }
+div.result h2 { background-color: #E0E5E5; border-radius: 3px;
+               font-weight: bold; padding: 10px; }
+div.result div.result-result { margin-left: 25px; }
+div.result p.output-omitted { font-style: italic; color: #606060; }
+div.result ul.nav { margin: 64px 0px 128px 0px; padding-left: 0px; }
+div.result ul.nav li { list-style: none; float: left;
+                   font-size: 0.90em; margin-right: 20px; }
+
+/* Other */
+div.about { text-align: center; font-size: 12px; color: #808080; }
+div.about a { text-decoration: none; color: #000000; }
+'''
 
 HTML_HEADER = u'''<html>
 <head>
   <meta charset="UTF-8">
-  <style>
-    /* Default classes */
-    .btn {{ color: #FFFFFF; font-weight: bold; font-size: 0.9em;
-            background-color: #1D98E4; padding: 9px; border-radius: 4px;
-            border-width: 0px; text-decoration: none; }}
-    .btn-act {{ background-color: #1D98E4; }}
-    .btn-lnk {{ background-color: #D0D0D0; }}
-    .error {{ color: #FF0000; }}
-
-    /* Main element markup */
-    *,body {{ font-family: sans-serif; }}
-    h1 {{ color: #555555; text-align: center; margin: 32px auto 32px auto; }}
-    pre {{ font-family: monospace; }}
-
-    /* List of available forms */
-    div.list {{ width: 50%; margin: 40px auto 0px auto; }}
-    div.list li {{ font-size: 0.90em; list-style: none;
-                  margin-bottom: 65px; }}
-    div.list h2 {{ background-color: #E0E5E5;
-                  border-radius: 3px; font-weight: bold;
-                  padding: 10px; font-size: 1.2em; }}
-    div.list p.form-description {{ margin-left: 25px; }}
-    div.list a.form-link {{ margin-left: 25px; }}
-
-    /* Form display */
-    div.form {{ width: 50%; margin: 40px auto 0px auto; }}
-    div.form h2 {{ font-weight: bold; background-color: #E0E5E5; padding: 25px;
-                  border-radius: 10px; }}
-    div.form p.form-description {{ font-size: 0.90em;
-                                  margin: 40px 25px 65px 25px; }}
-    div.form li {{ font-size: 0.90em; list-style: none; }}
-    div.form li.hidden {{ display: none; }}
-    div.form p.form-field-title {{ margin-bottom: 0px; }}
-    div.form p.form-field-input {{ margin-top: 0px; }}
-    div.form li.checkbox p.form-field-input {{ float: left;
-                                               margin-right: 8px; }}
-    div.form li.required abbr {{ color: #FF0000; }}
-    select,
-    textarea,
-    input[type=text],
-    input[type=number],
-    input[type=date],
-    input[type=password] {{ color: #606060; padding: 9px; border-radius: 4px;
-                            border: 1px solid #D0D0D0;
-                            background-color: #F9F9F9; }}
-    textarea {{ font-family: monospace; }}
-
-    /* Result display */
-    div.result {{ width: 50%; margin: 40px auto 0px auto; }}
-    div.result h2 {{ background-color: #E0E5E5; border-radius: 3px;
-                    font-weight: bold; padding: 10px; }}
-    div.result div.result-result {{ margin-left: 25px; }}
-    div.result ul.nav {{ margin: 64px 0px 128px 0px; padding-left: 0px; }}
-    div.result ul.nav li {{ list-style: none; float: left;
-                        font-size: 0.90em; margin-right: 20px; }}
-
-    /* Other */
-    div.about {{ text-align: center; font-size: 12px; color: #808080; }}
-    div.about a {{ text-decoration: none; color: #000000; }}
-
-    /* Custom css */
-    {custom_css}
-  </style>
+  <link rel="stylesheet" type="text/css" href="style?v={css_hash}">
 </head>
 <body>
   <h1>{title}</h1>
@@ -99,15 +107,12 @@ HTML_FOOTER = u'''
 '''
 
 HTML_LIST = u'''
-{header}
 <div class="list">
   {form_list}
 </div>
-{footer}
 '''
 
 HTML_FORM = u'''
-{header}
 <div class="form">
   <h2 class="form-title">{title}</h2>
   <p class="form-description">{description}</p>
@@ -127,7 +132,6 @@ HTML_FORM = u'''
     </ul>
   </form>
 </div>
-{footer}
 '''
 
 HTML_FORM_LIST = u'''
@@ -141,7 +145,6 @@ HTML_FORM_LIST = u'''
 '''
 
 HTML_SUBMIT_RESPONSE = u'''
-{header}
 <div class="result">
   <h2 class="result-title">{title}</h2>
   <h3 class="result-subtitle">Result</h3>
@@ -155,14 +158,115 @@ HTML_SUBMIT_RESPONSE = u'''
     <li><a class="btn btn-lnk" href=".">Back to the list</a></li>
   </ul>
 </div>
-{footer}
 '''
 
+HTML_OUTPUT_PREVIEW = u'''
+<div class="output-preview{classes}">
+  <pre class="output-head">{head}</pre>
+  <p class="output-omitted">{omitted} {link}</p>
+  <pre class="output-tail">{tail}</pre>
+</div>
+'''
+
+HTML_JOB_PENDING = u'''
+<p class="job-state">{state}</p>
+<p>This page is refreshed until the script has finished. You can also leave
+and come back to it later.</p>
+'''
+
+HTML_LOGIN = u'''
+<div class="form">
+  <h2 class="form-title">Log in</h2>
+  {error}
+  <form id="login" action="login" method="post">
+    <input type="hidden" name="url" value="{url}" />
+    <ul>
+        <li>
+          <p class="form-field-title">Username</p>
+          <p class="form-field-input">
+            <input type="text" name="username" value="{username}"
+             autofocus />
+          </p>
+        </li>
+        <li>
+          <p class="form-field-title">Password</p>
+          <p class="form-field-input">
+            <input type="password" name="password" />
+          </p>
+        </li>
+        <li class="submit">
+          <input type="submit" class="btn btn-act" value="Log in" />
+        </li>
+    </ul>
+  </form>
+</div>
+'''
+
+
+def local_url(url):
+    """
+    Return `url` if it's a URL on this site, so that it's safe to redirect
+    users to it: a relative URL or a path that starts with a single '/'.
+    Otherwise return the URL of the index.
+    """
+    url = url.strip()
+    # Browsers treat backslashes like slashes and ignore tabs and newlines,
+    # so those could turn the URL into one for another site.
+    if not url or '\\' in url or \
+       any(ord(char) < 0x20 or ord(char) == 0x7f for char in url):
+        return '.'
+    url_comp = urlparse.urlsplit(url)
+    if url_comp.scheme or url_comp.netloc or url.startswith('//') or \
+       url_comp.path.startswith('//'):
+        return '.'
+    return url
+
+
+class PageChrome(object):
+    """
+    The parts of pages that only depend on the form config, rendered and
+    UTF-8 encoded: the header and footer of pages, and the stylesheet. The
+    stylesheet is referred to by a fingerprint of its contents, so browsers
+    can cache it for as long as they like.
+    """
+    def __init__(self, form_config):
+        self.generation = form_config.generation
+        css = HTML_CSS.encode('utf8')
+        if form_config.custom_css:
+            css += '\n/* Custom css */\n' + form_config.custom_css
+        self.css = css
+        self.css_hash = hashlib.sha256(css).hexdigest()[:16]
+        self.header = HTML_HEADER.format(title=form_config.title,
+                                         css_hash=self.css_hash)
+        self.header = self.header.encode('utf8')
+        self.footer = HTML_FOOTER.encode('utf8')
+
 
 class ScriptFormWebApp(RequestHandler):
     """
     This class is a request handler for the webserver.
     """
+    # Whether the /metrics page is available.
+    metrics_enabled = False
+    # PageChrome of the most recent form config generation.
+    chrome = None
+    # filecache.FileCache for small static files, or None.
+    static_cache = None
+    # auth.CredentialCache of recently verified credentials, or None.
+    credential_cache = None
+    # auth.SessionSigner for the session cookies of the login form, or None
+    # if the login form is disabled.
+    sessions = None
+    # Script output beyond this many bytes is spooled to disk, and only its
+    # first and last `preview_size` bytes are shown.
+    capture_size = 1024 * 1024
+    preview_size = 64 * 1024
+    # outputstore.OutputStore that keeps spooled output for downloading, or
+    # None.
+    output_store = None
+    # jobs.JobRunner that runs the scripts of forms with the `async` option.
+    jobs = None
+
     def index(self):
         """
         Index handler. If there's only one form defined, render that form.
@@ -181,42 +285,179 @@ class ScriptFormWebApp(RequestHandler):
     def auth(self):
         """
         Verify that the user is authenticated. This is required if the form
-        definition contains a 'users' field. Returns the username if the user
-        is validated or None if no validation is required.. Otherwise, raises a
-        401 HTTP back to the client.
+        definition contains a 'users' or 'auth' field. Returns the username if
+        the user is validated or None if no validation is required.. Otherwise,
+        raises a 401 HTTP back to the client. The password is checked by the
+        form config's `auth_backend`.
+
+        If the login form is enabled, users may also be authenticated by the
+        session cookie it handed out. Browsers that aren't authenticated are
+        then redirected to the login form instead of getting a 401.
+
+        Verifying a password hash is slow on purpose, so credentials that
+        were verified recently are looked up in the `credential_cache`.
         """
         form_config = self.scriptform.get_form_config()
         username = None
 
-        # If a 'users' element was present in the form configuration file, the
-        # user must be authenticated.
-        if form_config.users:
+        # If a 'users' or 'auth' element was present in the form
+        # configuration file, the user must be authenticated.
+        backend = form_config.auth_backend
+        if backend is not None:
+            sessions = self.sessions
+            if sessions is not None:
+                token = self.get_cookie(SESSION_COOKIE)
+                if token is not None:
+                    username = sessions.verify(token, backend.session_stamp)
+                    if username is not None:
+                        return username
+
             auth_header = self.headers.getheader("Authorization")
             if auth_header is not None:
-                # Validate the username and password
-                auth_unpw = auth_header.split(' ', 1)[1]
-                username, password = base64.decodestring(auth_unpw).split(":")
-                pw_hash = hashlib.sha256(password).hexdigest()
+                # Users may change when the form config or the backend's
+                # source of users changes.
+                generation = (form_config.generation, backend.generation())
+                cache = self.credential_cache
+                if cache is not None:
+                    username = cache.get(auth_header, generation)
+                    if username is not None:
+                        return username
 
-                if username in form_config.users and \
-                   pw_hash == form_config.users[username]:
+                # Validate the username and password
+                try:
+                    auth_unpw = auth_header.split(' ', 1)[1]
+                    username, password = \
+                        base64.decodestring(auth_unpw).split(":", 1)
+                    username = username.decode('utf8')
+                except (IndexError, ValueError, binascii.Error):
+                    username, password = None, None
+
+                if username is not None and \
+                   backend.authenticate(username, password):
                     # Valid username and password. Return the username.
+                    if cache is not None:
+                        cache.add(auth_header, generation, username)
                     return username
 
             # Authentication needed, but not provided or wrong username/pw.
+            if sessions is not None and auth_header is None and \
+               self.command in ('GET', 'HEAD') and \
+               'text/html' in self.headers.get('accept', ''):
+                raise HTTPError(303, 'Log in',
+                                {'Location': self.login_url()})
             headers = {"WWW-Authenticate": 'Basic realm="Private Area"'}
             raise HTTPError(401, 'Authenticate', headers)
 
         # No authentication required. Return None as the username.
         return None
 
+    def login_url(self):
+        """
+        Return the URL of the login form, relative to the requested page,
+        which returns the user to that page after logging in.
+        """
+        url_comp = urlparse.urlsplit(self.path)
+        path = url_comp.path.lstrip('/')
+        url = path
+        if url_comp.query:
+            url += '?' + url_comp.query
+        # Requests such as '/form/' need to go up a directory first.
+        return '{0}login?url={1}'.format('../' * path.count('/'),
+                                         urllib.quote(url, ''))
+
+    def max_body_size(self, form_values):
+        """
+        Limit the size of submitted forms to the form's `max_upload_size`.
+        Until the form is known, the largest limit of all forms applies, if
+        all of them have one.
+        """
+        form_config = self.scriptform.get_form_config()
+        form_name = form_values.getfirst('form_name', None)
+        if form_name is not None:
+            try:
+                return form_config.get_form_def(form_name).max_upload_size
+            except ValueError:
+                pass
+        max_sizes = [form_def.max_upload_size
+                     for form_def in form_config.forms]
+        if None in max_sizes:
+            return None
+        return max(max_sizes)
+
+    def profile_key(self, path, params):
+        """
+        Profile requests for a form per form, e.g. as '/submit.my_form'.
+        Unknown form names are profiled with the route, so clients can't
+        create arbitrary profile files.
+        """
+        key = self.route_name(path)
+        if 'form_values' in params:
+            form_name = params['form_values'].getfirst('form_name', None)
+        else:
+            form_name = params.get('form_name')
+        if form_name is not None:
+            form_config = self.scriptform.get_form_config()
+            try:
+                form_def = form_config.get_form_def(form_name)
+            except ValueError:
+                return key
+            key = '{0}.{1}'.format(key, form_def.name)
+        return key
+
+    def get_chrome(self, form_config):
+        """
+        Return the PageChrome for `form_config`. It's only rendered again
+        when the generation of the form config changes.
+        """
+        chrome = self.chrome
+        if chrome is None or chrome.generation != form_config.generation:
+            chrome = PageChrome(form_config)
+            ScriptFormWebApp.chrome = chrome
+        return chrome
+
+    def render_page(self, form_config, template, **kwargs):
+        """
+        Render the page body `template` with `kwargs` and return it as UTF-8
+        between the header and footer of the form config's PageChrome.
+        """
+        chrome = self.get_chrome(form_config)
+        return ''.join((chrome.header,
+                        template.format(**kwargs).encode('utf8'),
+                        chrome.footer))
+
+    def page_headers(self, form_config, username, *key):
+        """
+        Return the headers that let clients cache a page which is entirely
+        determined by the form config, the user and `key`: an ETag with which
+        they can check whether their copy is still current, and headers
+        telling them to always do so. The pages are only for the user they
+        were rendered for, so shared caches such as proxies mustn't keep
+        them. Returns None for requests other than GET and HEAD, whose pages
+        aren't cached.
+        """
+        if self.command not in ('GET', 'HEAD'):
+            return None
+        # Pages also change with Scriptform's templates.
+        state = json.dumps(['%%VERSION%%', form_config.fingerprint, username,
+                            key])
+        etag = hashlib.sha256(state).hexdigest()[:32]
+        return {
+            'ETag': 'W/"{0}"'.format(etag),
+            'Cache-Control': 'private, no-cache',
+            'Vary': 'Authorization, Cookie, Accept-Encoding',
+        }
+
     def h_list(self):
         """
         Render a list of available forms.
         """
         username = self.auth()
+        self.timer.lap('auth')
 
         form_config = self.scriptform.get_form_config()
+        headers = self.page_headers(form_config, username, 'list')
+        if headers is not None and self.not_modified(headers):
+            return
         h_form_list = []
         for form_def in form_config.get_visible_forms(username):
             h_form_list.append(
@@ -227,16 +468,13 @@ class ScriptFormWebApp(RequestHandler):
                 )
             )
 
-        output = HTML_LIST.format(
-            header=HTML_HEADER.format(title=form_config.title,
-                                      custom_css=form_config.custom_css),
-            footer=HTML_FOOTER,
+        output = self.render_page(
+            form_config,
+            HTML_LIST,
             form_list=u''.join(h_form_list)
         )
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(output.encode('utf8'))
+        self.timer.lap('render')
+        self.respond(output, headers=headers)
 
     def h_form(self, form_name, errors=None, **form_values):
         """
@@ -319,6 +557,7 @@ class ScriptFormWebApp(RequestHandler):
             errors = {}
 
         username = self.auth()
+        self.timer.lap('auth')
 
         form_config = self.scriptform.get_form_config()
         fr_inst = FormRender(None)
@@ -329,6 +568,14 @@ class ScriptFormWebApp(RequestHandler):
            username not in form_def.allowed_users:
             raise HTTPError(403, "You're not authorized to view this form")
 
+        headers = None
+        if not errors:
+            headers = self.page_headers(form_config, username, 'form',
+                                        form_def.name,
+                                        sorted(form_values.items()))
+            if headers is not None and self.not_modified(headers):
+                return
+
         html_errors = u''
         if errors:
             html_errors = u'<ul>'
@@ -336,10 +583,9 @@ class ScriptFormWebApp(RequestHandler):
                 html_errors += u'<li class="error">{0}</li>'.format(error)
             html_errors += u'</ul>'
 
-        output = HTML_FORM.format(
-            header=HTML_HEADER.format(title=form_config.title,
-                                      custom_css=form_config.custom_css),
-            footer=HTML_FOOTER,
+        output = self.render_page(
+            form_config,
+            HTML_FORM,
             title=form_def.title,
             description=form_def.description,
             errors=html_errors,
@@ -350,11 +596,10 @@ class ScriptFormWebApp(RequestHandler):
             ),
             submit_title=form_def.submit_title
         )
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(output.encode('utf8'))
+        self.timer.lap('render')
+        self.respond(output, headers=headers)
 
+    @http_methods('POST')
     def h_submit(self, form_values):
         """
         Handle the submitting of a form by validating the values and then doing
@@ -362,6 +607,7 @@ class ScriptFormWebApp(RequestHandler):
         in the form definition.
         """
         username = self.auth()
+        self.timer.lap('auth')
 
         form_config = self.scriptform.get_form_config()
         form_name = form_values.getfirst('form_name', None)
@@ -370,39 +616,19 @@ class ScriptFormWebApp(RequestHandler):
            username not in form_def.allowed_users:
             raise HTTPError(403, "You're not authorized to view this form")
 
-        # Convert FieldStorage to a simple dict, because we're not allowd to
-        # add items to it. For normal fields, the form field name becomes the
-        # key and the value becomes the field value. For file upload fields, we
-        # stream the uploaded file to a temp file and then put the temp file in
-        # the destination dict. We also add an extra field with the originally
-        # uploaded file's name.
-        values = {}
-        tmp_files = []
-        for field_name in form_values:
-            field = form_values[field_name]
-            if field.filename is not None:
-                # Field is an uploaded file. Stream it to a temp file if
-                # something was actually uploaded
-                if field.filename == '':
-                    continue
-                tmp_fname = tempfile.mktemp(prefix="scriptform_")
-                tmp_file = file(tmp_fname, 'w')
-                while True:
-                    buf = field.file.read(1024 * 16)
-                    if not buf:
-                        break
-                    tmp_file.write(buf)
-                tmp_file.close()
-                field.file.close()
-
-                tmp_files.append(tmp_fname)  # For later cleanup
-                values[field_name] = tmp_fname
-                values['{0}__name'.format(field_name)] = field.filename
-            else:
-                # Field is a normal form field. Store its value.
-                values[field_name] = form_values.getfirst(field_name, None)
+        # Convert the form data to a simple dict. For normal fields, the form
+        # field name becomes the key and the value becomes the field value.
+        # Uploaded files have already been streamed to temp files by the
+        # parser, so we put the temp file in the destination dict. We also add
+        # an extra field with the originally uploaded file's name.
+        form_data = form_values
+        values = form_values.field_values()
+        for field_name, upload in form_values.files.items():
+            values[field_name] = upload.path
+            values['{0}__name'.format(field_name)] = upload.filename
 
         form_errors, form_values = form_def.validate(values)
+        self.timer.lap('validate')
 
         if not form_errors:
             # Call script. If a result is returned, we wrap its output in some
@@ -415,49 +641,366 @@ class ScriptFormWebApp(RequestHandler):
             cwd = os.path.realpath(os.curdir)
             log.info("Calling script: {0}".format(form_def.script))
             log.info("Current working dir: {0}".format(cwd))
-            log.info("User: {0}".format(username))
+            log.info(u"User: {0}".format(username))
             log.info("Variables: {0}".format(dict(form_values.items())))
 
             form_def = form_config.get_form_def(form_name)
+            if form_def.run_async and form_def.output != 'raw':
+                self.submit_job(form_def, form_values, form_data, username)
+                return
+            if form_def.stream and form_def.output != 'raw':
+                self.stream_result(form_config, form_def, form_values,
+                                   username)
+                return
+            if form_def.output == 'raw':
+                # The script writes straight to the socket, so it must be in
+                # blocking mode. There's no way to tell the length of the
+                # script's response, so the connection is closed afterwards.
+                # Anything still buffered must be sent before the script
+                # starts writing.
+                self.connection.settimeout(None)
+                self.close_connection = 1
+                self.send_body('')
             result = runscript.run_script(form_def, form_values, self.wfile,
-                                          self.wfile)
+                                          self.wfile, timer=self.timer,
+                                          capture_size=self.capture_size,
+                                          spool_dir=self.spool_dir())
             if form_def.output != 'raw':
                 # Ignore everything if we're doing raw output, since it's the
                 # scripts responsibility.
-                if result['exitcode'] != 0:
-                    stderr = cgi.escape(result['stderr'].decode('utf8'))
-                    msg = u'<span class="error">{0}</span>'.format(stderr)
-                else:
-                    if form_def.output == 'escaped':
-                        stdout = cgi.escape(result['stdout'].decode('utf8'))
-                        msg = u'<pre>{0}</pre>'.format(stdout)
+                try:
+                    if result['exitcode'] != 0:
+                        msg = self.render_output(result['stderr'], 'error',
+                                                 username)
                     else:
-                        # Non-escaped output (html, usually)
-                        msg = result['stdout'].decode('utf8')
-
-                output = HTML_SUBMIT_RESPONSE.format(
-                    header=HTML_HEADER.format(
-                        title=form_config.title,
-                        custom_css=form_config.custom_css
-                    ),
-                    footer=HTML_FOOTER,
+                        msg = self.render_output(result['stdout'],
+                                                 form_def.output, username)
+                finally:
+                    result['stdout'].cleanup()
+                    result['stderr'].cleanup()
+
+                output = self.render_page(
+                    form_config,
+                    HTML_SUBMIT_RESPONSE,
                     title=form_def.title,
                     form_name=form_def.name,
                     msg=msg,
                 )
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                self.wfile.write(output.encode('utf8'))
+                self.timer.lap('render')
+                self.respond(output)
         else:
             # Form had errors
             form_values.pop('form_name')
             self.h_form(form_name, form_errors, **form_values)
 
-        # Clean up uploaded files
-        for file_name in tmp_files:
-            if os.path.exists(file_name):
-                os.unlink(file_name)
+    def submit_job(self, form_def, form_values, form_data, username):
+        """
+        Queue a job that runs the script of `form_def` in the background, and
+        send the browser to the job's page. The job takes over the uploaded
+        files in the FormData `form_data`, and the upload budget reserved for
+        them.
+        """
+        try:
+            job = self.jobs.submit(form_def, form_values, username,
+                                   form_data.detach_uploads())
+        except JobQueueFull:
+            raise HTTPError(503, "Too many jobs queued", {'Retry-After': '5'})
+        self.timer.lap('submit')
+        headers = {
+            'Location': 'job?job_id={0}'.format(job['id']),
+            'Cache-Control': 'no-store',
+        }
+        self.respond('', status=303, content_type=None, headers=headers)
+
+    def spool_dir(self):
+        """
+        Return the directory that large script output is spooled to, so that
+        it can be moved into the output store afterwards.
+        """
+        if self.output_store is None:
+            return None
+        return self.output_store.directory
+
+    def render_output(self, captured, output, username, download=None):
+        """
+        Render the runscript.CapturedOutput `captured` as HTML. `output` is
+        the form's output type, or 'error' for the stderr of a failed script.
+
+        Output that was spooled to disk is too large to show. Its start and
+        end are shown as text instead, with a link to `download` all of it.
+        If that isn't given, the output is added to the output store, from
+        which only `username` can download it.
+        """
+        if not captured.spooled():
+            text = captured.getvalue().decode('utf8', 'replace')
+            if output == 'html':
+                return text
+            elif output == 'error':
+                return u'<span class="error">{0}</span>'.format(
+                    cgi.escape(text))
+            return u'<pre>{0}</pre>'.format(cgi.escape(text))
+
+        size = self.preview_size
+        if captured.size > 2 * size:
+            head = captured.head(size).decode('utf8', 'replace')
+            tail = captured.tail(size).decode('utf8', 'replace')
+            omitted = u'{0:,} bytes of output not shown.'.format(
+                captured.size - 2 * size)
+        else:
+            head = captured.head(captured.size).decode('utf8', 'replace')
+            tail = u''
+            omitted = u''
+        link = u''
+        if download is None and self.output_store is not None:
+            output_id = self.output_store.add(captured.detach(), username)
+            download = u'output?output_id={0}'.format(output_id)
+        if download is not None:
+            link = u'<a href="{0}">Download all of it</a>'.format(
+                cgi.escape(download, True))
+        return HTML_OUTPUT_PREVIEW.format(
+            classes=u' error' if output == 'error' else u'',
+            head=cgi.escape(head),
+            omitted=omitted,
+            link=link,
+            tail=cgi.escape(tail),
+        )
+
+    def stream_result(self, form_config, form_def, form_values, username):
+        """
+        Run the script of `form_def` and send its output to the browser while
+        it runs, for forms with the `stream` option. The page up to the
+        output is sent right away. Each piece of stdout is escaped (for
+        'escaped' output) and sent as soon as the script writes it. stderr
+        and the exit code follow once the script exits.
+        """
+        chrome = self.get_chrome(form_config)
+        before, after = HTML_SUBMIT_RESPONSE.split(u'{msg}')
+        page_vars = {'title': form_def.title, 'form_name': form_def.name}
+        escaped = form_def.output == 'escaped'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        coding = None
+        if self.compress_min_size is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+            coding = negotiate_encoding(
+                self.headers.get('accept-encoding', ''))
+        stream = self.start_stream(coding)
+        stream.write(chrome.header + before.format(**page_vars).encode('utf8'))
+        if escaped:
+            stream.write('<pre>')
+        # Characters may be split across the pieces of stdout.
+        decoder = codecs.getincrementaldecoder('utf8')('replace')
+
+        def write_stdout(data):
+            """
+            Send a piece of the script's stdout.
+            """
+            if escaped:
+                data = cgi.escape(decoder.decode(data)).encode('utf8')
+            stream.write(data)
+
+        result = runscript.run_script(form_def, form_values,
+                                      timer=self.timer,
+                                      on_stdout=write_stdout,
+                                      capture_size=self.capture_size,
+                                      spool_dir=self.spool_dir())
+        tail = []
+        if escaped:
+            tail.append(cgi.escape(decoder.decode('', True)))
+            tail.append(u'</pre>')
+        try:
+            if result['exitcode'] != 0:
+                tail.append(u'<p class="error">The script exited with code '
+                            u'{0}.</p>'.format(result['exitcode']))
+                tail.append(self.render_output(result['stderr'], 'error',
+                                               username))
+        finally:
+            result['stdout'].cleanup()
+            result['stderr'].cleanup()
+        tail.append(after.format(**page_vars))
+        stream.write(u''.join(tail).encode('utf8') + chrome.footer)
+        stream.close()
+        self.timer.lap('render')
+
+    @http_methods('GET', 'HEAD', 'POST')
+    def h_login(self, form_values=None, url='.'):
+        """
+        Render the login form, or log in the user who submitted it. Users
+        that log in get a session cookie and are sent on to `url`, which is
+        relative to the login form.
+        """
+        form_config = self.scriptform.get_form_config()
+        backend = form_config.auth_backend
+        if self.sessions is None or backend is None:
+            raise HTTPError(404, "Not found")
+
+        error = u''
+        username = u''
+        if self.command == 'POST':
+            url = form_values.getfirst('url', '.')
+            username = form_values.getfirst('username', '')
+            username = username.decode('utf8', 'replace')
+            password = form_values.getfirst('password', '')
+            if backend.authenticate(username, password):
+                self.timer.lap('auth')
+                stamp = backend.session_stamp(username)
+                headers = {
+                    'Location': local_url(url),
+                    'Set-Cookie': self.sessions.cookie(
+                        self.sessions.sign(username, stamp),
+                        secure=self.is_https()),
+                    'Cache-Control': 'no-store',
+                }
+                self.respond('', status=303, content_type=None,
+                             headers=headers)
+                return
+            self.timer.lap('auth')
+            error = u'<p class="error">Invalid username or password</p>'
+
+        output = self.render_page(
+            form_config,
+            HTML_LOGIN,
+            error=error,
+            url=cgi.escape(url.decode('utf8', 'replace'), True),
+            username=cgi.escape(username, True),
+        )
+        self.timer.lap('render')
+        self.respond(output, headers={'Cache-Control': 'no-store'})
+
+    def is_https(self):
+        """
+        Return whether the client connected over HTTPS. Scriptform itself
+        only speaks HTTP, so this relies on the `X-Forwarded-Proto` header of
+        a proxy in front of it.
+        """
+        proto = self.headers.get('X-Forwarded-Proto', '')
+        return proto.split(',')[0].strip().lower() == 'https'
+
+    def h_logout(self):
+        """
+        Log out the user by removing their session cookie. A copy of the
+        cookie stays valid until it expires.
+        """
+        if self.sessions is None:
+            raise HTTPError(404, "Not found")
+        headers = {
+            'Location': '.',
+            'Set-Cookie': self.sessions.cookie('', secure=self.is_https()),
+            'Cache-Control': 'no-store',
+        }
+        self.respond('', status=303, content_type=None, headers=headers)
+
+    def h_output(self, output_id):
+        """
+        Serve the complete output of a script that was too large to show on
+        the result page. Only the user that ran the script may download it.
+        """
+        username = self.auth()
+        path = None
+        if self.output_store is not None:
+            path = self.output_store.get(output_id, username)
+        if path is None:
+            raise HTTPError(404, "Not found")
+        headers = {
+            'Content-Disposition': 'attachment; filename="output.txt"',
+            'Cache-Control': 'private, no-cache',
+        }
+        self.send_file(path, 'text/plain; charset=utf-8', headers=headers)
+
+    def get_job(self, job_id, username):
+        """
+        Return the job with `job_id`. Raises a 404 if there's no such job or
+        it was submitted by someone other than `username`.
+        """
+        job = None
+        if self.jobs is not None:
+            job = self.jobs.store.get(job_id)
+        if job is None or job['username'] != username:
+            raise HTTPError(404, "Not found")
+        return job
+
+    def h_job(self, job_id):
+        """
+        Render the page of a job: its state while it's waiting or running,
+        and the output of its script once it's done. Pages of unfinished
+        jobs ask the browser to refresh them.
+        """
+        username = self.auth()
+        self.timer.lap('auth')
+        job = self.get_job(job_id, username)
+        form_config = self.scriptform.get_form_config()
+
+        headers = {'Cache-Control': 'no-store'}
+        if job['state'] == 'queued':
+            state = u'The job is waiting to run (submitted at {0}).'.format(
+                time.strftime('%H:%M:%S', time.localtime(job['submitted'])))
+            msg = HTML_JOB_PENDING.format(state=state)
+            headers['Refresh'] = '2'
+        elif job['state'] == 'running':
+            state = u'The script is running (since {0}).'.format(
+                time.strftime('%H:%M:%S', time.localtime(job['started'])))
+            msg = HTML_JOB_PENDING.format(state=state)
+            headers['Refresh'] = '2'
+        elif job['state'] == 'lost':
+            msg = u'<span class="error">The job was lost, because the ' \
+                  u'server process that ran it stopped.</span>'
+        else:
+            if job['exitcode'] != 0:
+                name, output = 'stderr', 'error'
+            else:
+                name, output = 'stdout', job['output']
+            captured = runscript.load_output(
+                self.jobs.store.path(job_id, name), self.capture_size)
+            try:
+                msg = self.render_output(
+                    captured, output, username,
+                    download='job_output?job_id={0}&name={1}'.format(job_id,
+                                                                     name))
+            finally:
+                captured.close()
+
+        output = self.render_page(
+            form_config,
+            HTML_SUBMIT_RESPONSE,
+            title=job['title'],
+            form_name=job['form_name'],
+            msg=msg,
+        )
+        self.timer.lap('render')
+        self.respond(output, headers=headers)
+
+    def h_job_output(self, job_id, name='stdout'):
+        """
+        Serve the complete stdout or stderr (`name`) of a finished job.
+        """
+        username = self.auth()
+        job = self.get_job(job_id, username)
+        path = self.jobs.store.path(job_id, name)
+        if job['state'] != 'done' or name not in ('stdout', 'stderr') or \
+           not os.path.isfile(path):
+            raise HTTPError(404, "Not found")
+        headers = {
+            'Content-Disposition': 'attachment; filename="{0}.txt"'.format(
+                name),
+            'Cache-Control': 'private, no-cache',
+        }
+        self.send_file(path, 'text/plain; charset=utf-8', headers=headers)
+
+    def h_style(self, v=None):
+        """
+        Serve the stylesheet. If it's requested with the fingerprint `v` of
+        the current stylesheet, as pages do, it may be cached forever, since
+        a changed stylesheet gets a different URL. It's served without
+        authentication, since it contains nothing but styling.
+        """
+        chrome = self.get_chrome(self.scriptform.get_form_config())
+        if v == chrome.css_hash:
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = 'no-cache'
+        self.respond(chrome.css, content_type='text/css; charset=utf-8',
+                     headers={'Cache-Control': cache_control})
 
     def h_static(self, fname):
         """Serve static files"""
@@ -472,10 +1015,35 @@ class ScriptFormWebApp(RequestHandler):
             raise HTTPError(403, "Invalid file name")
 
         path = os.path.join(form_config.static_dir, fname)
-        if not os.path.exists(path):
+        # Files that are only served to authenticated users mustn't be kept
+        # by shared caches such as proxies.
+        if form_config.auth_backend is None:
+            headers = {'Cache-Control': 'public, no-cache'}
+        else:
+            headers = {'Cache-Control': 'private, no-cache'}
+        if self.static_cache is not None:
+            cached = self.static_cache.get(path)
+            if cached is not None:
+                self.send_cached_file(cached, headers)
+                return
+
+        if not os.path.isfile(path):
             raise HTTPError(404, "Not found")
 
-        static_file = file(path, 'r')
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(static_file.read())
+        self.send_file(path, headers=headers)
+
+    def h_metrics(self):
+        """
+        Serve the server's metrics in the Prometheus text format.
+        """
+        if not self.metrics_enabled:
+            raise HTTPError(404, "Not found")
+        username = self.auth()
+
+        form_config = self.scriptform.get_form_config()
+        if form_config.metrics_users is not None and \
+           username not in form_config.metrics_users:
+            raise HTTPError(403, "You're not authorized to view metrics")
+
+        self.respond(metrics.REGISTRY.expose(),
+                     content_type='text/plain; version=0.0.4')
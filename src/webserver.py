@@ -6,7 +6,342 @@ from SocketServer import ThreadingMixIn
 import BaseHTTPServer
 from BaseHTTPServer import BaseHTTPRequestHandler
 import urlparse
-import cgi
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import Queue
+import collections
+import contextlib
+import zlib
+import ctypes
+import ctypes.util
+import email.utils
+import errno
+import mimetypes
+import sys
+
+import formdata
+import metrics
+import timing
+from watchdog import WATCHDOG
+
+
+log = logging.getLogger('WEBSERVER')
+
+REQUESTS = metrics.Counter(
+    'scriptform_http_requests_total',
+    "HTTP requests handled, by route, method and status code.",
+    ('route', 'method', 'status'))
+REQUEST_DURATION = metrics.Histogram(
+    'scriptform_http_request_duration_seconds',
+    "Time taken to handle HTTP requests, by route.",
+    ('route', ))
+REQUESTS_IN_FLIGHT = metrics.Gauge(
+    'scriptform_http_requests_in_flight',
+    "HTTP requests currently being handled.")
+
+# Max bytes of a rejected request's body to read before closing the connection
+DISCARD_LIMIT = 1024 * 1024
+
+# Content types that are worth compressing.
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'image/svg+xml')
+
+# Content codings we can compress with, in order of preference.
+CONTENT_CODINGS = ('gzip', 'deflate')
+
+# Bodies up to this size are sent in the same write as the headers.
+COALESCE_MAX = 64 * 1024
+
+HTTP_503 = (
+    'HTTP/1.0 503 Service Unavailable\r\n'
+    'Content-Type: text/plain\r\n'
+    'Content-Length: {length}\r\n'
+    'Retry-After: {retry_after}\r\n'
+    'Connection: close\r\n'
+    '\r\n'
+    '{body}'
+)
+
+
+def http_methods(*methods):
+    """
+    Decorator for the h_ methods of a RequestHandler that sets which HTTP
+    methods the route accepts. By default, routes accept GET and HEAD.
+    """
+    def decorator(method_cb):
+        """
+        Set the allowed methods on the route's method.
+        """
+        method_cb.http_methods = methods
+        return method_cb
+    return decorator
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Return the content coding from CONTENT_CODINGS that's acceptable according
+    to the `accept_encoding` header value, or None if none of them are.
+    """
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        qvalue = 1.0
+        for param in params[1:]:
+            param_k, _, param_v = param.partition('=')
+            if param_k.strip() == 'q':
+                try:
+                    qvalue = float(param_v)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[params[0].strip().lower()] = qvalue
+
+    for coding in CONTENT_CODINGS:
+        if qvalues.get(coding, qvalues.get('*', 0.0)) > 0.0:
+            return coding
+    return None
+
+
+def compressor_for(coding, level=6):
+    """
+    Return a zlib compressor for content coding `coding` ('gzip' or
+    'deflate').
+    """
+    if coding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS  # gzip header and trailer
+    else:
+        wbits = zlib.MAX_WBITS  # 'deflate' means the zlib format
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def compress(pieces, coding, level=6):
+    """
+    Compress the strings in the iterable `pieces` with content coding
+    `coding` ('gzip' or 'deflate'). This is a generator which yields the
+    compressed data as it's produced, so the compressed body is never held
+    in memory in its entirety.
+    """
+    compressor = compressor_for(coding, level)
+    for piece in pieces:
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def etag_matches(etag, if_none_match):
+    """
+    Return whether `etag` matches the value of an If-None-Match header. Weak
+    and strong entity tags are compared alike, as that header requires.
+    """
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    if '*' in tags:
+        return True
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for tag in tags:
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def parse_http_date(value):
+    """
+    Return the HTTP date `value` as a Unix timestamp, or None if it's not a
+    valid date.
+    """
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def guess_type(path):
+    """
+    Guess the Content-Type of the file at `path` from its extension.
+    Compressed files such as 'foo.tar.gz' are served as they are, so their
+    type is unknown.
+    """
+    content_type, encoding = mimetypes.guess_type(path)
+    if content_type is None or encoding is not None:
+        return 'application/octet-stream'
+    return content_type
+
+
+def file_etag(size, mtime):
+    """
+    Return a strong ETag for a file of `size` bytes last modified at `mtime`.
+    """
+    return '"{0:x}-{1:x}"'.format(size, int(mtime * 1000000))
+
+
+def _load_sendfile():
+    """
+    Return Linux's sendfile(2) system call from the C library, or None if
+    it's not available. Python 2 has no os.sendfile().
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = (ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    func.restype = ctypes.c_ssize_t
+    return func
+
+
+LIBC_SENDFILE = _load_sendfile()
+
+
+def sendfile(sock, fileobj, offset, count):
+    """
+    Send `count` bytes of the open file `fileobj`, starting at `offset`, to
+    the socket `sock`. With sendfile(2), the kernel copies the data straight
+    from the file to the socket. Otherwise, it's copied in chunks of 64 KiB.
+    Returns the number of bytes that couldn't be sent because the file
+    turned out to be shorter.
+    """
+    if LIBC_SENDFILE is None:
+        fileobj.seek(offset)
+        while count > 0:
+            buf = fileobj.read(min(count, 64 * 1024))
+            if not buf:
+                break
+            sock.sendall(buf)
+            count -= len(buf)
+        return count
+
+    pos = ctypes.c_int64(offset)
+    while count > 0:
+        sent = LIBC_SENDFILE(sock.fileno(), fileobj.fileno(),
+                             ctypes.byref(pos), count)
+        if sent == 0:
+            break
+        if sent < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err != errno.EAGAIN:
+                raise socket.error(err, os.strerror(err))
+            # Sockets with a timeout are non-blocking underneath.
+            if not select.select([], [sock], [], sock.gettimeout())[1]:
+                raise socket.timeout("timed out")
+            continue
+        count -= sent
+    return count
+
+
+def parse_range(range_header, size):
+    """
+    Parse the value of a Range header for a resource of `size` bytes. Returns
+    the (first, last) byte positions of the range, None if the header should
+    be ignored, or False if the range can't be satisfied. Only single byte
+    ranges are supported; for multiple ranges, the header is ignored and the
+    whole resource is sent.
+    """
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    try:
+        if not sep:
+            return None
+        if not first:
+            # Suffix range: the last `last` bytes.
+            length = int(last)
+            if length <= 0:
+                return False
+            return (max(size - length, 0), size - 1)
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if first >= size:
+        return False
+    if first > last:
+        return None
+    return (first, min(last, size - 1))
+
+
+def iter_slices(body, size=64 * 1024):
+    """
+    Yield `body` in slices of at most `size` bytes.
+    """
+    for offset in xrange(0, len(body), size):
+        yield body[offset:offset + size]
+
+
+class ResponseStream(object):
+    """
+    The body of a response of unknown length, which is sent piece by piece
+    as the pieces become available. See RequestHandler.start_stream().
+
+    If the client goes away halfway, the rest of the body is discarded, so
+    that whatever produces it can finish normally.
+    """
+    def __init__(self, handler, chunked, coding=None):
+        self.handler = handler
+        self.chunked = chunked
+        self.compressor = None
+        if coding is not None:
+            self.compressor = compressor_for(coding)
+        self.discard = handler.command == 'HEAD'
+
+    def write(self, data):
+        """
+        Send `data` to the client right away.
+        """
+        if self.compressor is not None:
+            # Flush, so the client doesn't have to wait for more data before
+            # it can decompress this.
+            data = (self.compressor.compress(data) +
+                    self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._send(data)
+
+    def close(self):
+        """
+        Finish the body.
+        """
+        if self.compressor is not None:
+            self._send(self.compressor.flush())
+        if self.chunked:
+            self._send('0\r\n\r\n', True)
+        else:
+            self._send('', True)
+
+    def abort(self):
+        """
+        Stop sending the body without finishing it, and close the connection
+        afterwards, so that the client can tell the body is incomplete.
+        """
+        self.discard = True
+        self.handler.close_connection = 1
+
+    def _send(self, data, last=False):
+        """
+        Send `data`, framed as a chunk if needed.
+        """
+        if self.discard or (not data and not last):
+            return
+        if self.chunked and not last:
+            data = '{0:x}\r\n{1}\r\n'.format(len(data), data)
+        try:
+            self.handler.send_body(data)
+        except socket.error as err:
+            log.warning("Client went away while streaming: {0}".format(err))
+            self.handler.close_connection = 1
+            self.discard = True
 
 
 class HTTPError(Exception):
@@ -30,12 +365,629 @@ class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
     pass
 
 
+class ThreadPoolHTTPServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server that handles requests with a fixed number of worker threads.
+    Accepted connections are put on a bounded queue from which the workers
+    pick them up. If the queue is full, the connection is answered with a
+    '503 Service Unavailable' straight away instead of piling up more work.
+    """
+    retry_after = 5
+
+    def __init__(self, server_address, request_handler_class, threads=10,
+                 queue_size=50):
+        # Set before binding, which calls server_close() if it fails.
+        self.threads = threads
+        self.request_queue = Queue.Queue(queue_size)
+        self.workers = []
+        BaseHTTPServer.HTTPServer.__init__(self, server_address,
+                                           request_handler_class)
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Start the worker threads and handle requests until shutdown. The
+        threads are started here rather than in the constructor, so that the
+        server can be created before forking worker processes.
+        """
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        BaseHTTPServer.HTTPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        """
+        Queue the request for one of the worker threads, or reject it if the
+        queue is full.
+        """
+        try:
+            self.request_queue.put_nowait((request, client_address))
+        except Queue.Full:
+            self.reject_request(request, client_address)
+
+    def reject_request(self, request, client_address):
+        """
+        Answer the request with a 503 and close the connection without handing
+        it to a worker.
+        """
+        log.warning("Request queue full. Rejecting request from "
+                    "{0}".format(client_address[0]))
+        body = "Error 503: Server busy, please try again later"
+        response = HTTP_503.format(length=len(body),
+                                   retry_after=self.retry_after,
+                                   body=body)
+        try:
+            # Drain whatever part of the request has already arrived, so that
+            # closing the socket doesn't reset the connection before the client
+            # has read our response.
+            request.setblocking(0)
+            try:
+                request.recv(65536)
+            except socket.error:
+                pass
+            request.setblocking(1)
+            request.sendall(response)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def _worker(self):
+        """
+        Worker thread main loop. Handle queued requests until a `None`
+        request is received.
+        """
+        while True:
+            request, client_address = self.request_queue.get()
+            if request is None:
+                break
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """
+        Close the listening socket and the connections that are still queued,
+        and stop the worker threads once they've finished their requests.
+        """
+        BaseHTTPServer.HTTPServer.server_close(self)
+        while True:
+            try:
+                request, _ = self.request_queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is not None:
+                self.shutdown_request(request)
+        for _ in self.workers:
+            try:
+                self.request_queue.put_nowait((None, None))
+            except Queue.Full:
+                # More workers than room in the queue. The workers that
+                # don't get to stop are daemon threads.
+                break
+
+
+class EventHTTPServer(ThreadPoolHTTPServer):
+    """
+    HTTP server that keeps connections which are waiting for a request in a
+    single poll loop, instead of tying up a worker thread for each of them.
+    Once a request comes in on a connection, it's handed to the worker pool.
+    After the response, keep-alive connections are parked in the poll loop
+    again. This lets the server hold many idle connections with only a small
+    number of threads. Connections that stay idle for more than
+    `idle_timeout` seconds are closed.
+
+    Connections handed to a worker get a read timeout of `idle_timeout`
+    seconds too, unless the request handler sets its own `timeout`. Otherwise
+    a client that stalls halfway through its request would tie up the worker
+    forever.
+    """
+    def __init__(self, server_address, request_handler_class, threads=10,
+                 queue_size=50, idle_timeout=15):
+        self.idle_timeout = idle_timeout
+        self.idle_lock = threading.Lock()
+        self.parking = {}
+        self.parked = []
+        self.stopping = False
+        self.wakeup_r, self.wakeup_w = None, None
+        self.poller = None
+        ThreadPoolHTTPServer.__init__(self, server_address,
+                                      request_handler_class,
+                                      threads=threads,
+                                      queue_size=queue_size)
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Start the poll loop and worker threads and handle requests until
+        shutdown.
+        """
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poller = threading.Thread(target=self._poll_loop)
+        self.poller.daemon = True
+        self.poller.start()
+        ThreadPoolHTTPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        """
+        Park newly accepted connections until they have sent a request.
+        """
+        self._park(request, client_address)
+
+    def park_request(self, request, client_address):
+        """
+        Called by a request handler to indicate that the connection should be
+        kept open and parked in the poll loop once the handler is done.
+        """
+        with self.idle_lock:
+            self.parking[request] = client_address
+
+    def shutdown_request(self, request):
+        """
+        Close the connection, unless the request handler asked for it to be
+        parked.
+        """
+        with self.idle_lock:
+            client_address = self.parking.pop(request, None)
+        if client_address is not None:
+            self._park(request, client_address)
+        else:
+            ThreadPoolHTTPServer.shutdown_request(self, request)
+
+    def _park(self, request, client_address):
+        """
+        Hand a connection to the poll loop.
+        """
+        with self.idle_lock:
+            self.parked.append((request, client_address))
+        os.write(self.wakeup_w, 'x')
+
+    def _poll_loop(self):
+        """
+        Poll loop main loop. Wait for parked connections to become readable
+        and queue them for the worker threads, or close them once they've
+        been idle for too long.
+        """
+        poller = select.poll()
+        poller.register(self.wakeup_r, select.POLLIN)
+        # Connections are parked with the same timeout, so insertion order is
+        # also the order in which they expire.
+        idle = collections.OrderedDict()
+
+        while True:
+            timeout = None
+            if idle:
+                first_deadline = idle.itervalues().next()[2]
+                timeout = max(0, (first_deadline - time.time()) * 1000)
+            try:
+                events = poller.poll(timeout)
+            except select.error:
+                continue
+
+            for fdescriptor, _ in events:
+                if fdescriptor == self.wakeup_r:
+                    os.read(self.wakeup_r, 4096)
+                    continue
+                request, client_address, _ = idle.pop(fdescriptor)
+                poller.unregister(fdescriptor)
+                request.settimeout(self.idle_timeout)
+                ThreadPoolHTTPServer.process_request(self, request,
+                                                     client_address)
+
+            with self.idle_lock:
+                parked, self.parked = self.parked, []
+            deadline = time.time() + self.idle_timeout
+            for request, client_address in parked:
+                fdescriptor = request.fileno()
+                idle[fdescriptor] = (request, client_address, deadline)
+                poller.register(fdescriptor, select.POLLIN)
+
+            now = time.time()
+            while idle and (self.stopping or
+                            idle.itervalues().next()[2] <= now):
+                fdescriptor, (request, _, _) = idle.popitem(last=False)
+                poller.unregister(fdescriptor)
+                ThreadPoolHTTPServer.shutdown_request(self, request)
+
+            if self.stopping:
+                break
+
+    def server_close(self):
+        """
+        Close the listening socket, all idle connections and stop the threads.
+        """
+        if self.poller is not None:
+            self.stopping = True
+            os.write(self.wakeup_w, 'x')
+            self.poller.join()
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+        ThreadPoolHTTPServer.server_close(self)
+
+
 class RequestHandler(BaseHTTPRequestHandler):
     """
     Basic web server request handler. Handles GET and POST requests. You should
     inherit from this class and implement h_ methods for handling requests.
     If no path is set, it dispatches to the 'index' or 'default' method.
     """
+    routes = None
+    # Normal fields of a submitted form are kept in memory up to this size.
+    max_field_size = 1024 * 1024
+    # Larger fields are spilled to disk up to this size, or rejected if it's
+    # None.
+    max_spill_size = None
+    # Uploaded files are written to disk in chunks of this size.
+    upload_chunk_size = 64 * 1024
+    # formdata.UploadBudget shared by all requests, or None for no limit.
+    upload_budget = None
+    # Responses of at least this many bytes are compressed if the client
+    # accepts it. None disables compression.
+    compress_min_size = 1024
+    # Whether to report the phases of requests in a Server-Timing header.
+    server_timing = False
+    # Whether to write the phases of requests to timing.TRACE_LOG.
+    trace = False
+    # profiling.Profiler for requests, or None. Requests are only profiled
+    # while it's enabled.
+    profiler = None
+    # Send small writes right away. Responses are written in as few writes as
+    # possible, so there's nothing for Nagle's algorithm to gain.
+    disable_nagle_algorithm = True
+    # The ResponseStream of the current request, once start_stream() has
+    # sent the headers.
+    response_stream = None
+
+    @classmethod
+    def get_routes(cls):
+        """
+        Return the table which maps request paths to the methods handling
+        them, and the HTTP methods those accept. The table is built once per
+        class, so that requests don't have to look up methods by name. The
+        `None` key holds the 'default' method, if there is one.
+        """
+        if cls.__dict__.get('routes') is None:
+            routes = {}
+            for attr_name in dir(cls):
+                method_cb = getattr(cls, attr_name)
+                if attr_name.startswith('h_') and callable(method_cb):
+                    routes[attr_name[2:]] = method_cb
+            if 'index' in dir(cls) and '' not in routes:
+                routes[''] = getattr(cls, 'index')
+            if 'default' in dir(cls):
+                routes[None] = getattr(cls, 'default')
+            cls.routes = dict(
+                (path, (method_cb,
+                        getattr(method_cb, 'http_methods', ('GET', 'HEAD'))))
+                for path, method_cb in routes.items()
+            )
+        return cls.routes
+
+    def respond(self, body, status=200, content_type='text/html',
+                headers=None):
+        """
+        Send a complete response with `body` as its content. The length of
+        the body is always sent along, so that the connection can be reused
+        for further requests if the client and server support keep-alive.
+
+        Textual bodies of at least `compress_min_size` bytes are compressed
+        if the client accepts it. Since their length isn't known in advance,
+        they're sent with chunked transfer coding if possible.
+        """
+        if headers is None:
+            headers = {}
+        if self.server_timing:
+            headers['Server-Timing'] = self.timer.server_timing()
+        coding = None
+        compressible = (content_type is not None and
+                        self.compress_min_size is not None and
+                        content_type.startswith(COMPRESSIBLE_TYPES))
+        if compressible:
+            vary = headers.get('Vary')
+            if vary is None:
+                headers['Vary'] = 'Accept-Encoding'
+            elif 'Accept-Encoding' not in vary:
+                headers['Vary'] = vary + ', Accept-Encoding'
+            if len(body) >= self.compress_min_size:
+                coding = negotiate_encoding(
+                    self.headers.get('accept-encoding', ''))
+
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header('Content-Type', content_type)
+        for header_k, header_v in headers.items():
+            self.send_header(header_k, header_v)
+        if coding is None:
+            self.send_header('Content-Length', len(body))
+            self._end_headers()
+            if self.command == 'HEAD':
+                self.send_body('')
+            elif len(body) <= COALESCE_MAX:
+                self.send_body(body)
+            else:
+                # Not worth copying the body just to save a write.
+                self.send_body('')
+                self.wfile.write(body)
+        else:
+            self.send_header('Content-Encoding', coding)
+            self.send_stream(compress(iter_slices(body), coding))
+
+    def not_modified(self, headers):
+        """
+        If the client already has the version of the requested resource
+        identified by headers['ETag'] or headers['Last-Modified'], according
+        to its If-None-Match or If-Modified-Since header, answer with a 304
+        Not Modified and return True. The other `headers` that describe that
+        version, such as Cache-Control, are sent along. Otherwise return
+        False, so that the caller can send the full response with the same
+        `headers`.
+        """
+        if self.command not in ('GET', 'HEAD'):
+            return False
+        if_none_match = self.headers.get('if-none-match')
+        if_modified_since = self.headers.get('if-modified-since')
+        if if_none_match is not None:
+            # If-None-Match takes precedence over If-Modified-Since.
+            if 'ETag' not in headers or \
+               not etag_matches(headers['ETag'], if_none_match):
+                return False
+        elif if_modified_since is not None and 'Last-Modified' in headers:
+            since = parse_http_date(if_modified_since)
+            modified = parse_http_date(headers['Last-Modified'])
+            if since is None or modified is None or modified > since:
+                return False
+        else:
+            return False
+        if self.server_timing:
+            headers['Server-Timing'] = self.timer.server_timing()
+        self.send_response(304)
+        for header_k, header_v in headers.items():
+            self.send_header(header_k, header_v)
+        self.end_headers()
+        return True
+
+    def send_file(self, path, content_type=None, headers=None):
+        """
+        Send the file at `path` as the response. It's sent with sendfile(),
+        so it's never read into memory. If `content_type` isn't given, it's
+        guessed from the file name. Extra `headers` are sent along with the
+        file's ETag and Last-Modified headers.
+
+        Conditional requests are answered with a 304 if the file hasn't
+        changed (see not_modified()). A single range of bytes of the file can
+        be requested with a Range header, which is honoured only if the
+        file's ETag or modification date matches the If-Range header, if
+        any.
+        """
+        with open(path, 'rb') as fileobj:
+            fstat = os.fstat(fileobj.fileno())
+            if content_type is None:
+                content_type = guess_type(path)
+
+            def send_range(first, count):
+                """
+                Send the headers, then the range straight from the file.
+                """
+                self.send_body('')
+                if sendfile(self.connection, fileobj, first, count):
+                    # The file shrunk while sending it. The client is still
+                    # waiting for the rest, so the connection can't be
+                    # reused.
+                    self.close_connection = 1
+
+            self._send_entity(fstat.st_size, fstat.st_mtime,
+                              file_etag(fstat.st_size, fstat.st_mtime),
+                              content_type, headers, send_range)
+
+    def send_cached_file(self, cached, headers=None):
+        """
+        Send a filecache.CachedFile from memory, like send_file() does for
+        files on disk. If it has a gzipped version and the client accepts
+        gzip, that's sent instead, unless a range was requested.
+        """
+        if headers is None:
+            headers = {}
+        data = cached.data
+        etag = cached.etag
+        if cached.gzip_data is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            coding = negotiate_encoding(self.headers.get('accept-encoding',
+                                                         ''))
+            if coding == 'gzip' and 'range' not in self.headers:
+                data = cached.gzip_data
+                etag = cached.gzip_etag
+                headers['Content-Encoding'] = 'gzip'
+
+        def send_range(first, count):
+            """
+            Send the headers along with the range, if it's small.
+            """
+            if count <= COALESCE_MAX:
+                self.send_body(data[first:first + count])
+            else:
+                self.send_body('')
+                self.wfile.write(buffer(data, first, count))
+
+        self._send_entity(len(data), cached.mtime, etag, cached.content_type,
+                          headers, send_range)
+
+    def _send_entity(self, size, mtime, etag, content_type, headers,
+                     send_range):
+        """
+        Respond with (a range of) an entity of `size` bytes, which was last
+        modified at `mtime`. See send_file(). Once the status and headers
+        are buffered, send_range(first, count) is called to send them along
+        with `count` bytes of the entity from position `first`.
+        """
+        if headers is None:
+            headers = {}
+        headers['ETag'] = etag
+        headers['Last-Modified'] = self.date_time_string(int(mtime))
+        if self.not_modified(headers):
+            return
+
+        status = 200
+        first, last = 0, size - 1
+        range_header = self.headers.get('range')
+        if_range = self.headers.get('if-range')
+        if range_header is not None and self.command == 'GET' and \
+           if_range in (None, headers['ETag'], headers['Last-Modified']):
+            byte_range = parse_range(range_header, size)
+            if byte_range is False:
+                headers['Content-Range'] = 'bytes */{0}'.format(size)
+                raise HTTPError(416, "Requested range not satisfiable",
+                                headers)
+            if byte_range is not None:
+                status = 206
+                first, last = byte_range
+                headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                    first, last, size)
+        headers['Accept-Ranges'] = 'bytes'
+        if self.server_timing:
+            headers['Server-Timing'] = self.timer.server_timing()
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', last - first + 1)
+        for header_k, header_v in headers.items():
+            self.send_header(header_k, header_v)
+        self._end_headers()
+        if self.command == 'HEAD':
+            self.send_body('')
+        else:
+            send_range(first, last - first + 1)
+
+    def send_stream(self, pieces):
+        """
+        Finish the headers and send the strings in the iterable `pieces` as
+        the body of a response of unknown length. See start_stream().
+        """
+        stream = self.start_stream()
+        for piece in pieces:
+            stream.write(piece)
+        stream.close()
+
+    def start_stream(self, coding=None):
+        """
+        Finish the headers and return a ResponseStream with which the body of
+        a response of unknown length can be sent. If the client supports it,
+        the body is sent with chunked transfer coding so the connection can
+        be reused. Otherwise the end of the body is signalled by closing the
+        connection. If `coding` is given, the body is compressed with it.
+        """
+        chunked = (self.protocol_version >= 'HTTP/1.1' and
+                   self.request_version >= 'HTTP/1.1')
+        if coding is not None:
+            self.send_header('Content-Encoding', coding)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self._end_headers()
+        if self.command == 'HEAD':
+            self.send_body('')
+        # The headers go out along with the first piece.
+        self.response_stream = ResponseStream(self, chunked, coding)
+        return self.response_stream
+
+    def setup(self):
+        """
+        Prepare the handler for a connection.
+        """
+        BaseHTTPRequestHandler.setup(self)
+        self._headers_buffer = []
+
+    def send_response(self, code, message=None):
+        """
+        Overrides BaseHTTPRequestHandler, which writes the status line to the
+        socket immediately. We buffer it along with the headers, so that the
+        entire header block is sent in a single write.
+        """
+        self.log_request(code)
+        self.status = code
+        if message is None:
+            if code in self.responses:
+                message = self.responses[code][0]
+            else:
+                message = ''
+        if self.request_version != 'HTTP/0.9':
+            self._headers_buffer.append("{0} {1} {2}\r\n".format(
+                self.protocol_version, code, message))
+        self.send_header('Server', self.version_string())
+        self.send_header('Date', self.date_time_string())
+
+    def send_header(self, keyword, value):
+        """
+        Overrides BaseHTTPRequestHandler to buffer the header instead of
+        writing it to the socket immediately.
+        """
+        if self.request_version != 'HTTP/0.9':
+            self._headers_buffer.append("{0}: {1}\r\n".format(keyword,
+                                                              value))
+        if keyword.lower() == 'connection':
+            if value.lower() == 'close':
+                self.close_connection = 1
+            elif value.lower() == 'keep-alive':
+                self.close_connection = 0
+
+    def end_headers(self):
+        """
+        Finish the headers and send them, for handlers that write the body to
+        self.wfile themselves.
+        """
+        self._end_headers()
+        self.send_body('')
+
+    def _end_headers(self):
+        """
+        Buffer the blank line that ends the headers.
+        """
+        if self.request_version != 'HTTP/0.9':
+            self._headers_buffer.append('\r\n')
+
+    def send_body(self, data):
+        """
+        Write `data` to the client. Status line and headers that haven't been
+        sent yet are written along with it in a single write.
+        """
+        if self._headers_buffer:
+            self._headers_buffer.append(data)
+            data = ''.join(self._headers_buffer)
+            self._headers_buffer = []
+        if data:
+            self.wfile.write(data)
+
+    def send_http_error(self, err):
+        """
+        Send the HTTPError `err` to the client.
+        """
+        if err.status_code not in (303, 401):
+            self.scriptform.log.exception(err)
+        self.respond("Error {0}: {1}".format(err.status_code, err.msg),
+                     status=err.status_code,
+                     content_type='text/plain',
+                     headers=err.headers)
+
+    def handle(self):
+        """
+        Handle requests on the connection until it's closed. If the server
+        supports it, a keep-alive connection is handed back to the server
+        after each request instead of blocking this thread until the client
+        sends the next one.
+        """
+        park_request = getattr(self.server, 'park_request', None)
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            # If the client has pipelined requests, they're already in our
+            # read buffer and polling the socket wouldn't notice them.
+            if park_request is not None and self.rfile._rbuf.tell() == 0:
+                park_request(self.request, self.client_address)
+                return
+            self.handle_one_request()
+
     def log_message(self, fmt, *args):
         """Overrides BaseHTTPRequestHandler which logs to the console. We log
         to our log file instead"""
@@ -46,17 +998,103 @@ class RequestHandler(BaseHTTPRequestHandler):
         """
         Handle a GET request.
         """
-        self._call(*self._parse(self.path))
+        with self._measure():
+            self._call(*self._parse(self.path))
+
+    def do_HEAD(self):
+        """
+        Handle a HEAD request. This is handled like a GET request, except
+        that no body is sent.
+        """
+        with self._measure():
+            self._call(*self._parse(self.path))
 
     def do_POST(self):
         """
-        Handle a POST request.
+        Handle a POST request. The form data in the body is parsed and passed
+        to the handler as `form_values`. Bodies that don't fit in the
+        `upload_budget` or are larger than max_body_size() allows are
+        rejected without reading them completely.
+        """
+        with self._measure():
+            self._post()
+
+    def _post(self):
+        """
+        Parse the form data of a POST request and call its handler.
+        """
+        try:
+            length = formdata.get_content_length(self.headers)
+        except formdata.FormDataError as err:
+            self._reject_body(HTTPError(err.status_code, err.msg))
+            return
+
+        budget = self.upload_budget
+        if budget is not None:
+            if length > budget.max_bytes:
+                self._reject_body(HTTPError(413, "Request body too large"))
+                return
+            if not budget.reserve(length):
+                self._reject_body(HTTPError(503, "Too many uploads",
+                                            {'Retry-After': '5'}))
+                return
+        try:
+            try:
+                form_values = formdata.parse(self.rfile, self.headers,
+                                             self.max_field_size,
+                                             self.upload_chunk_size,
+                                             self.max_body_size,
+                                             self.max_spill_size)
+            except formdata.FormDataError as err:
+                self._reject_body(HTTPError(err.status_code, err.msg))
+                return
+            if budget is not None:
+                # The form data releases the reservation from now on, so that
+                # it can be handed over along with the uploads.
+                form_values.budget = budget
+                form_values.reserved = length
+                budget = None
+            self.timer.lap('parse')
+            try:
+                path = self._parse(self.path)[0]
+                self._call(path, params={'form_values': form_values})
+            finally:
+                form_values.cleanup()
+                form_values.release()
+        finally:
+            if budget is not None:
+                budget.release(length)
+
+    def max_body_size(self, form_values):
+        """
+        Return the maximum size of a POST request's body, or None if there's
+        no limit. This is called before the body is read and again after each
+        form field, with the FormData parsed so far. Override this to impose
+        limits that depend on the submitted form.
         """
-        form_values = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={'REQUEST_METHOD': 'POST'})
-        self._call(self.path.strip('/'), params={'form_values': form_values})
+        return None
+
+    def _reject_body(self, err):
+        """
+        Send the HTTPError `err` in response to a request whose body hasn't
+        been read (completely) and close the connection. Some of what the
+        client is still sending is read and discarded, since closing a socket
+        with unread data resets the connection, possibly before the client
+        has read the response.
+        """
+        err.headers['Connection'] = 'close'
+        self.send_http_error(err)
+        try:
+            self.connection.shutdown(socket.SHUT_WR)
+            self.connection.settimeout(1)
+            discarded = 0
+            while discarded < DISCARD_LIMIT:
+                buf = self.connection.recv(64 * 1024)
+                if not buf:
+                    break
+                discarded += len(buf)
+        except socket.error:
+            pass
 
     def _parse(self, reqinfo):
         """
@@ -70,45 +1108,127 @@ class RequestHandler(BaseHTTPRequestHandler):
         var_values = dict([(k, v[0]) for k, v in query_vars.items()])
         return (path.strip('/'), var_values)
 
+    def get_cookie(self, name):
+        """
+        Return the value of the cookie `name` that the client sent along
+        with the request, or None if it didn't.
+        """
+        cookie_header = self.headers.get('cookie')
+        if cookie_header is None:
+            return None
+        for cookie in cookie_header.split(';'):
+            cookie_name, sep, value = cookie.strip().partition('=')
+            if sep and cookie_name == name:
+                return value.strip('"')
+        return None
+
+    def _route(self, path):
+        """
+        Find the method that handles requests for `path`. This is the method
+        in the form 'h_<PATH>'. If no path was given, it's the 'index'
+        method. If no method could be found but a `default` method exists,
+        that's returned. Otherwise a 404 HTTPError is raised. If the method
+        doesn't accept the request's HTTP method, a 405 is raised.
+        """
+        routes = self.routes or self.get_routes()
+        route = routes.get(path)
+        if route is None:
+            route = routes.get(None)
+            if route is None:
+                raise HTTPError(404, "Not found")
+        method_cb, http_methods = route
+        if self.command not in http_methods:
+            headers = {'Allow': ', '.join(http_methods)}
+            raise HTTPError(405, "Method not allowed", headers)
+        return method_cb
+
+    def route_name(self, path):
+        """
+        Return the name under which requests for `path` are counted: the
+        route's path, or 'other' for paths without a route of their own.
+        """
+        routes = self.routes or self.get_routes()
+        if path in routes:
+            return '/' + path
+        return 'other'
+
+    def profile_key(self, path, params):
+        """
+        Return the key under which the profile of a request for `path` is
+        recorded. Override this to profile requests in more detail.
+        """
+        return self.route_name(path)
+
+    @contextlib.contextmanager
+    def _measure(self):
+        """
+        Count the request and measure how long it takes, per route. Handlers
+        can record the phases of the request with self.timer.lap(). While
+        it's being handled, the request is registered with the WATCHDOG.
+        """
+        self.timer = timing.Timer()
+        self.status = None
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            with WATCHDOG.track(self.command, self.path,
+                                self.client_address[0]):
+                yield
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            path = self._parse(self.path)[0]
+            route = self.route_name(path)
+            REQUEST_DURATION.observe(time.time() - self.timer.start,
+                                     (route, ))
+            REQUESTS.inc((route, self.command, str(self.status or '')))
+            if self.trace:
+                timing.TRACE_LOG.info(self.timer.trace(
+                    method=self.command, path='/' + path, route=route,
+                    status=self.status))
+
     def _call(self, path, params):
         """
-        Find a method to call on self.app_class based on `path` and call it.
-        The method that's called is in the form 'h_<PATH>'. If no path was
-        given, it will try to call the 'index' method. If no method could be
-        found but a `default` method exists, it is called. Otherwise 404 is
-        sent.
+        Find a method to handle `path` (see _route()) and call it.
 
         Methods should take care of sending proper headers and content
-        themselves using self.send_response(), self.send_header(),
-        self.end_header() and by writing to self.wfile.
+        themselves, either by using self.respond() or by using
+        self.send_response(), self.send_header(), self.end_header() and
+        writing to self.wfile. In the latter case, they must take care of
+        setting a Content-Length or closing the connection themselves.
+
+        While the `profiler` is enabled, the call is profiled.
         """
-        method_name = 'h_{0}'.format(path)
-        method_cb = None
+        profiler = self.profiler
+        if profiler is None or not profiler.enabled:
+            return self._dispatch(path, params)
+        with profiler.profile(self.profile_key(path, params)):
+            return self._dispatch(path, params)
+
+    def _dispatch(self, path, params):
+        """
+        Route the request and call its method. See _call().
+
+        Errors are sent to the client, unless the method already started
+        streaming its response. Such a response is cut off instead.
+        """
+        self.response_stream = None
         try:
-            if hasattr(self, method_name) and \
-               callable(getattr(self, method_name)):
-                method_cb = getattr(self, method_name)
-            elif path == '' and hasattr(self, 'index'):
-                method_cb = getattr(self, 'index')
-            elif hasattr(self, 'default'):
-                method_cb = getattr(self, 'default')
-            else:
-                raise HTTPError(404, "Not found")
-            method_cb(**params)
+            method_cb = self._route(path)
+            method_cb(self, **params)
         except HTTPError as err:
+            if self.response_stream is not None:
+                self.scriptform.log.exception(err)
+                self.response_stream.abort()
+                return False
             # HTTP erors are generally thrown by the webapp on purpose. Send
             # error to the browser.
-            if err.status_code not in (401, ):
-                self.scriptform.log.exception(err)
-            self.send_response(err.status_code)
-            for header_k, header_v in err.headers.items():
-                self.send_header(header_k, header_v)
-            self.end_headers()
-            self.wfile.write("Error {0}: {1}".format(err.status_code,
-                                                     err.msg))
-            self.wfile.flush()
+            self.send_http_error(err)
             return False
         except Exception as err:
             self.scriptform.log.exception(err)
+            if self.response_stream is not None:
+                self.response_stream.abort()
+                raise
+            # Drop headers of the failed response that weren't sent yet.
+            self._headers_buffer = []
             self.send_error(500, "Internal server error")
             raise
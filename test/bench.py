@@ -0,0 +1,151 @@
+"""
+Microbenchmarks for Scriptform internals. Run from the test directory:
+
+    $ python ./bench.py
+
+Where a benchmark measures an optimization, the previous implementation is
+reproduced here as the 'before' case so both can be compared on the same
+machine.
+"""
+
+import sys
+import timeit
+
+sys.path.insert(0, '../src')
+import scriptform
+import webapp
+from webapp import ScriptFormWebApp
+from formrender import FormRender
+
+
+NUMBER = 100000
+REPEAT = 5
+
+
+class BenchHandler(ScriptFormWebApp):
+    """
+    Request handler that can be instantiated without a connection.
+    """
+    def __init__(self, command='GET'):
+        self.command = command
+
+
+def measure(func):
+    """
+    Return the best time of REPEAT runs of NUMBER calls to `func`.
+    """
+    return min(timeit.repeat(func, number=NUMBER, repeat=REPEAT))
+
+
+def report(name, before, after):
+    """
+    Print the time per call of the 'before' and 'after' cases.
+    """
+    before = measure(before)
+    after = measure(after)
+    fmt = "{0:<30} before: {1:9.3f} us   after: {2:9.3f} us   ({3:.1f}x)"
+    print fmt.format(name,
+                     before * 1000000.0 / NUMBER,
+                     after * 1000000.0 / NUMBER,
+                     before / after)
+
+
+def bench_route():
+    """
+    Resolve a request path to its handler method.
+    """
+    handler = BenchHandler()
+
+    def before_route(path):
+        method_name = 'h_{0}'.format(path)
+        if hasattr(handler, method_name) and \
+           callable(getattr(handler, method_name)):
+            return getattr(handler, method_name)
+        elif path == '' and hasattr(handler, 'index'):
+            return getattr(handler, 'index')
+        elif hasattr(handler, 'default'):
+            return getattr(handler, 'default')
+
+    for path in ('', 'form', 'static'):
+        report("route dispatch '{0}'".format(path),
+               lambda: before_route(path),
+               lambda: handler._route(path))
+
+
+def bench_render_field():
+    """
+    Look up the method that renders a field.
+    """
+    fr_inst = FormRender(None)
+
+    def before(field_type='string'):
+        return getattr(fr_inst, 'r_field_{0}'.format(field_type), None)
+
+    def after(field_type='string'):
+        return fr_inst.field_renderers[field_type]
+
+    report("field render dispatch", before, after)
+
+
+def bench_validate_field():
+    """
+    Look up a field definition and the method that validates it.
+    """
+    sf = scriptform.ScriptForm('test_webapp.json')
+    form_def = sf.get_form_config().get_form_def('validate')
+
+    def before(field_name='file'):
+        for field in form_def.fields:
+            if field['name'] == field_name:
+                field_def = field
+                break
+        return getattr(form_def, 'validate_{0}'.format(field_def['type']))
+
+    def after(field_name='file'):
+        form_def.get_field_def(field_name)
+        return form_def.field_validators[field_name]
+
+    report("field validate dispatch", before, after)
+
+
+def bench_render_page():
+    """
+    Render the list of forms, including the page's header and footer. Before,
+    the stylesheet was inlined in the header of every page.
+    """
+    sf = scriptform.ScriptForm('test_webapp.json')
+    form_config = sf.get_form_config()
+    handler = BenchHandler()
+    form_list = u''.join(
+        webapp.HTML_FORM_LIST.format(title=form_def.title,
+                                     description=form_def.description,
+                                     name=form_def.name)
+        for form_def in form_config.forms)
+    header = webapp.HTML_HEADER.replace(
+        u'  <link rel="stylesheet" type="text/css" href="style?v={css_hash}">',
+        u'  <style>\n' +
+        webapp.HTML_CSS.replace(u'{', u'{{').replace(u'}', u'}}') +
+        u'{custom_css}\n  </style>')
+    page = u'{header}' + webapp.HTML_LIST + u'{footer}'
+
+    def before():
+        return page.format(
+            header=header.format(title=form_config.title,
+                                 custom_css=form_config.custom_css or u''),
+            footer=webapp.HTML_FOOTER,
+            form_list=form_list).encode('utf8')
+
+    def after():
+        return handler.render_page(form_config, webapp.HTML_LIST,
+                                   form_list=form_list)
+
+    report("render page", before, after)
+    print "{0:<30} before: {1:6d} bytes  after: {2:6d} bytes".format(
+        "page size", len(before()), len(after()))
+
+
+if __name__ == '__main__':
+    bench_route()
+    bench_render_field()
+    bench_validate_field()
+    bench_render_page()
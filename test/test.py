@@ -6,10 +6,18 @@ import json
 import os
 import copy
 import thread
+import threading
 import time
 import requests
 import StringIO
 import re
+import Queue
+import shutil
+import socket
+import zlib
+import pstats
+import tempfile
+import subprocess
 
 
 class FormConfigTestCase(unittest.TestCase):
@@ -39,6 +47,12 @@ class FormConfigTestCase(unittest.TestCase):
         from formconfig import FormConfigError
         self.assertRaises(FormConfigError, scriptform.ScriptForm, 'test_formconfig_noexec.json')
 
+    def testNoCaptureSize(self):
+        """Running without capturing script output isn't supported"""
+        sf = scriptform.ScriptForm('test_formconfig_hidden.json')
+        self.assertRaises(scriptform.ScriptFormError, sf.run,
+                          listen_port=8002, capture_size=None)
+
     def testHidden(self):
         """Hidden forms should not show up in the list of forms"""
         sf = scriptform.ScriptForm('test_formconfig_hidden.json')
@@ -68,6 +82,49 @@ class FormConfigTestCase(unittest.TestCase):
         self.assertTrue(exitcode == 33)
         self.assertTrue('stdout' in stdout.read())
 
+    def testCallbackStream(self):
+        """Test a callback whose stdout is passed on while it runs"""
+        sf = scriptform.ScriptForm('test_formconfig_callback.json')
+        fc = sf.get_form_config()
+        fd = fc.get_form_def('test_store')
+        pieces = []
+        res = runscript.run_script(fd, {}, on_stdout=pieces.append)
+        self.assertEquals(res['exitcode'], 33)
+        self.assertEquals(res['stdout'], '')
+        self.assertTrue('stdout' in ''.join(pieces))
+        self.assertTrue('stderr' in res['stderr'])
+
+    def testCallbackStreamError(self):
+        """A failing stdout callback doesn't leave the script blocked"""
+        sf = scriptform.ScriptForm('test_webapp.json')
+        fd = sf.get_form_config().get_form_def('output_large')
+
+        def on_stdout(data):
+            raise IOError("Client went away")
+        start = time.time()
+        self.assertRaises(IOError, runscript.run_script, fd, {},
+                          on_stdout=on_stdout)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(runscript.SCRIPTS_RUNNING.values.get((), 0), 0)
+
+    def testCallbackCapture(self):
+        """Test a callback whose output is spooled to disk"""
+        sf = scriptform.ScriptForm('test_formconfig_callback.json')
+        fc = sf.get_form_config()
+        fd = fc.get_form_def('test_store')
+        res = runscript.run_script(fd, {}, capture_size=4)
+        try:
+            self.assertEquals(res['exitcode'], 33)
+            self.assertTrue(res['stdout'].spooled())
+            self.assertTrue(os.path.exists(res['stdout'].path))
+            self.assertTrue('stdout' in res['stdout'].getvalue())
+            self.assertTrue('stderr' in res['stderr'].getvalue())
+        finally:
+            path = res['stdout'].path
+            res['stdout'].cleanup()
+            res['stderr'].cleanup()
+        self.assertFalse(os.path.exists(path))
+
     def testCallbackMissingParams(self):
         """
         """
@@ -76,6 +133,47 @@ class FormConfigTestCase(unittest.TestCase):
         fd = fc.get_form_def('test_raw')
         self.assertRaises(ValueError, runscript.run_script, fd, {})
 
+    def testGeneration(self):
+        """Reloading an unchanged config should keep its generation"""
+        sf = scriptform.ScriptForm('test_formconfig_hidden.json', cache=False)
+        generation = sf.get_form_config().generation
+        self.assertEquals(sf.get_form_config().generation, generation)
+        sf.config_file = 'test_formconfig_callback.json'
+        self.assertNotEquals(sf.get_form_config().generation, generation)
+        # Generations are unique across instances.
+        sf2 = scriptform.ScriptForm('test_formconfig_hidden.json')
+        self.assertNotEquals(sf2.get_form_config().generation, generation)
+
+    def testRenderPage(self):
+        """Page headers should be rendered once per config generation"""
+        import webapp
+
+        class Handler(webapp.ScriptFormWebApp):
+            def __init__(self):
+                pass
+        handler = Handler()
+        sf = scriptform.ScriptForm('test_formconfig_hidden.json')
+        fc = sf.get_form_config()
+        page = handler.render_page(fc, u'<p>{msg}</p>', msg=u'\xe9')
+        self.assertTrue(page.startswith(webapp.ScriptFormWebApp.chrome.header))
+        self.assertIn('<p>\xc3\xa9</p>', page)
+        self.assertTrue(page.endswith('</html>\n'))
+        fc.title = u'Changed'
+        self.assertNotIn('Changed', handler.render_page(fc, u''))
+        fc.generation = next(scriptform.GENERATIONS)
+        self.assertIn('<h1>Changed</h1>', handler.render_page(fc, u''))
+
+    def testAuthBackend(self):
+        """An 'auth' section selects the backend users log in with"""
+        sf = scriptform.ScriptForm('test_formconfig_htpasswd.json', cache=False)
+        backend = sf.get_form_config().auth_backend
+        self.assertTrue(isinstance(backend, authbackends.HtpasswdBackend))
+        self.assertTrue(backend.authenticate(u'apr', 'secret'))
+        # The backend is kept when the config is read again.
+        self.assertTrue(sf.get_form_config().auth_backend is backend)
+        sf = scriptform.ScriptForm('test_formconfig_hidden.json')
+        self.assertEquals(sf.get_form_config().auth_backend, None)
+
 
 class FormDefinitionTest(unittest.TestCase):
     """
@@ -270,6 +368,1076 @@ class FormDefinitionFieldMissingProperty(unittest.TestCase):
     def testMissing(self):
         self.assertRaises(KeyError, scriptform.ScriptForm, 'test_formdefinition_missing_title.json')
 
+    def testUnknownType(self):
+        self.assertRaises(ValueError, scriptform.ScriptForm, 'test_formdefinition_unknown_type.json')
+
+
+class FormDataTest(unittest.TestCase):
+    """
+    Test the parsing of submitted form data.
+    """
+    def parse(self, body, content_type, **kwargs):
+        headers = {'content-type': content_type,
+                   'content-length': str(len(body))}
+        return formdata.parse(StringIO.StringIO(body), headers, **kwargs)
+
+    def multipart(self, parts, boundary='XyZ'):
+        body = ''
+        for headers, value in parts:
+            body += '--{0}\r\n{1}\r\n\r\n{2}\r\n'.format(boundary, headers,
+                                                          value)
+        body += '--{0}--\r\n'.format(boundary)
+        return body
+
+    def testMultipart(self):
+        upload = ''.join([chr(i % 256) for i in range(5000)]) + '\r\n--XyY'
+        body = self.multipart([
+            ('Content-Disposition: form-data; name="form_name"', 'upload'),
+            ('Content-Disposition: form-data; name="file"; '
+             'filename="data.raw"\r\nContent-Type: text/plain', upload),
+            ('Content-Disposition: form-data; name="empty"; filename=""', ''),
+        ])
+        # A small chunk size makes the boundary end up across chunks.
+        form_data = self.parse(body, 'multipart/form-data; boundary=XyZ',
+                               chunk_size=7)
+        self.assertEquals(form_data.getfirst('form_name'), 'upload')
+        self.assertNotIn('empty', form_data.files)
+        self.assertEquals(form_data.files['file'].filename, 'data.raw')
+        path = form_data.files['file'].path
+        self.assertEquals(file(path, 'rb').read(), upload)
+        form_data.cleanup()
+        self.assertFalse(os.path.exists(path))
+
+    def testMultipartFieldTooLarge(self):
+        body = self.multipart([
+            ('Content-Disposition: form-data; name="string"', 'x' * 100),
+        ])
+        try:
+            self.parse(body, 'multipart/form-data; boundary=XyZ',
+                       max_field_size=50)
+            self.fail("FormDataError not raised")
+        except formdata.FormDataError as err:
+            self.assertEquals(err.status_code, 413)
+
+    def testMultipartFieldSpilled(self):
+        body = self.multipart([
+            ('Content-Disposition: form-data; name="string"', 'x' * 100),
+            ('Content-Disposition: form-data; name="small"', 'y' * 10),
+        ])
+        form_data = self.parse(body, 'multipart/form-data; boundary=XyZ',
+                               max_field_size=50, max_spill_size=200)
+        spilled = form_data.fields['string']
+        self.assertTrue(isinstance(spilled, formdata.SpilledField))
+        self.assertEquals(spilled.size, 100)
+        self.assertEquals(form_data.getfirst('string'), 'x' * 100)
+        self.assertEquals(form_data.fields['small'], 'y' * 10)
+        self.assertEquals(form_data.field_values(),
+                          {'string': 'x' * 100, 'small': 'y' * 10})
+        form_data.cleanup()
+        self.assertFalse(os.path.exists(spilled.path))
+
+        try:
+            self.parse(body, 'multipart/form-data; boundary=XyZ',
+                       max_field_size=50, max_spill_size=80)
+            self.fail("FormDataError not raised")
+        except formdata.FormDataError as err:
+            self.assertEquals(err.status_code, 413)
+
+    def testMultipartTruncated(self):
+        body = self.multipart([
+            ('Content-Disposition: form-data; name="file"; '
+             'filename="data.raw"', 'data'),
+        ])[:-20]
+        self.assertRaises(formdata.FormDataError, self.parse, body,
+                          'multipart/form-data; boundary=XyZ')
+
+    def testMaxSize(self):
+        body = self.multipart([
+            ('Content-Disposition: form-data; name="form_name"', 'upload'),
+            ('Content-Disposition: form-data; name="file"; '
+             'filename="data.raw"', 'x' * 10000),
+        ])
+        rfile = StringIO.StringIO(body)
+        headers = {'content-type': 'multipart/form-data; boundary=XyZ',
+                   'content-length': str(len(body))}
+
+        def max_size_cb(form_data):
+            if form_data.getfirst('form_name') == 'upload':
+                return 1000
+            return None
+
+        try:
+            formdata.parse(rfile, headers, chunk_size=100,
+                           max_size_cb=max_size_cb)
+            self.fail("FormDataError not raised")
+        except formdata.FormDataError as err:
+            self.assertEquals(err.status_code, 413)
+        # Rejected as soon as the form was known
+        self.assertTrue(rfile.tell() < 1000)
+
+    def testUploadBudget(self):
+        budget = formdata.UploadBudget(1000)
+        self.assertTrue(budget.reserve(600))
+        self.assertFalse(budget.reserve(600))
+        budget.release(600)
+        self.assertTrue(budget.reserve(600))
+
+    def testUrlencoded(self):
+        form_data = self.parse('form_name=test&string=&string=2',
+                               'application/x-www-form-urlencoded')
+        self.assertEquals(form_data.getfirst('form_name'), 'test')
+        self.assertEquals(form_data.getfirst('string'), '')
+
+    def testUrlencodedChunks(self):
+        body = 'a+b=%3Cx%3E+y&flag&;c=1;d=%E2%82%AC' + '%41' * 30
+        # Escapes end up across chunks.
+        for chunk_size in (1, 2, 3, 64 * 1024):
+            form_data = self.parse(body, 'application/x-www-form-urlencoded',
+                                   chunk_size=chunk_size)
+            self.assertEquals(form_data.fields, {
+                'a b': '<x> y', 'flag': '', 'c': '1',
+                'd': '\xe2\x82\xac' + 'A' * 30})
+
+    def testUrlencodedSpilled(self):
+        # Only fields are limited, not the whole body.
+        body = 'form_name=test&' + '&'.join('f{0}=xx'.format(i)
+                                            for i in range(20))
+        form_data = self.parse(body, 'application/x-www-form-urlencoded',
+                               max_field_size=10)
+        self.assertEquals(form_data.getfirst('f19'), 'xx')
+
+        body = 'form_name=test&string=' + 'x' * 100
+        try:
+            self.parse(body, 'application/x-www-form-urlencoded',
+                       max_field_size=50)
+            self.fail("FormDataError not raised")
+        except formdata.FormDataError as err:
+            self.assertEquals(err.status_code, 413)
+
+        form_data = self.parse(body, 'application/x-www-form-urlencoded',
+                               max_field_size=50, max_spill_size=200,
+                               chunk_size=7)
+        spilled = form_data.fields['string']
+        self.assertTrue(isinstance(spilled, formdata.SpilledField))
+        self.assertEquals(form_data.getfirst('string'), 'x' * 100)
+        form_data.cleanup()
+        self.assertFalse(os.path.exists(spilled.path))
+
+
+class ResponseWriteTest(unittest.TestCase):
+    """
+    Test that responses are sent with as few writes as possible.
+    """
+    def handler(self, command='GET', accept_encoding='identity'):
+        class Handler(webserver.RequestHandler):
+            def __init__(self):
+                self._headers_buffer = []
+
+            def log_request(self, *args):
+                pass
+
+        class WriteRecorder(object):
+            def __init__(self):
+                self.writes = []
+
+            def write(self, data):
+                self.writes.append(data)
+
+        handler = Handler()
+        handler.command = command
+        handler.request_version = 'HTTP/1.1'
+        handler.protocol_version = 'HTTP/1.1'
+        handler.headers = {'accept-encoding': accept_encoding}
+        handler.wfile = WriteRecorder()
+        return handler
+
+    def testRespond(self):
+        handler = self.handler()
+        handler.respond('<p>Hello</p>')
+        self.assertEquals(len(handler.wfile.writes), 1)
+        self.assertTrue(handler.wfile.writes[0].startswith('HTTP/1.1 200'))
+        self.assertTrue(handler.wfile.writes[0].endswith('\r\n\r\n<p>Hello</p>'))
+
+    def testRespondHead(self):
+        handler = self.handler(command='HEAD')
+        handler.respond('<p>Hello</p>')
+        self.assertEquals(len(handler.wfile.writes), 1)
+        self.assertTrue(handler.wfile.writes[0].endswith('\r\n\r\n'))
+
+    def testRespondStream(self):
+        handler = self.handler(accept_encoding='gzip')
+        handler.respond('<p>Hello</p>' * 1000)
+        writes = handler.wfile.writes
+        self.assertIn('Transfer-Encoding: chunked', writes[0])
+        self.assertFalse(writes[0].endswith('\r\n\r\n'))
+        self.assertEquals(writes[-1], '0\r\n\r\n')
+
+    def testStartStream(self):
+        handler = self.handler(accept_encoding='gzip')
+        handler.send_response(200)
+        stream = handler.start_stream('gzip')
+        stream.write('<p>Hello</p>')
+        # What was written so far can be decompressed on its own.
+        writes = handler.wfile.writes
+        self.assertEquals(len(writes), 1)
+        headers, chunk = writes[0].split('\r\n\r\n', 1)
+        self.assertIn('Content-Encoding: gzip', headers)
+        length, data = chunk.split('\r\n', 1)
+        self.assertEquals(len(data), int(length, 16) + 2)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEquals(decompressor.decompress(data[:-2]), '<p>Hello</p>')
+        stream.close()
+        self.assertEquals(writes[-1], '0\r\n\r\n')
+
+    def testStreamClientGone(self):
+        handler = self.handler()
+
+        def write(data):
+            raise socket.error(32, 'Broken pipe')
+        handler.wfile.write = write
+        handler.send_response(200)
+        stream = handler.start_stream()
+        stream.write('<p>Hello</p>')
+        self.assertEquals(handler.close_connection, 1)
+        stream.write('<p>Hello</p>')
+        stream.close()
+
+    def testStreamError(self):
+        handler = self.handler()
+
+        class Log(object):
+            def exception(self, err):
+                pass
+
+        class ScriptForm(object):
+            log = Log()
+
+        def h_fail(handler):
+            handler.send_response(200)
+            stream = handler.start_stream()
+            stream.write('<p>Hello</p>')
+            raise ValueError("Oops")
+        handler.__class__.h_fail = h_fail
+        handler.scriptform = ScriptForm()
+        self.assertRaises(ValueError, handler._dispatch, 'fail', {})
+        # The response is cut off, not followed by an error page.
+        writes = ''.join(handler.wfile.writes)
+        self.assertEquals(writes.count('HTTP/1.'), 1)
+        self.assertFalse(writes.endswith('0\r\n\r\n'))
+        self.assertEquals(handler.close_connection, 1)
+
+    def testEndHeaders(self):
+        handler = self.handler()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/plain')
+        self.assertEquals(handler.wfile.writes, [])
+        handler.end_headers()
+        self.assertEquals(len(handler.wfile.writes), 1)
+
+
+class SendFileTest(unittest.TestCase):
+    """
+    Test sending (parts of) files to a socket and parsing Range headers.
+    """
+    def setUp(self):
+        self.data = ''.join(chr(i % 256) for i in range(200000))
+        file('tmp_sendfile', 'wb').write(self.data)
+        self.sock_a, self.sock_b = socket.socketpair()
+
+    def tearDown(self):
+        os.unlink('tmp_sendfile')
+        self.sock_a.close()
+        self.sock_b.close()
+
+    def receive(self, size):
+        received = ''
+        while len(received) < size:
+            received += self.sock_b.recv(size - len(received))
+        return received
+
+    def send(self, offset, count):
+        def sender():
+            with open('tmp_sendfile', 'rb') as fileobj:
+                self.missing = webserver.sendfile(self.sock_a, fileobj,
+                                                  offset, count)
+        sender_thread = threading.Thread(target=sender)
+        sender_thread.start()
+        received = self.receive(min(count, len(self.data) - offset))
+        sender_thread.join()
+        return received
+
+    def testSendFile(self):
+        self.assertEquals(self.send(0, len(self.data)), self.data)
+        self.assertEquals(self.send(1000, 10), self.data[1000:1010])
+        self.assertEquals(self.missing, 0)
+        self.assertEquals(self.send(len(self.data) - 5, 10), self.data[-5:])
+        self.assertEquals(self.missing, 5)
+
+    def testSendFileFallback(self):
+        libc_sendfile = webserver.LIBC_SENDFILE
+        webserver.LIBC_SENDFILE = None
+        try:
+            self.assertEquals(self.send(0, len(self.data)), self.data)
+            self.assertEquals(self.send(1000, 10), self.data[1000:1010])
+            self.assertEquals(self.send(len(self.data) - 5, 10), self.data[-5:])
+            self.assertEquals(self.missing, 5)
+        finally:
+            webserver.LIBC_SENDFILE = libc_sendfile
+
+    def testParseRange(self):
+        parse = webserver.parse_range
+        self.assertEquals(parse('bytes=0-9', 100), (0, 9))
+        self.assertEquals(parse('bytes=90-', 100), (90, 99))
+        self.assertEquals(parse('bytes=90-200', 100), (90, 99))
+        self.assertEquals(parse('bytes=-10', 100), (90, 99))
+        self.assertEquals(parse('bytes=-200', 100), (0, 99))
+        self.assertEquals(parse('bytes=100-', 100), False)
+        self.assertEquals(parse('bytes=-0', 100), False)
+        self.assertEquals(parse('bytes=0-1,5-6', 100), None)
+        self.assertEquals(parse('bytes=5-1', 100), None)
+        self.assertEquals(parse('items=0-1', 100), None)
+        self.assertEquals(parse('bytes=a-b', 100), None)
+
+
+class FileCacheTest(unittest.TestCase):
+    """
+    Test caching static files in memory.
+    """
+    def setUp(self):
+        os.mkdir('tmp_static')
+        self.write('small.txt', 'small')
+        self.write('style.css', 'p { color: red; }\n' * 100)
+        self.cache = filecache.FileCache(max_size=4000, max_file_size=3000,
+                                         check_interval=60)
+
+    def tearDown(self):
+        shutil.rmtree('tmp_static')
+
+    def write(self, fname, data, mtime=None):
+        path = os.path.join('tmp_static', fname)
+        file(path, 'wb').write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def testCache(self):
+        cached = self.cache.get('tmp_static/small.txt')
+        self.assertEquals(cached.data, 'small')
+        self.assertEquals(cached.content_type, 'text/plain')
+        self.assertEquals(cached.gzip_data, None)
+        # Not checked again until the check interval has passed.
+        self.write('small.txt', 'changed')
+        self.assertTrue(self.cache.get('tmp_static/small.txt') is cached)
+        cached.checked = 0
+        self.assertEquals(self.cache.get('tmp_static/small.txt').data, 'changed')
+
+    def testNotCached(self):
+        self.assertEquals(self.cache.get('tmp_static/nosuchfile'), None)
+        self.assertEquals(self.cache.get('tmp_static'), None)
+        self.write('large.bin', 'x' * 3001)
+        self.assertEquals(self.cache.get('tmp_static/large.bin'), None)
+        self.assertEquals(self.cache.size, 0)
+
+    def testGzip(self):
+        cached = self.cache.get('tmp_static/style.css')
+        self.assertTrue(len(cached.gzip_data) < len(cached.data))
+        self.assertEquals(zlib.decompress(cached.gzip_data, 16 + zlib.MAX_WBITS),
+                          cached.data)
+        self.assertNotEquals(cached.gzip_etag, cached.etag)
+
+    def testGzipSidecar(self):
+        self.write('style.css.gz', 'precompressed', mtime=time.time() + 10)
+        cached = self.cache.get('tmp_static/style.css')
+        self.assertEquals(cached.gzip_data, 'precompressed')
+        etag = cached.gzip_etag
+        # Replaced or removed sidecar files are noticed.
+        cached.checked = 0
+        self.write('style.css.gz', 'replaced', mtime=time.time() + 20)
+        cached = self.cache.get('tmp_static/style.css')
+        self.assertEquals(cached.gzip_data, 'replaced')
+        self.assertNotEquals(cached.gzip_etag, etag)
+        cached.checked = 0
+        os.unlink('tmp_static/style.css.gz')
+        cached = self.cache.get('tmp_static/style.css')
+        self.assertEquals(zlib.decompress(cached.gzip_data, 16 + zlib.MAX_WBITS),
+                          cached.data)
+        # Outdated sidecar files are ignored.
+        self.write('other.css', 'p { color: red; }\n' * 100)
+        self.write('other.css.gz', 'outdated', mtime=time.time() - 10)
+        cached = self.cache.get('tmp_static/other.css')
+        self.assertNotEquals(cached.gzip_data, 'outdated')
+
+    def testEvict(self):
+        for i in range(3):
+            self.write('{0}.bin'.format(i), 'x' * 1500)
+        self.cache.get('tmp_static/0.bin')
+        self.cache.get('tmp_static/1.bin')
+        self.cache.get('tmp_static/0.bin')
+        self.cache.get('tmp_static/2.bin')
+        self.assertEquals(sorted(self.cache.files),
+                          ['tmp_static/0.bin', 'tmp_static/2.bin'])
+        self.assertEquals(self.cache.size, 3000)
+
+
+class AuthTest(unittest.TestCase):
+    """
+    Test password hashing and the cache of verified credentials.
+    """
+    def testHashPassword(self):
+        pw_hash = auth.hash_password('secret', iterations=1000)
+        self.assertTrue(pw_hash.startswith('pbkdf2_sha256$1000$'))
+        self.assertNotEquals(auth.hash_password('secret', iterations=1000), pw_hash)
+        self.assertTrue(auth.verify_password('secret', pw_hash))
+        self.assertFalse(auth.verify_password('Secret', pw_hash))
+        self.assertFalse(auth.verify_password('secret', 'pbkdf2_sha256$garbage'))
+
+    def testLegacyHash(self):
+        pw_hash = '2bb80d537b1da3e38bd30361aa855686bde0eacd7162fef6a25fe97bf527a25b'
+        self.assertTrue(auth.verify_password('secret', pw_hash))
+        self.assertTrue(auth.verify_password('secret', pw_hash.upper()))
+        self.assertFalse(auth.verify_password('Secret', pw_hash))
+
+    def testPurePythonPBKDF2(self):
+        self.assertEquals(auth._pbkdf2_sha256('secret', 'salt', 100),
+                          auth.pbkdf2_sha256('secret', 'salt', 100))
+
+    def testCredentialCache(self):
+        cache = auth.CredentialCache(ttl=60, max_entries=2)
+        self.assertEquals(cache.get('Basic abc', 1), None)
+        cache.add('Basic abc', 1, 'user')
+        self.assertEquals(cache.get('Basic abc', 1), 'user')
+        self.assertEquals(cache.get('Basic abd', 1), None)
+        self.assertNotIn('Basic abc', ''.join(cache.entries))
+
+        cache.add('Basic def', 1, 'admin')
+        cache.add('Basic ghi', 1, 'other')
+        self.assertEquals(cache.get('Basic abc', 1), None)
+        self.assertEquals(cache.get('Basic ghi', 1), 'other')
+
+        # A new generation of users forgets everything.
+        self.assertEquals(cache.get('Basic ghi', 2), None)
+        cache.add('Basic ghi', 2, 'other')
+        self.assertEquals(cache.get('Basic ghi', 1), None)
+        self.assertEquals(cache.get('Basic ghi', 2), None)
+
+    def testCredentialCacheExpiry(self):
+        cache = auth.CredentialCache(ttl=-1)
+        cache.add('Basic abc', 1, 'user')
+        self.assertEquals(cache.get('Basic abc', 1), None)
+
+    def testSessionSigner(self):
+        users = {u'user': 'hash', u'\xe9l\xe8ve': 'hash2'}
+        signer = auth.SessionSigner(ttl=60)
+        token = signer.sign(u'user', 'hash')
+        self.assertEquals(signer.verify(token, users.get), u'user')
+        token = signer.sign(u'\xe9l\xe8ve', 'hash2')
+        self.assertEquals(signer.verify(token, users.get), u'\xe9l\xe8ve')
+        self.assertIn('Max-Age=60', signer.cookie(token))
+        self.assertIn('Max-Age=0', signer.cookie(''))
+        self.assertNotIn('Secure', signer.cookie(token))
+        self.assertIn('; Secure', signer.cookie(token, secure=True))
+        self.assertIn('; Secure', auth.SessionSigner(secure=True).cookie(token))
+
+        # Tampered, changed password, other key, garbage.
+        user_b64, expires, mac = signer.sign(u'user', 'hash').split('.')
+        tampered = '.'.join((user_b64, str(int(expires) + 1), mac))
+        self.assertEquals(signer.verify(tampered, users.get), None)
+        token = signer.sign(u'user', 'hash')
+        self.assertEquals(signer.verify(token, {u'user': 'newhash'}.get), None)
+        self.assertEquals(signer.verify(token, {}.get), None)
+        self.assertEquals(auth.SessionSigner().verify(token, users.get), None)
+        for token in ('', 'a.b', 'a.b.c', '!!!.1.c'):
+            self.assertEquals(signer.verify(token, users.get), None)
+
+    def testMD5Crypt(self):
+        self.assertEquals(auth.md5_crypt('secret', 'abcdefgh'),
+                          '$apr1$abcdefgh$h9FWgUz3n9YxylKLlR5SQ/')
+        self.assertEquals(auth.md5_crypt('secret', 'abcdefgh', '$1$'),
+                          '$1$abcdefgh$cHJi5PXp/ki/ktXzqlk6I1')
+        self.assertEquals(auth.md5_crypt('', 'x'),
+                          '$apr1$x$tMwYqBfQwi3FYAr0aJc8M/')
+
+    def testVerifyHtpasswd(self):
+        for pw_hash in ('{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ=',
+                        '$apr1$abcdefgh$h9FWgUz3n9YxylKLlR5SQ/',
+                        'abNANd1rDfiNc',
+                        '2bb80d537b1da3e38bd30361aa855686bde0eacd7162fef6a25fe97bf527a25b',
+                        auth.hash_password('secret', iterations=1000)):
+            self.assertTrue(auth.verify_htpasswd('secret', pw_hash))
+            self.assertFalse(auth.verify_htpasswd('Secret', pw_hash))
+        if auth.bcrypt is None:
+            self.assertFalse(auth.verify_htpasswd('secret', '$2y$05$abc'))
+
+    def testSessionSignerExpiry(self):
+        signer = auth.SessionSigner(ttl=-1)
+        token = signer.sign(u'user', 'hash')
+        self.assertEquals(signer.verify(token, {u'user': 'hash'}.get), None)
+
+
+class LDAPStandIn(object):
+    """
+    Stand-in for an LDAP server, which only answers simple binds. `passwords`
+    maps the DNs of users to their passwords.
+    """
+    def __init__(self, passwords):
+        self.passwords = passwords
+        self.connections = []
+        self.binds = 0
+        self.running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        thread.start_new_thread(self._accept, ())
+
+    def _accept(self):
+        while self.running:
+            try:
+                conn = self.sock.accept()[0]
+            except socket.timeout:
+                continue
+            self.connections.append(conn)
+            thread.start_new_thread(self._serve, (conn, ))
+        self.sock.close()
+
+    def _serve(self, conn):
+        conn.settimeout(None)
+        rfile = conn.makefile('rb')
+        try:
+            while True:
+                message = ldapclient.ber_decode(ldapclient.ber_read(rfile)[1])
+                message_id, (tag, request) = message[0][1], message[1]
+                if tag != ldapclient.TAG_BIND_REQUEST:
+                    break
+                version, dn, password = ldapclient.ber_decode(request)
+                self.binds += 1
+                result = 49
+                if self.passwords.get(dn[1]) == password[1]:
+                    result = 0
+                response = ldapclient.ber_encode(
+                    ldapclient.TAG_BIND_RESPONSE,
+                    ldapclient.ber_encode_int(result, ldapclient.TAG_ENUMERATED) +
+                    ldapclient.ber_encode(ldapclient.TAG_OCTET_STRING, '') +
+                    ldapclient.ber_encode(ldapclient.TAG_OCTET_STRING, ''))
+                conn.sendall(ldapclient.ber_encode(
+                    ldapclient.TAG_SEQUENCE,
+                    ldapclient.ber_encode(ldapclient.TAG_INTEGER, message_id) +
+                    response))
+        except (ldapclient.LDAPError, socket.error):
+            pass
+        conn.close()
+
+    def drop_connections(self):
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def stop(self):
+        self.running = False
+        self.drop_connections()
+
+
+class AuthBackendTest(unittest.TestCase):
+    """
+    Test the htpasswd and LDAP authentication backends.
+    """
+    def setUp(self):
+        self.ldap = LDAPStandIn({
+            'uid=user,ou=people,dc=example,dc=com': 'secret',
+            'uid=a\\,b,ou=people,dc=example,dc=com': 'secret',
+        })
+        self.ldap_url = 'ldap://127.0.0.1:{0}'.format(self.ldap.port)
+        self.user_dn = 'uid={username},ou=people,dc=example,dc=com'
+
+    def tearDown(self):
+        self.ldap.stop()
+        if os.path.exists('tmp_htpasswd'):
+            os.unlink('tmp_htpasswd')
+
+    def testBER(self):
+        self.assertEquals(ldapclient.ber_encode_int(128), '\x02\x02\x00\x80')
+        self.assertEquals(ldapclient.ber_decode_int('\x00\x80'), 128)
+        data = ldapclient.ber_encode(ldapclient.TAG_OCTET_STRING, 'x' * 300)
+        self.assertEquals(data[:4], '\x04\x82\x01\x2c')
+        self.assertEquals(ldapclient.ber_decode(data + '\x02\x01\x05'),
+                          [(4, 'x' * 300), (2, '\x05')])
+        self.assertRaises(ldapclient.LDAPError, ldapclient.ber_decode, data[:-1])
+
+    def testEscapeDN(self):
+        self.assertEquals(ldapclient.escape_dn_value(u'a,b=c+d\\'),
+                          u'a\\,b\\=c\\+d\\\\')
+        self.assertEquals(ldapclient.escape_dn_value(u'#a b '), u'\\#a b\\ ')
+
+    def testHtpasswd(self):
+        with open('tmp_htpasswd', 'w') as fileobj:
+            fileobj.write('sha:{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ=\n')
+        backend = authbackends.HtpasswdBackend('tmp_htpasswd', check_interval=0)
+        self.assertTrue(backend.authenticate(u'sha', 'secret'))
+        self.assertFalse(backend.authenticate(u'sha', 'wrong'))
+        self.assertFalse(backend.authenticate(u'nobody', 'secret'))
+        generation = backend.generation()
+        self.assertEquals(backend.generation(), generation)
+        self.assertEquals(backend.session_stamp(u'sha'), '{SHA}5en6G6MezRroT3XKqkdPOmY/BfQ=')
+
+        with open('tmp_htpasswd', 'a') as fileobj:
+            fileobj.write('crypt:abNANd1rDfiNc\n')
+        self.assertTrue(backend.authenticate(u'crypt', 'secret'))
+        self.assertNotEquals(backend.generation(), generation)
+
+        os.unlink('tmp_htpasswd')
+        self.assertFalse(backend.authenticate(u'sha', 'secret'))
+
+    def testGetAuthBackend(self):
+        from formconfig import FormConfigError
+        backend = authbackends.get_auth_backend({u'type': u'htpasswd', u'path': u'test_htpasswd'})
+        self.assertTrue(backend.authenticate(u'sha', 'secret'))
+        for auth_config in ({u'type': u'nosuchtype'},
+                            {u'type': u'htpasswd', u'path': u'nosuchfile'},
+                            {u'type': u'htpasswd', u'foo': u'bar'},
+                            {u'type': u'ldap', u'url': u'http://x', u'user_dn': u'{username}'},
+                            {u'type': u'ldap', u'url': self.ldap_url, u'user_dn': u'dc=com'}):
+            self.assertRaises(FormConfigError, authbackends.get_auth_backend, auth_config)
+
+    def testLDAP(self):
+        backend = authbackends.LDAPBackend(self.ldap_url, self.user_dn)
+        for i in range(2):
+            self.assertTrue(backend.authenticate(u'user', 'secret'))
+            self.assertFalse(backend.authenticate(u'user', 'wrong'))
+        # Both results were cached.
+        self.assertEquals(self.ldap.binds, 2)
+        # Binding without a password would succeed.
+        self.assertFalse(backend.authenticate(u'user', ''))
+        self.assertEquals(self.ldap.binds, 2)
+        # Special characters in the username are escaped.
+        self.assertTrue(backend.authenticate(u'a,b', 'secret'))
+        self.assertEquals(len(self.ldap.connections), 1)
+
+    def testLDAPNoCache(self):
+        backend = authbackends.LDAPBackend(self.ldap_url, self.user_dn,
+                                           cache_ttl=0, negative_cache_ttl=0)
+        for i in range(3):
+            self.assertTrue(backend.authenticate(u'user', 'secret'))
+        self.assertEquals(self.ldap.binds, 3)
+        self.assertEquals(len(self.ldap.connections), 1)
+
+    def testLDAPReconnect(self):
+        backend = authbackends.LDAPBackend(self.ldap_url, self.user_dn, cache_ttl=0)
+        self.assertTrue(backend.authenticate(u'user', 'secret'))
+        self.ldap.drop_connections()
+        time.sleep(0.1)
+        self.assertTrue(backend.authenticate(u'user', 'secret'))
+        self.assertEquals(len(self.ldap.connections), 2)
+
+    def testLDAPPool(self):
+        pool = ldapclient.LDAPConnectionPool(self.ldap_url, size=1, timeout=0.1)
+        conn = pool.connections.get()
+        self.assertRaises(ldapclient.LDAPError, pool.bind, 'uid=user', 'secret')
+        pool.connections.put(conn)
+        self.assertFalse(pool.bind('uid=user', 'secret'))
+        pool.close()
+
+    def testLDAPDown(self):
+        self.ldap.stop()
+        time.sleep(0.2)
+        backend = authbackends.LDAPBackend(self.ldap_url, self.user_dn)
+        self.assertFalse(backend.authenticate(u'user', 'secret'))
+
+
+class QueueFileHandlerTest(unittest.TestCase):
+    """
+    Test writing the log from a background thread.
+    """
+    def tearDown(self):
+        if os.path.exists('tmp_log'):
+            os.unlink('tmp_log')
+
+    def logger(self, handler):
+        logger = logging.getLogger('TEST_LOGQUEUE')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.handlers = [handler]
+        handler.setFormatter(logging.Formatter('%(name)s:%(message)s'))
+        return logger
+
+    def testWrite(self):
+        handler = logqueue.QueueFileHandler('tmp_log')
+        logger = self.logger(handler)
+        for i in range(500):
+            logger.error(u'record {0} \u2713'.format(i))
+        handler.close()
+        lines = file('tmp_log', 'r').read().splitlines()
+        self.assertEquals(len(lines), 500)
+        self.assertEquals(lines[-1], 'TEST_LOGQUEUE:record 499 \xe2\x9c\x93')
+
+    def testDropped(self):
+        class StalledHandler(logqueue.QueueFileHandler):
+            def _start_writer(self):
+                # Queue records without a writer, as if the disk stalled.
+                self.queue = Queue.Queue(self.queue_size)
+                self.writer_pid = os.getpid()
+
+        handler = StalledHandler('tmp_log', queue_size=10)
+        logger = self.logger(handler)
+        for i in range(15):
+            logger.error('record')
+        self.assertEquals(handler.dropped, 5)
+
+        # Replace one record with the sentinel, so the writer loop ends.
+        handler.queue.get()
+        handler.queue.put(None)
+        handler._write_loop(handler.queue)
+        handler.writer_pid = None
+        handler.close()
+        lines = file('tmp_log', 'r').read().splitlines()
+        self.assertEquals(len(lines), 10)
+        self.assertIn('Dropped 5 log records', lines[-1])
+
+    def testConcurrentEmit(self):
+        class StalledHandler(logqueue.QueueFileHandler):
+            starts = 0
+
+            def _start_writer(self):
+                self.starts += 1
+                time.sleep(0.01)
+                self.queue = Queue.Queue(self.queue_size)
+                self.writer_pid = os.getpid()
+
+        handler = StalledHandler('tmp_log', queue_size=10)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        record = logging.LogRecord('TEST', logging.ERROR, __file__, 0,
+                                   'record', None, None)
+
+        def emit():
+            for i in range(100):
+                handler.emit(record)
+
+        threads = [threading.Thread(target=emit) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(handler.starts, 1)
+        self.assertEquals(handler.dropped, 790)
+        handler.writer_pid = None
+        handler.close()
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Test the rendering of metrics in the Prometheus text format.
+    """
+    def testCounter(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', "Test.", ('path', ),
+                                  registry=registry)
+        counter.inc(('/a"b', ))
+        counter.inc(('/a"b', ), 2)
+        self.assertEquals(registry.expose(),
+                          '# HELP test_total Test.\n'
+                          '# TYPE test_total counter\n'
+                          'test_total{path="/a\\"b"} 3\n')
+
+    def testHistogram(self):
+        registry = metrics.Registry()
+        histogram = metrics.Histogram('test_seconds', "Test.",
+                                      buckets=(0.1, 1), registry=registry)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = registry.expose().splitlines()
+        self.assertEquals(lines[2:], [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+        ])
+
+
+class ProfilerTest(unittest.TestCase):
+    """
+    Test profiling code per key.
+    """
+    def setUp(self):
+        os.mkdir('tmp_profile')
+
+    def tearDown(self):
+        shutil.rmtree('tmp_profile')
+
+    def busy(self):
+        end = time.time() + 0.1
+        while time.time() < end:
+            pass
+
+    def testSample(self):
+        profiler = profiling.Profiler('tmp_profile', 'sample', interval=0.001)
+        profiler.start()
+        with profiler.profile('/form.my form'):
+            self.busy()
+        self.busy()
+        profiler.stop()
+        path = 'tmp_profile/scriptform.{0}.form.my_form.collapsed'.format(os.getpid())
+        self.assertEquals(os.listdir('tmp_profile'), [os.path.basename(path)])
+        lines = file(path, 'r').read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[-1].rsplit(' ', 1)
+        self.assertIn('test.py:busy', stack)
+        self.assertTrue(int(count) > 0)
+
+    def testCProfile(self):
+        profiler = profiling.Profiler('tmp_profile', 'cprofile')
+        profiler.start()
+        with profiler.profile('/'):
+            self.busy()
+        with profiler.profile('/'):
+            self.busy()
+        profiler.stop()
+        path = 'tmp_profile/scriptform.{0}.index.pstats'.format(os.getpid())
+        stats = pstats.Stats(path)
+        calls = [value[0] for func, value in stats.stats.items()
+                 if func[2] == 'busy']
+        self.assertEquals(calls, [2])
+
+
+class WatchdogTest(unittest.TestCase):
+    """
+    Test the reporting of slow requests and thread stacks.
+    """
+    def setUp(self):
+        self.output = StringIO.StringIO()
+        self.handler = logging.StreamHandler(self.output)
+        self.watchdog = watchdog.Watchdog()
+        self.watchdog.log = logging.getLogger('test_watchdog')
+        self.watchdog.log.addHandler(self.handler)
+        self.watchdog.log.setLevel(logging.INFO)
+        self.done = threading.Event()
+        self.started = threading.Event()
+
+    def tearDown(self):
+        self.done.set()
+        self.watchdog.log.removeHandler(self.handler)
+
+    def stuck_request(self):
+        with self.watchdog.track('POST', '/submit', '127.0.0.1'):
+            self.watchdog.set_child_pid(1234)
+            self.started.set()
+            self.done.wait()
+
+    def testSlowRequest(self):
+        threading.Thread(target=self.stuck_request).start()
+        self.started.wait()
+        self.watchdog.threshold = 10
+        self.assertEquals(self.watchdog.check(), [])
+        self.watchdog.threshold = 0
+        slow = self.watchdog.check()
+        self.assertEquals(len(slow), 1)
+        self.assertEquals(slow[0].child_pid, 1234)
+        # Requests are only reported once while they're running.
+        self.assertEquals(self.watchdog.check(), [])
+        self.done.set()
+        time.sleep(0.1)
+        self.assertEquals(self.watchdog.requests, {})
+
+        output = self.output.getvalue()
+        self.assertIn('Slow request: POST /submit from 127.0.0.1', output)
+        self.assertIn('script PID 1234', output)
+        self.assertIn('in stuck_request', output)
+        self.assertIn('Slow request finished: POST /submit', output)
+
+    def testRestart(self):
+        """Stopping and starting again doesn't leave two checkers running"""
+        self.watchdog.start(10, interval=0.05)
+        first = self.watchdog.checker
+        self.watchdog.stop()
+        self.assertFalse(first.is_alive())
+        self.watchdog.start(10, interval=0.05)
+        self.assertTrue(self.watchdog.checker is not first)
+        self.assertTrue(self.watchdog.checker.is_alive())
+        self.watchdog.stop()
+        self.watchdog.stop()
+        self.assertEquals(self.watchdog.checker, None)
+
+    def testDumpStacks(self):
+        threading.Thread(target=self.stuck_request, name='stuck').start()
+        self.started.wait()
+        self.watchdog.dump_stacks()
+        output = self.output.getvalue()
+        self.assertIn('Thread MainThread', output)
+        self.assertIn('Thread stuck', output)
+        self.assertIn('Handling POST /submit from 127.0.0.1', output)
+        self.assertIn('in testDumpStacks', output)
+
+
+class OutputStoreTest(unittest.TestCase):
+    def testCapturedOutput(self):
+        captured = runscript.CapturedOutput(10)
+        captured.write('0123')
+        captured.write('4567')
+        self.assertFalse(captured.spooled())
+        self.assertEquals(captured.head(3), '012')
+        self.assertEquals(captured.tail(3), '567')
+        captured.write('89abcdef')
+        self.assertTrue(captured.spooled())
+        self.assertEquals(captured.size, 16)
+        self.assertEquals(captured.head(3), '012')
+        self.assertEquals(captured.tail(3), 'def')
+        self.assertEquals(captured.getvalue(), '0123456789abcdef')
+        path = captured.path
+        captured.cleanup()
+        self.assertFalse(os.path.exists(path))
+
+    def testAddGet(self):
+        store = outputstore.OutputStore(ttl=60)
+        try:
+            captured = runscript.CapturedOutput(0, store.directory)
+            captured.write('output')
+            output_id = store.add(captured.detach(), u'user')
+            captured.cleanup()
+            path = store.get(output_id, u'user')
+            self.assertEquals(open(path).read(), 'output')
+            self.assertEquals(store.get(output_id, u'admin'), None)
+            self.assertEquals(store.get(output_id[:-1] + 'x', u'user'), None)
+            self.assertEquals(store.get('../test.py-x', u'user'), None)
+            # Another store with the same key can get it.
+            other = outputstore.OutputStore(store.directory, 60, store.key)
+            self.assertEquals(other.get(output_id, u'user'), path)
+        finally:
+            store.remove_all()
+        self.assertFalse(os.path.exists(store.directory))
+
+    def testExpire(self):
+        store = outputstore.OutputStore(ttl=60)
+        try:
+            fdescriptor, path = tempfile.mkstemp(dir=store.directory)
+            os.close(fdescriptor)
+            output_id = store.add(path, u'user')
+            path = store.get(output_id, u'user')
+            os.utime(path, (time.time() - 120, time.time() - 120))
+            self.assertEquals(store.get(output_id, u'user'), None)
+            # Spool files of running scripts are left alone.
+            fdescriptor, spool_path = tempfile.mkstemp(dir=store.directory)
+            os.close(fdescriptor)
+            os.utime(spool_path, (time.time() - 120, time.time() - 120))
+            store.expired = 0
+            store.expire()
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(spool_path))
+        finally:
+            store.remove_all()
+
+
+class JobsTest(unittest.TestCase):
+    def setUp(self):
+        sf = scriptform.ScriptForm('test_formconfig_callback.json')
+        self.fd = sf.get_form_config().get_form_def('test_store')
+        self.store = jobs.JobStore(ttl=60)
+        self.runner = jobs.JobRunner(self.store, threads=1, queue_size=1,
+                                     capture_size=4)
+
+    def tearDown(self):
+        self.runner.stop()
+        self.store.remove_all()
+
+    def wait(self, job_id):
+        for i in range(50):
+            job = self.store.get(job_id)
+            if job['state'] == 'done':
+                return job
+            time.sleep(0.1)
+        self.fail("Job didn't finish")
+
+    def uploads(self, budget):
+        fdescriptor, tmp_fname = tempfile.mkstemp()
+        os.close(fdescriptor)
+        uploads = formdata.FormData()
+        uploads.tmp_files.append(tmp_fname)
+        budget.reserve(10)
+        uploads.budget = budget
+        uploads.reserved = 10
+        return uploads
+
+    def testRun(self):
+        budget = formdata.UploadBudget(100)
+        uploads = self.uploads(budget)
+        tmp_fname = uploads.tmp_files[0]
+        job = self.runner.submit(self.fd, {}, u'user', uploads)
+        self.assertEquals(self.store.get(job['id'])['username'], u'user')
+        job = self.wait(job['id'])
+        self.assertEquals(job['exitcode'], 33)
+        self.assertIn('stdout', open(self.store.path(job['id'], 'stdout')).read())
+        self.assertIn('stderr', open(self.store.path(job['id'], 'stderr')).read())
+        # The job removes the uploads it took over, and releases their
+        # budget.
+        self.assertFalse(os.path.exists(tmp_fname))
+        self.assertEquals(budget.in_flight, 0)
+        # Output spooled to the job's dir was moved into place.
+        self.assertEquals(sorted(os.listdir(self.store.path(job['id']))),
+                          ['job.json', 'stderr', 'stdout'])
+
+    def testQueueFull(self):
+        self.runner.stop()
+        # Without a thread to run them, jobs stay queued.
+        self.runner.pid = os.getpid()
+        job = self.runner.submit(self.fd, {}, u'user', formdata.FormData())
+        self.assertEquals(self.store.get(job['id'])['state'], 'queued')
+        budget = formdata.UploadBudget(100)
+        uploads = self.uploads(budget)
+        tmp_fname = uploads.tmp_files[0]
+        self.assertRaises(jobs.JobQueueFull, self.runner.submit, self.fd, {},
+                          u'user', uploads)
+        self.assertFalse(os.path.exists(tmp_fname))
+        self.assertEquals(budget.in_flight, 0)
+        self.assertEquals(os.listdir(self.store.directory), [job['id']])
+
+    def testStop(self):
+        sf = scriptform.ScriptForm('test_webapp.json')
+        fd = sf.get_form_config().get_form_def('output_stream')
+        self.runner.stop()
+        self.runner = jobs.JobRunner(self.store, threads=1, queue_size=2)
+        running = self.runner.submit(fd, {'string': 'x'}, u'user',
+                                     formdata.FormData())
+        queued = self.runner.submit(fd, {'string': 'x'}, u'user',
+                                    formdata.FormData())
+        while self.store.get(running['id'])['state'] != 'running':
+            time.sleep(0.05)
+        # The running job doesn't finish in time. Its dir is left alone.
+        self.assertFalse(self.runner.stop(timeout=0.1))
+        self.assertEquals(self.store.get(queued['id'])['state'], 'lost')
+        self.store.remove_all()
+        self.assertEquals(os.listdir(self.store.directory), [running['id']])
+        self.wait(running['id'])
+        self.store.remove_all()
+        self.assertFalse(os.path.exists(self.store.directory))
+
+    def testLostAndExpire(self):
+        job = self.store.create(self.fd, u'user')
+        self.assertEquals(self.store.get(job['id'])['state'], 'queued')
+        # A job of a process that no longer exists is lost.
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        job['pid'] = proc.pid
+        self.store.update(job)
+        self.assertEquals(self.store.get(job['id'])['state'], 'lost')
+        self.assertEquals(self.store.get('../' + job['id'][3:]), None)
+
+        old = time.time() - 120
+        os.utime(self.store.path(job['id'], 'job.json'), (old, old))
+        self.store.expired = 0
+        self.store.expire()
+        self.assertEquals(self.store.get(job['id']), None)
+
+        # Looking up jobs expires them too.
+        job = self.store.create(self.fd, u'user')
+        job['state'] = 'done'
+        self.store.update(job)
+        os.utime(self.store.path(job['id'], 'job.json'), (old, old))
+        self.store.expired = 0
+        self.assertEquals(self.store.get('0' * 32), None)
+        self.assertFalse(os.path.exists(self.store.path(job['id'])))
+
 
 class WebAppTest(unittest.TestCase):
     """
@@ -281,7 +1449,8 @@ class WebAppTest(unittest.TestCase):
         cls.auth_user = requests.auth.HTTPBasicAuth('user', 'user')
 
         def server_thread(sf):
-            sf.run(listen_port=8002)
+            sf.run(listen_port=8002, session_ttl=60, capture_size=64 * 1024,
+                   preview_size=1024)
         cls.sf = scriptform.ScriptForm('test_webapp.json')
         thread.start_new_thread(server_thread, (cls.sf, ))
         # Wait until the webserver is ready
@@ -307,6 +1476,42 @@ class WebAppTest(unittest.TestCase):
         r = requests.get('http://localhost:8002/')
         self.assertEqual(r.status_code, 401)
 
+    def testError405(self):
+        r = requests.get('http://localhost:8002/submit?form_name=validate', auth=self.auth_user)
+        self.assertEqual(r.status_code, 405)
+        self.assertEqual(r.headers['Allow'], 'POST')
+        r = requests.post('http://localhost:8002/form', {'form_name': 'validate'}, auth=self.auth_user)
+        self.assertEqual(r.status_code, 405)
+
+    def testHead(self):
+        headers = {'Accept-Encoding': 'identity'}
+        r = requests.head('http://localhost:8002/form?form_name=validate', headers=headers, auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(int(r.headers['Content-Length']) > 0)
+        self.assertEqual(r.text, '')
+
+    def testCompress(self):
+        r = requests.get('http://localhost:8002/form?form_name=validate', auth=self.auth_user)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', r.headers['Vary'])
+        self.assertIn('Validated form', r.text)
+
+        headers = {'Accept-Encoding': 'deflate'}
+        r = requests.get('http://localhost:8002/form?form_name=validate', headers=headers, auth=self.auth_user)
+        self.assertEqual(r.headers['Content-Encoding'], 'deflate')
+        self.assertIn('Validated form', r.text)
+
+    def testCompressNotAccepted(self):
+        headers = {'Accept-Encoding': 'gzip;q=0, identity'}
+        r = requests.get('http://localhost:8002/form?form_name=validate', headers=headers, auth=self.auth_user)
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(int(r.headers['Content-Length']), len(r.content))
+
+    def testCompressMinSize(self):
+        r = requests.get('http://localhost:8002/nosuchurl', auth=self.auth_user)
+        self.assertEqual(r.status_code, 404)
+        self.assertNotIn('Content-Encoding', r.headers)
+
     def testAuthFormNoAuthGet(self):
         r = requests.get('http://localhost:8002/form?form_name=admin_only')
         self.assertEqual(r.status_code, 401)
@@ -458,6 +1663,17 @@ class WebAppTest(unittest.TestCase):
         r = requests.post('http://localhost:8002/submit', data, auth=self.auth_user)
         self.assertIn('string=&lt;foo&gt;', r.text)
 
+    def testFieldSizeLimit(self):
+        # Spilled to disk, but still small enough for the environment.
+        data = {"form_name": 'output_escaped', "string": 'x' * 100000}
+        r = requests.post('http://localhost:8002/submit', data, auth=self.auth_user)
+        self.assertEquals(r.status_code, 200)
+        self.assertNotIn('error', r.text)
+
+        data['string'] = 'x' * (runscript.MAX_VALUE_SIZE + 1)
+        r = requests.post('http://localhost:8002/submit', data, auth=self.auth_user)
+        self.assertEquals(r.status_code, 413)
+
     def testOutputRaw(self):
         data = {
             "form_name": 'output_raw',
@@ -474,6 +1690,127 @@ class WebAppTest(unittest.TestCase):
         r = requests.post('http://localhost:8002/submit', data, auth=self.auth_user)
         self.assertIn('string=<foo>', r.text)
 
+    def testOutputStream(self):
+        data = {
+            "form_name": 'output_stream',
+            "string": '<foo>\xc3\xa9'
+        }
+        headers = {'Accept-Encoding': 'identity'}
+        start = time.time()
+        r = requests.post('http://localhost:8002/submit', data, headers=headers,
+                          auth=self.auth_user, stream=True)
+        output = ''
+        for piece in r.iter_content(1):
+            output += piece
+            if 'first' in output:
+                break
+        # The first line arrives before the script is done.
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertIn('<h1>', output)
+        output += r.raw.read()
+        self.assertIn('string=&lt;foo&gt;\xc3\xa9\nsecond', output)
+        self.assertIn('</pre>', output)
+        self.assertNotIn('class="error"', output)
+        self.assertTrue(output.endswith('</html>\n'))
+
+    def testOutputStreamFail(self):
+        data = {"form_name": 'output_stream_fail'}
+        r = requests.post('http://localhost:8002/submit', data, auth=self.auth_user)
+        self.assertEquals(r.headers['Content-Encoding'], 'gzip')
+        self.assertIn('stdout output', r.text)
+        self.assertIn('exited with code 1', r.text)
+        self.assertIn('<span class="error">stderr output', r.text)
+
+    def testOutputLarge(self):
+        data = {"form_name": 'output_large'}
+        r = requests.post('http://localhost:8002/submit', data, auth=self.auth_user)
+        self.assertEquals(r.status_code, 200)
+        self.assertIn('<pre class="output-head">1\n2\n3\n', r.text)
+        self.assertIn('49999\n50000\n</pre>', r.text)
+        self.assertNotIn('\n25000\n', r.text)
+        self.assertIn('bytes of output not shown', r.text)
+        output_id = re.search('output\?output_id=([0-9a-f-]+)', r.text).group(1)
+
+        url = 'http://localhost:8002/output?output_id=' + output_id
+        r = requests.get(url, auth=self.auth_user)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.headers['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertIn('attachment', r.headers['Content-Disposition'])
+        expected = ''.join('{0}\n'.format(i) for i in range(1, 50001))
+        self.assertEquals(r.content, expected)
+
+        # Only the user that ran the script can download its output.
+        r = requests.get(url, auth=self.auth_admin)
+        self.assertEquals(r.status_code, 404)
+        r = requests.get(url)
+        self.assertEquals(r.status_code, 401)
+        r = requests.get('http://localhost:8002/output?output_id=x',
+                         auth=self.auth_user)
+        self.assertEquals(r.status_code, 404)
+
+    def waitForJob(self, url, auth):
+        for i in range(50):
+            r = requests.get(url, auth=auth)
+            if 'Refresh' not in r.headers:
+                return r
+            time.sleep(0.1)
+        self.fail("Job didn't finish")
+
+    def testOutputAsync(self):
+        data = {
+            "form_name": 'output_async',
+            "string": '<foo>'
+        }
+        start = time.time()
+        r = requests.post('http://localhost:8002/submit', data,
+                          auth=self.auth_user, allow_redirects=False)
+        # The response doesn't wait for the script.
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertEquals(r.status_code, 303)
+        self.assertTrue(r.headers['Location'].startswith('job?job_id='))
+        url = 'http://localhost:8002/' + r.headers['Location']
+
+        r = requests.get(url, auth=self.auth_user)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.headers['Refresh'], '2')
+        self.assertIn('class="job-state"', r.text)
+
+        # Only the user that submitted the job can see it.
+        r = requests.get(url, auth=self.auth_admin)
+        self.assertEquals(r.status_code, 404)
+
+        r = self.waitForJob(url, self.auth_user)
+        self.assertEquals(r.status_code, 200)
+        self.assertIn('first\nstring=&lt;foo&gt;\nsecond', r.text)
+        self.assertIn('Back to the form', r.text)
+
+        r = requests.get('http://localhost:8002/job?job_id=x',
+                         auth=self.auth_user)
+        self.assertEquals(r.status_code, 404)
+        r = requests.get(url.replace('job?', 'job_output?') + '&name=../x',
+                         auth=self.auth_user)
+        self.assertEquals(r.status_code, 404)
+        r = requests.get(url.replace('job?', 'job_output?'),
+                         auth=self.auth_user)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.content, 'first\nstring=<foo>\nsecond\n')
+
+    def testUploadAsync(self):
+        f = file('data.raw', 'w')
+        f.write('x' * 1024)
+        f.close()
+
+        data = {"form_name": "upload_async"}
+        files = {'file': open('data.raw', 'rb')}
+        r = requests.post("http://localhost:8002/submit", files=files,
+                          data=data, auth=self.auth_user,
+                          allow_redirects=False)
+        url = 'http://localhost:8002/' + r.headers['Location']
+        # The upload outlives the request, until the job has run.
+        r = self.waitForJob(url, self.auth_user)
+        self.assertIn('SAME', r.text)
+        os.unlink('data.raw')
+
     def testUpload(self):
         import random
         f = file('data.raw', 'w')
@@ -489,6 +1826,175 @@ class WebAppTest(unittest.TestCase):
         self.assertIn('SAME', r.text)
         os.unlink('data.raw')
 
+    def testUploadTooLarge(self):
+        f = file('data.raw', 'w')
+        f.write('x' * 4096)
+        f.close()
+
+        data = {
+            "form_name": "upload_limited"
+        }
+        files = {'file': open('data.raw', 'rb')}
+        r = requests.post("http://localhost:8002/submit", files=files, data=data, auth=self.auth_user)
+        self.assertEquals(r.status_code, 413)
+        os.unlink('data.raw')
+
+    def testConditionalGet(self):
+        url = "http://localhost:8002/form?form_name=validate"
+        r = requests.get(url, auth=self.auth_user)
+        etag = r.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEquals(r.headers['Cache-Control'], 'private, no-cache')
+        self.assertIn('Authorization', r.headers['Vary'])
+        self.assertIn('Accept-Encoding', r.headers['Vary'])
+
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'If-None-Match': etag})
+        self.assertEquals(r.status_code, 304)
+        self.assertEquals(r.content, '')
+        self.assertEquals(r.headers['ETag'], etag)
+
+        # Other users, query values and pages have other ETags.
+        r = requests.get(url, auth=self.auth_admin,
+                         headers={'If-None-Match': etag})
+        self.assertEquals(r.status_code, 200)
+        self.assertNotEquals(r.headers['ETag'], etag)
+        r = requests.get(url + "&integer=5", auth=self.auth_user,
+                         headers={'If-None-Match': etag})
+        self.assertEquals(r.status_code, 200)
+        r = requests.get("http://localhost:8002/", auth=self.auth_user,
+                         headers={'If-None-Match': etag})
+        self.assertEquals(r.status_code, 200)
+
+        # Authentication is checked before the ETag.
+        r = requests.get(url, headers={'If-None-Match': etag})
+        self.assertEquals(r.status_code, 401)
+
+    def testConditionalGetList(self):
+        r = requests.get("http://localhost:8002/", auth=self.auth_user)
+        r = requests.get("http://localhost:8002/", auth=self.auth_user,
+                         headers={'If-None-Match': 'W/"x", ' + r.headers['ETag']})
+        self.assertEquals(r.status_code, 304)
+
+    def testNoETagOnSubmit(self):
+        data = {"form_name": "validate", "string": "12345"}
+        r = requests.post("http://localhost:8002/submit", data, auth=self.auth_user)
+        self.assertNotIn('ETag', r.headers)
+
+    def testAuthPBKDF2(self):
+        url = "http://localhost:8002/form?form_name=validate"
+        for i in range(2):
+            r = requests.get(url, auth=requests.auth.HTTPBasicAuth('pbkdf2', 'pbkdf2'))
+            self.assertEquals(r.status_code, 200)
+        r = requests.get(url, auth=requests.auth.HTTPBasicAuth('pbkdf2', 'wrong'))
+        self.assertEquals(r.status_code, 401)
+
+    def testLoginRedirect(self):
+        headers = {'Accept': 'text/html,*/*;q=0.8'}
+        r = requests.get('http://localhost:8002/form?form_name=validate',
+                         headers=headers, allow_redirects=False)
+        self.assertEquals(r.status_code, 303)
+        self.assertEquals(r.headers['Location'], 'login?url=form%3Fform_name%3Dvalidate')
+        r = requests.get('http://localhost:8002/form/?form_name=validate',
+                         headers=headers, allow_redirects=False)
+        self.assertEquals(r.headers['Location'], '../login?url=form%2F%3Fform_name%3Dvalidate')
+        # Clients that aren't browsers still get asked for basic auth.
+        r = requests.get('http://localhost:8002/form?form_name=validate',
+                         allow_redirects=False)
+        self.assertEquals(r.status_code, 401)
+
+    def testLogin(self):
+        r = requests.get('http://localhost:8002/login?url=form%3Fform_name%3Dvalidate')
+        self.assertEquals(r.status_code, 200)
+        self.assertIn('value="form?form_name=validate"', r.text)
+
+        data = {'username': 'user', 'password': 'wrong', 'url': 'form?form_name=validate'}
+        r = requests.post('http://localhost:8002/login', data, allow_redirects=False)
+        self.assertEquals(r.status_code, 200)
+        self.assertIn('Invalid username or password', r.text)
+        self.assertNotIn('Set-Cookie', r.headers)
+
+        data['password'] = 'user'
+        r = requests.post('http://localhost:8002/login', data, allow_redirects=False)
+        self.assertEquals(r.status_code, 303)
+        self.assertEquals(r.headers['Location'], 'form?form_name=validate')
+        self.assertIn('HttpOnly', r.headers['Set-Cookie'])
+        self.assertNotIn('Secure', r.headers['Set-Cookie'])
+        cookies = r.cookies
+
+        r = requests.get('http://localhost:8002/form?form_name=validate', cookies=cookies)
+        self.assertEquals(r.status_code, 200)
+        self.assertIn('Cookie', r.headers['Vary'])
+        r = requests.get('http://localhost:8002/form?form_name=admin_only', cookies=cookies)
+        self.assertEquals(r.status_code, 403)
+
+        cookies = {'scriptform_session': cookies['scriptform_session'][:-1] + 'x'}
+        r = requests.get('http://localhost:8002/form?form_name=validate', cookies=cookies)
+        self.assertEquals(r.status_code, 401)
+
+    def testLoginOffsite(self):
+        for url in ('http://example.com/', '//example.com/', ' //example.com/',
+                    '///example.com/', '/\\example.com/', '\\\\example.com',
+                    '/\t/example.com/', 'http:example.com', 'javascript:alert(1)',
+                    'a\r\nX-Foo: bar', ''):
+            data = {'username': 'user', 'password': 'user', 'url': url}
+            r = requests.post('http://localhost:8002/login', data, allow_redirects=False)
+            self.assertEquals(r.status_code, 303)
+            self.assertEquals(r.headers['Location'], '.')
+
+    def testLocalUrl(self):
+        import webapp
+        self.assertEquals(webapp.local_url('form?form_name=a:b'), 'form?form_name=a:b')
+        self.assertEquals(webapp.local_url('  /form?form_name=x '), '/form?form_name=x')
+        self.assertEquals(webapp.local_url('../form'), '../form')
+        self.assertEquals(webapp.local_url('/a//b'), '/a//b')
+        self.assertEquals(webapp.local_url(' //example.com'), '.')
+
+    def testLoginHTTPS(self):
+        data = {'username': 'user', 'password': 'user', 'url': 'form?form_name=validate'}
+        headers = {'X-Forwarded-Proto': 'https'}
+        r = requests.post('http://localhost:8002/login', data, headers=headers, allow_redirects=False)
+        self.assertEquals(r.status_code, 303)
+        self.assertIn('; Secure', r.headers['Set-Cookie'])
+
+    def testLogout(self):
+        r = requests.get('http://localhost:8002/logout', allow_redirects=False)
+        self.assertEquals(r.status_code, 303)
+        self.assertIn('scriptform_session=;', r.headers['Set-Cookie'])
+        self.assertIn('Max-Age=0', r.headers['Set-Cookie'])
+
+    def testAuthMalformed(self):
+        url = "http://localhost:8002/form?form_name=validate"
+        for header in ('Basic', 'Basic !!!', 'Basic ' + 'nocolon'.encode('base64').strip()):
+            r = requests.get(url, headers={'Authorization': header})
+            self.assertEquals(r.status_code, 401)
+
+    def testStyle(self):
+        r = requests.get("http://localhost:8002/", auth=self.auth_user)
+        self.assertNotIn('<style>', r.text)
+        css_hash = re.search('href="style\\?v=([0-9a-f]+)"', r.text).group(1)
+        # The stylesheet doesn't require authentication.
+        r = requests.get("http://localhost:8002/style?v=" + css_hash)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.headers['Content-Type'], 'text/css; charset=utf-8')
+        self.assertIn('immutable', r.headers['Cache-Control'])
+        self.assertIn('.btn-act', r.text)
+
+    def testStyleOutdated(self):
+        r = requests.get("http://localhost:8002/style?v=0123456789abcdef")
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.headers['Cache-Control'], 'no-cache')
+
+    def testMetricsDisabled(self):
+        r = requests.get("http://localhost:8002/metrics", auth=self.auth_admin)
+        self.assertEquals(r.status_code, 404)
+
+    def testUploadInvalid(self):
+        headers = {'Content-Type': 'multipart/form-data; boundary=XyZ'}
+        r = requests.post("http://localhost:8002/submit", data="garbage",
+                          headers=headers, auth=self.auth_user)
+        self.assertEquals(r.status_code, 400)
+
     def testStaticValid(self):
         r = requests.get("http://localhost:8002/static?fname=ssh_server.png", auth=self.auth_user)
         self.assertEquals(r.status_code, 200)
@@ -499,6 +2005,66 @@ class WebAppTest(unittest.TestCase):
         f_orig = file('static/ssh_server.png', 'rb').read()
         self.assertEquals(f_orig, f_served)
 
+    def testStaticHeaders(self):
+        url = "http://localhost:8002/static?fname=ssh_server.png"
+        r = requests.get(url, auth=self.auth_user)
+        self.assertEquals(r.headers['Content-Type'], 'image/png')
+        self.assertEquals(r.headers['Content-Length'], '3015')
+        self.assertEquals(r.headers['Accept-Ranges'], 'bytes')
+        self.assertEquals(r.headers['Cache-Control'], 'private, no-cache')
+        self.assertIn('Last-Modified', r.headers)
+
+        etag = r.headers['ETag']
+        r = requests.get(url, auth=self.auth_user, headers={'If-None-Match': etag})
+        self.assertEquals(r.status_code, 304)
+        self.assertEquals(r.content, '')
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'If-Modified-Since': r.headers['Last-Modified']})
+        self.assertEquals(r.status_code, 304)
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'If-Modified-Since': 'Thu, 01 Jan 2004 00:00:00 GMT'})
+        self.assertEquals(r.status_code, 200)
+
+    def testStaticRange(self):
+        url = "http://localhost:8002/static?fname=ssh_server.png"
+        f_orig = file('static/ssh_server.png', 'rb').read()
+        r = requests.get(url, auth=self.auth_user, headers={'Range': 'bytes=10-19'})
+        self.assertEquals(r.status_code, 206)
+        self.assertEquals(r.headers['Content-Range'], 'bytes 10-19/3015')
+        self.assertEquals(r.content, f_orig[10:20])
+
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'Range': 'bytes=3000-', 'If-Range': r.headers['ETag']})
+        self.assertEquals(r.status_code, 206)
+        self.assertEquals(r.content, f_orig[3000:])
+
+        # The file changed since the client got the first part
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'Range': 'bytes=3000-', 'If-Range': '"0-0"'})
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.content, f_orig)
+
+        r = requests.get(url, auth=self.auth_user, headers={'Range': 'bytes=4000-'})
+        self.assertEquals(r.status_code, 416)
+        self.assertEquals(r.headers['Content-Range'], 'bytes */3015')
+
+    def testStaticGzip(self):
+        css = 'p { color: red; }\n' * 100
+        file('static/tmp_style.css', 'w').write(css)
+        try:
+            url = "http://localhost:8002/static?fname=tmp_style.css"
+            r = requests.get(url, auth=self.auth_user)
+            self.assertEquals(r.headers['Content-Encoding'], 'gzip')
+            self.assertEquals(r.headers['Content-Type'], 'text/css')
+            self.assertEquals(r.headers['Vary'], 'Accept-Encoding')
+            self.assertEquals(r.text, css)
+            r = requests.get(url, auth=self.auth_user,
+                             headers={'Accept-Encoding': 'identity'})
+            self.assertNotIn('Content-Encoding', r.headers)
+            self.assertEquals(r.headers['Content-Length'], str(len(css)))
+        finally:
+            os.unlink('static/tmp_style.css')
+
     def testStaticInvalidFilename(self):
         r = requests.get("http://localhost:8002/static?fname=../../ssh_server.png", auth=self.auth_user)
         self.assertEquals(r.status_code, 403)
@@ -558,6 +2124,449 @@ class WebAppSingleTest(unittest.TestCase):
         self.assertEquals(r.status_code, 501)
 
 
+class WebAppMetricsTest(unittest.TestCase):
+    """
+    Test the /metrics page and request timing.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.auth_admin = requests.auth.HTTPBasicAuth('admin', 'admin')
+        cls.auth_user = requests.auth.HTTPBasicAuth('user', 'user')
+        os.mkdir('tmp_profile')
+
+        def server_thread(sf):
+            sf.run(listen_port=8002, metrics=True, server_timing=True,
+                   trace_file='tmp_trace', profile_dir='tmp_profile',
+                   profile_mode='cprofile', static_cache_size=0)
+        cls.sf = scriptform.ScriptForm('test_webapp.json')
+        thread.start_new_thread(server_thread, (cls.sf, ))
+        # Wait until the webserver is ready
+        while True:
+            time.sleep(0.1)
+            if cls.sf.running:
+                break
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sf.shutdown()
+        while True:
+            time.sleep(0.1)
+            if not cls.sf.running:
+                break
+        if os.path.exists('tmp_trace'):
+            os.unlink('tmp_trace')
+        shutil.rmtree('tmp_profile')
+
+    def testMetrics(self):
+        requests.get("http://localhost:8002/form?form_name=validate", auth=self.auth_user)
+        data = {"form_name": "output_escaped", "string": "foo"}
+        requests.post("http://localhost:8002/submit", data, auth=self.auth_user)
+
+        r = requests.get("http://localhost:8002/metrics", auth=self.auth_admin)
+        self.assertEquals(r.status_code, 200)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        self.assertIn('scriptform_http_requests_total{route="/form",method="GET",status="200"}', r.text)
+        self.assertIn('scriptform_http_request_duration_seconds_count{route="/submit"}', r.text)
+        self.assertIn('scriptform_script_exits_total{form="output_escaped",exitcode="0"}', r.text)
+        self.assertIn('scriptform_script_duration_seconds_bucket{form="output_escaped",le="+Inf"}', r.text)
+        self.assertIn('scriptform_http_requests_in_flight 1', r.text)
+        self.assertIn('scriptform_scripts_running 0', r.text)
+
+    def testServerTiming(self):
+        data = {"form_name": "output_escaped", "string": "foo"}
+        r = requests.post("http://localhost:8002/submit", data, auth=self.auth_user)
+        phases = [t.split(';')[0] for t in r.headers['Server-Timing'].split(', ')]
+        self.assertEquals(phases, ['parse', 'auth', 'validate', 'spawn',
+                                   'script', 'render', 'total'])
+
+    def testTrace(self):
+        r = requests.get("http://localhost:8002/form?form_name=validate", auth=self.auth_user)
+        time.sleep(0.2)
+        spans = [json.loads(line) for line in file('tmp_trace', 'r')]
+        request = [span for span in spans if span['span'] == 'request'][-1]
+        self.assertEquals(request['route'], '/form')
+        self.assertEquals(request['status'], 200)
+        phases = [span['span'] for span in spans
+                  if span['trace'] == request['trace']]
+        self.assertEquals(phases, ['request', 'auth', 'render'])
+
+    def testProfile(self):
+        self.sf.toggle_profiling()
+        requests.get("http://localhost:8002/form?form_name=validate", auth=self.auth_user)
+        requests.get("http://localhost:8002/form?form_name=../nosuchform", auth=self.auth_user)
+        data = {"form_name": "output_escaped", "string": "foo"}
+        requests.post("http://localhost:8002/submit", data, auth=self.auth_user)
+        self.sf.toggle_profiling()
+        fnames = sorted(os.listdir('tmp_profile'))
+        self.assertEquals(fnames, [
+            'scriptform.{0}.form.pstats'.format(os.getpid()),
+            'scriptform.{0}.form.validate.pstats'.format(os.getpid()),
+            'scriptform.{0}.submit.output_escaped.pstats'.format(os.getpid()),
+        ])
+        stats = pstats.Stats(os.path.join('tmp_profile', fnames[2]))
+        funcs = [func[2] for func in stats.stats]
+        self.assertIn('h_submit', funcs)
+        self.assertIn('run_script', funcs)
+
+    def testStaticUncached(self):
+        url = "http://localhost:8002/static?fname=ssh_server.png"
+        f_orig = file('static/ssh_server.png', 'rb').read()
+        r = requests.get(url, auth=self.auth_user)
+        self.assertEquals(r.content, f_orig)
+        self.assertEquals(r.headers['Content-Type'], 'image/png')
+        r = requests.get(url, auth=self.auth_user, headers={'Range': 'bytes=10-19'})
+        self.assertEquals(r.status_code, 206)
+        self.assertEquals(r.content, f_orig[10:20])
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'If-None-Match': r.headers['ETag']})
+        self.assertEquals(r.status_code, 304)
+
+    def testMetricsUsers(self):
+        r = requests.get("http://localhost:8002/metrics")
+        self.assertEquals(r.status_code, 401)
+        r = requests.get("http://localhost:8002/metrics", auth=self.auth_user)
+        self.assertEquals(r.status_code, 403)
+
+
+class WebAppPoolTest(unittest.TestCase):
+    """
+    Test the worker pool server mode.
+    """
+    @classmethod
+    def setUpClass(cls):
+        def server_thread(sf):
+            sf.run(listen_port=8002, threads=1, queue_size=1)
+        cls.sf = scriptform.ScriptForm('test_webapp_singleform.json')
+        thread.start_new_thread(server_thread, (cls.sf, ))
+        # Wait until the webserver is ready
+        while True:
+            time.sleep(0.1)
+            if cls.sf.running:
+                break
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sf.shutdown()
+        while True:
+            time.sleep(0.1)
+            if not cls.sf.running:
+                break
+
+    def testRequest(self):
+        r = requests.get("http://localhost:8002/")
+        self.assertEquals(r.status_code, 200)
+        self.assertIn('only_form', r.text)
+
+    def testQueueFull(self):
+        """
+        When the worker is busy and the queue is full, new requests get a 503
+        """
+        import socket
+        # Occupy the single worker, then fill up the queue.
+        busy = socket.create_connection(('localhost', 8002))
+        time.sleep(0.2)
+        queued = socket.create_connection(('localhost', 8002))
+        time.sleep(0.2)
+
+        r = requests.get("http://localhost:8002/")
+        self.assertEquals(r.status_code, 503)
+        self.assertIn('Retry-After', r.headers)
+
+        busy.close()
+        queued.close()
+        time.sleep(0.2)
+        r = requests.get("http://localhost:8002/")
+        self.assertEquals(r.status_code, 200)
+
+    def testCloseQueueFull(self):
+        """
+        Closing the server doesn't hang when the queue is full, and closes the
+        queued connections
+        """
+        import socket
+        import BaseHTTPServer
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        server = webserver.ThreadPoolHTTPServer(('localhost', 8003), Handler,
+                                                threads=1, queue_size=1)
+        thread.start_new_thread(server.serve_forever, ())
+        busy = socket.create_connection(('localhost', 8003))
+        time.sleep(0.2)
+        queued = socket.create_connection(('localhost', 8003))
+        time.sleep(0.2)
+
+        start = time.time()
+        server.shutdown()
+        server.server_close()
+        self.assertTrue(time.time() - start < 2)
+        queued.settimeout(5)
+        self.assertEquals(queued.recv(1), '')
+        queued.close()
+        busy.close()
+
+
+class WebAppKeepAliveTest(unittest.TestCase):
+    """
+    Test HTTP/1.1 keep-alive connections.
+    """
+    @classmethod
+    def setUpClass(cls):
+        def server_thread(sf):
+            sf.run(listen_port=8002, keepalive=2)
+        cls.sf = scriptform.ScriptForm('test_webapp.json')
+        thread.start_new_thread(server_thread, (cls.sf, ))
+        # Wait until the webserver is ready
+        while True:
+            time.sleep(0.1)
+            if cls.sf.running:
+                break
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sf.shutdown()
+        while True:
+            time.sleep(0.1)
+            if not cls.sf.running:
+                break
+
+    def setUp(self):
+        import base64
+        import httplib
+        self.conn = httplib.HTTPConnection('localhost', 8002)
+        self.headers = {
+            'Authorization': 'Basic ' + base64.b64encode('user:user')
+        }
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _get(self, path, headers=None):
+        if headers is None:
+            headers = self.headers
+        self.conn.request('GET', path, headers=headers)
+        r = self.conn.getresponse()
+        return r, r.read()
+
+    def testReuse(self):
+        """Multiple requests, including errors, go over one connection"""
+        r, body = self._get('/')
+        self.assertEquals(r.version, 11)
+        self.assertFalse(r.will_close)
+        self.assertIn('Output escaped', body)
+        sock = self.conn.sock
+
+        r, body = self._get('/nosuchurl')
+        self.assertEquals(r.status, 404)
+        self.assertFalse(r.will_close)
+
+        r, body = self._get('/', headers={})
+        self.assertEquals(r.status, 401)
+        self.assertFalse(r.will_close)
+
+        r, body = self._get('/form?form_name=validate')
+        self.assertEquals(r.status, 200)
+        self.assertIn('Validated form', body)
+        self.assertIs(self.conn.sock, sock)
+
+    def testCompressChunked(self):
+        """Compressed responses are chunked and keep the connection open"""
+        import gzip
+        headers = dict(self.headers, **{'Accept-Encoding': 'gzip'})
+        r, body = self._get('/form?form_name=validate', headers=headers)
+        self.assertEquals(r.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEquals(r.getheader('Content-Encoding'), 'gzip')
+        self.assertFalse(r.will_close)
+        body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+        self.assertIn('Validated form', body)
+
+        r, body = self._get('/form?form_name=validate')
+        self.assertIn('Validated form', body)
+
+    def testPost(self):
+        """Form submits keep the connection open"""
+        headers = self.headers.copy()
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.conn.request('POST', '/submit',
+                          'form_name=output_escaped&string=foo', headers)
+        r = self.conn.getresponse()
+        self.assertIn('string=foo', r.read())
+        self.assertFalse(r.will_close)
+
+        r, body = self._get('/')
+        self.assertEquals(r.status, 200)
+
+    def testRawCloses(self):
+        """Raw output can't be framed, so the connection is closed"""
+        headers = self.headers.copy()
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.conn.request('POST', '/submit',
+                          'form_name=output_raw_headers&string=foo', headers)
+        start = time.time()
+        r = self.conn.getresponse()
+        self.assertIn('raw output: foo', r.read())
+        # Reading until the end of the response shouldn't have to wait for
+        # the idle timeout.
+        self.assertTrue(time.time() - start < 1)
+
+    def testIdleTimeout(self):
+        """Idle connections are closed by the server"""
+        r, body = self._get('/')
+        sock = self.conn.sock
+        time.sleep(2.5)
+        self.assertEquals(sock.recv(1), '')
+
+
+class WebAppEventTest(unittest.TestCase):
+    """
+    Test the event engine, which parks idle connections in a poll loop.
+    """
+    @classmethod
+    def setUpClass(cls):
+        def server_thread(sf):
+            sf.run(listen_port=8002, threads=2, queue_size=2, keepalive=2,
+                   engine='events')
+        cls.sf = scriptform.ScriptForm('test_webapp_singleform.json')
+        thread.start_new_thread(server_thread, (cls.sf, ))
+        # Wait until the webserver is ready
+        while True:
+            time.sleep(0.1)
+            if cls.sf.running:
+                break
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sf.shutdown()
+        while True:
+            time.sleep(0.1)
+            if not cls.sf.running:
+                break
+
+    def testIdleConnections(self):
+        """Idle connections don't occupy worker threads"""
+        import socket
+        idle = [socket.create_connection(('localhost', 8002))
+                for i in range(20)]
+        time.sleep(0.2)
+        r = requests.get("http://localhost:8002/")
+        self.assertEquals(r.status_code, 200)
+        self.assertIn('only_form', r.text)
+        for conn in idle:
+            conn.close()
+
+    def testKeepAlive(self):
+        """Connections are reused and closed once idle for too long"""
+        import httplib
+        conn = httplib.HTTPConnection('localhost', 8002)
+        for i in range(3):
+            conn.request('GET', '/')
+            r = conn.getresponse()
+            self.assertIn('only_form', r.read())
+            self.assertFalse(r.will_close)
+            if i == 0:
+                sock = conn.sock
+            self.assertIs(conn.sock, sock)
+        time.sleep(2.5)
+        self.assertEquals(sock.recv(1), '')
+        conn.close()
+
+    def testPipelined(self):
+        """Pipelined requests are answered even though they're buffered"""
+        import socket
+        conn = socket.create_connection(('localhost', 8002))
+        conn.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n' * 2 +
+                     'GET / HTTP/1.1\r\nHost: localhost\r\n'
+                     'Connection: close\r\n\r\n')
+        response = ''
+        while True:
+            buf = conn.recv(65536)
+            if not buf:
+                break
+            response += buf
+        conn.close()
+        self.assertEquals(response.count('HTTP/1.1 200 OK'), 3)
+
+    def testStalledRequest(self):
+        """Clients that stall halfway through a request don't block workers"""
+        import socket
+        import BaseHTTPServer
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write('ok')
+
+            def log_message(self, *args):
+                pass
+
+        server = webserver.EventHTTPServer(('localhost', 8003), Handler,
+                                           threads=1, queue_size=1,
+                                           idle_timeout=1)
+        thread.start_new_thread(server.serve_forever, ())
+        try:
+            stalled = socket.create_connection(('localhost', 8003))
+            stalled.sendall('GET / HTTP/1.0\r\nHost: loc')
+            time.sleep(0.2)
+            start = time.time()
+            r = requests.get("http://localhost:8003/", timeout=5)
+            self.assertEquals(r.text, 'ok')
+            self.assertTrue(time.time() - start < 3)
+            stalled.settimeout(5)
+            self.assertEquals(stalled.recv(1), '')
+            stalled.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class WebAppPreforkTest(unittest.TestCase):
+    """
+    Test the pre-fork mode, where multiple processes serve requests.
+    """
+    @classmethod
+    def setUpClass(cls):
+        def server_thread(sf):
+            sf.run(listen_port=8002, workers=2)
+        cls.sf = scriptform.ScriptForm('test_webapp_singleform.json')
+        thread.start_new_thread(server_thread, (cls.sf, ))
+        # Wait until the webserver is ready
+        while True:
+            time.sleep(0.1)
+            if cls.sf.running:
+                break
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sf.shutdown()
+        while True:
+            time.sleep(0.1)
+            if not cls.sf.running:
+                break
+
+    def testRequests(self):
+        for i in range(10):
+            r = requests.get("http://localhost:8002/")
+            self.assertEquals(r.status_code, 200)
+            self.assertIn('only_form', r.text)
+
+    def testRestartWorker(self):
+        """Workers that die are restarted"""
+        import signal
+        children = self.sf.supervisor.children.keys()
+        self.assertEquals(len(children), 2)
+        os.kill(children[0], signal.SIGKILL)
+        time.sleep(1.5)
+        new_children = self.sf.supervisor.children.keys()
+        self.assertEquals(len(new_children), 2)
+        self.assertNotIn(children[0], new_children)
+
+        r = requests.get("http://localhost:8002/")
+        self.assertEquals(r.status_code, 200)
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.FATAL,
                         format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
@@ -570,6 +2579,18 @@ if __name__ == '__main__':
     sys.path.insert(0, '../src')
     import scriptform
     import runscript
+    import formdata
+    import webserver
+    import logqueue
+    import metrics
+    import profiling
+    import watchdog
+    import filecache
+    import auth
+    import authbackends
+    import ldapclient
+    import outputstore
+    import jobs
     unittest.main(exit=False)
 
     cov.stop()
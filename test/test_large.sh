@@ -0,0 +1,3 @@
+#!/bin/sh
+
+seq 1 50000
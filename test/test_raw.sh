@@ -0,0 +1,6 @@
+#!/bin/sh
+
+printf "HTTP/1.0 200 OK\r\n"
+printf "Content-Type: text/plain\r\n"
+printf "\r\n"
+echo "raw output: $string"
@@ -0,0 +1,6 @@
+#!/bin/sh
+
+echo "first"
+sleep 1
+echo "string=$string"
+echo "second"